@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# Keeps the log of the benchmark runs out of the working tree, settings.config reads it on import
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'informative_telegram-benchmarks.log'))
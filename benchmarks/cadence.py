@@ -0,0 +1,77 @@
+"""
+Cadence simulation: polls and notification latency of the adaptive manga polling against one poll a day.
+
+A few hundred series are generated, weekly, biweekly, monthly, irregular and dormant ones, each with two months of
+history before the simulated period. Every series is then polled as tgbot.cadence schedules it, and once a day as
+the night slot does, counting the polls and how long each release waited before a poll saw it. Either way the
+chats get the chapters in their night slot, the wait is how stale the watermarks and the release history get.
+
+    python -m benchmarks.cadence
+    python -m benchmarks.cadence --series 1000 --days 365 --seed 7
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from tgbot import cadence
+
+# Days between releases of each kind of series, dormant ones released once long ago
+KINDS = {'weekly': 7, 'biweekly': 14, 'monthly': 30, 'irregular': 10, 'dormant': None}
+WEIGHTS = {'weekly': 2, 'biweekly': 1, 'monthly': 1, 'irregular': 1, 'dormant': 1}
+
+
+def generate_series(count: int, start: datetime, days: int) -> list[list[datetime]]:
+    """Release times of each series, from two months before `start` to the end of the simulated period"""
+    series = []
+    for kind in random.choices(list(WEIGHTS), weights=list(WEIGHTS.values()), k=count):
+        period = KINDS[kind]
+        if period is None:
+            series.append([start - timedelta(days=400)])
+            continue
+        release_times = []
+        release_at = start - timedelta(days=60) + timedelta(hours=random.uniform(0, 24 * period))
+        while release_at < start + timedelta(days=days):
+            release_times.append(release_at)
+            jitter = random.uniform(0.5, 1.5) if kind == 'irregular' else 1
+            release_at += timedelta(days=period * jitter, hours=random.uniform(-6, 6))
+        series.append(release_times)
+    return series
+
+
+def simulate(series: list[list[datetime]], start: datetime, days: int, adaptive: bool) -> tuple[int, float]:
+    """:return: polls made and the mean hours a release waited to be seen"""
+    end = start + timedelta(days=days)
+    polls = 0
+    waits = []
+    for release_times in series:
+        seen = [release_at for release_at in release_times if release_at < start][-cadence.HISTORY:]
+        pending = [release_at for release_at in release_times if release_at >= start]
+        now = start
+        while now < end:
+            polls += 1
+            new = [release_at for release_at in pending if release_at <= now]
+            waits += [(now - release_at).total_seconds() / 3600 for release_at in new]
+            pending = pending[len(new):]
+            seen = (seen + new)[-cadence.HISTORY:]
+            now = cadence.next_poll(seen, now)[0] if adaptive else now + timedelta(days=1)
+    return polls, sum(waits) / len(waits) if waits else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--series', type=int, default=300)
+    parser.add_argument('--days', type=int, default=120, help='length of the simulated period')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = datetime(2026, 1, 1)
+    series = generate_series(args.series, start, args.days)
+    print(f"{'polling':>10} {'polls':>10} {'mean wait (h)':>14}")
+    for name, adaptive in (('daily', False), ('adaptive', True)):
+        polls, wait = simulate(series, start, args.days, adaptive)
+        print(f"{name:>10} {polls:>10} {wait:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Local stand-ins for OpenWeatherMap, the RSS feeds, MangaDex and the Telegram Bot API, used by the scale benchmark.
+
+Every upstream listens on its own port with its own latency and rate limit, past the limit it answers 429 with a
+Retry-After header as the real services do. The servers run in a child process so their CPU time and memory stay
+out of the bot's measurements.
+"""
+import asyncio
+import json
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+
+HOST = '127.0.0.1'
+REASONS = {200: 'OK', 304: 'Not Modified', 404: 'Not Found', 429: 'Too Many Requests'}
+
+
+class Upstream:
+    """Minimal keep-alive HTTP/1.1 server, subclasses build the responses"""
+
+    def __init__(self, latency: float = 0.0, rate: float = 0.0):
+        self.latency = latency
+        # Requests per second, 0 means unlimited
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.requests = 0
+        self.limited = 0
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'limited': self.limited}
+
+    def allow(self) -> bool:
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def respond(self, method: str, path: str, query: dict, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        raise NotImplementedError
+
+    def rate_limited(self) -> tuple[int, dict, bytes]:
+        return 429, {'Retry-After': '1'}, b'{"result": "error"}'
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self.requests += 1
+                allowed = self.allow()
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if allowed:
+                    url = urlsplit(target)
+                    status, extra, payload = self.respond(method, url.path, parse_qs(url.query), headers, body)
+                else:
+                    self.limited += 1
+                    status, extra, payload = self.rate_limited()
+
+                head = [f'HTTP/1.1 {status} {REASONS.get(status, "")}', f'Content-Length: {len(payload)}',
+                        'Connection: keep-alive']
+                head += [f'{name}: {value}' for name, value in extra.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def json_response(data: dict) -> tuple[int, dict, bytes]:
+    return 200, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+
+class OpenWeatherMap(Upstream):
+    def respond(self, method, path, query, headers, body):
+        now = int(time.time())
+        hourly = [{'dt': now + hour * 3600, 'weather': [{'id': 500 if hour % 3 else 800, 'main': 'Rain',
+                                                         'description': 'light rain' if hour % 3 else 'clear sky'}]}
+                  for hour in range(48)]
+        return json_response({'timezone_offset': -18000, 'hourly': hourly})
+
+
+class RssFeeds(Upstream):
+    """Serves /feed/<n>.xml, every feed has an entry per hour going back from `newest`"""
+
+    def __init__(self, newest: datetime, entries: int = 50, **kwargs):
+        super().__init__(**kwargs)
+        self.newest = newest
+        self.entries = entries
+        self._documents: dict[str, bytes] = {}
+
+    def document(self, path: str) -> bytes:
+        content = self._documents.get(path)
+        if content is None:
+            items = []
+            for i in range(self.entries):
+                published = (self.newest - timedelta(hours=i)).strftime('%a, %d %b %Y %H:%M:%S +0000')
+                items.append(f'<item><title>{path} post {i}</title><link>http://{HOST}{path}#{i}</link>'
+                             f'<description>{"Lorem ipsum dolor sit amet. " * 10}</description>'
+                             f'<pubDate>{published}</pubDate></item>')
+            content = self._documents[path] = (
+                '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                f'<title>{path}</title>{"".join(items)}</channel></rss>').encode()
+        return content
+
+    def respond(self, method, path, query, headers, body):
+        if not path.startswith('/feed/'):
+            return 404, {}, b''
+        etag = f'"{path}"'
+        if headers.get('if-none-match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'Content-Type': 'application/rss+xml', 'ETag': etag}, self.document(path)
+
+
+class MangaDex(Upstream):
+    """
+    Serves /chapter, /manga, /manga/<id>/feed and /manga/<id>, every manga has a few chapters before `newest`
+    except the dormant-<n> ones, which have none. publishAtSince is honoured.
+    """
+
+    def __init__(self, newest: datetime, chapters: int = 2, **kwargs):
+        super().__init__(**kwargs)
+        self.newest = newest
+        self.chapters = chapters
+
+    def manga_chapters(self, manga_id: str) -> list[dict]:
+        if manga_id.startswith('dormant-'):
+            return []
+        return [{'id': f'{manga_id}-{number}',
+                 'attributes': {'chapter': str(number), 'title': f'Chapter {number}', 'translatedLanguage': 'en',
+                                'publishAt': (self.newest - timedelta(hours=number)).strftime(
+                                    '%Y-%m-%dT%H:%M:%S+00:00')},
+                 'relationships': [{'type': 'scanlation_group', 'id': 'group'}, {'type': 'manga', 'id': manga_id}]}
+                for number in range(self.chapters)]
+
+    @staticmethod
+    def manga(manga_id: str) -> dict:
+        return {'id': manga_id, 'type': 'manga',
+                'attributes': {'title': {'en': f'Title of {manga_id}'}, 'altTitles': [{'ja': manga_id}],
+                               'status': 'ongoing'}}
+
+    def page(self, data: list[dict], query: dict) -> tuple[int, dict, bytes]:
+        if 'publishAtSince' in query:
+            # Same format on both sides, so the strings compare as the dates do
+            since = query['publishAtSince'][0]
+            data = [item for item in data if item['attributes'].get('publishAt', since)[0:19] >= since]
+        limit = int(query.get('limit', ['10'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        return json_response({'result': 'ok', 'limit': limit, 'offset': offset, 'total': len(data),
+                              'data': data[offset:offset + limit]})
+
+    def rate_limited(self):
+        return 429, {'Retry-After': '1'}, json.dumps(
+            {'result': 'error', 'errors': [{'status': 429, 'title': 'Too Many Requests', 'detail': ''}]}).encode()
+
+    def respond(self, method, path, query, headers, body):
+        parts = path.strip('/').split('/')
+        if parts == ['chapter']:
+            data = [chapter for manga_id in query.get('manga[]', []) for chapter in self.manga_chapters(manga_id)]
+            data.sort(key=lambda chapter: chapter['attributes']['publishAt'], reverse=True)
+            return self.page(data, query)
+        if len(parts) == 3 and parts[0] == 'manga' and parts[2] == 'feed':
+            return self.page(self.manga_chapters(parts[1]), query)
+        if parts == ['manga']:
+            return self.page([self.manga(manga_id) for manga_id in query.get('ids[]', [])], query)
+        if len(parts) == 2 and parts[0] == 'manga':
+            return json_response({'result': 'ok', 'data': self.manga(parts[1])})
+        return 404, {}, b''
+
+
+class TelegramBotApi(Upstream):
+    """Answers getMe and sendMessage like the Bot API, flood control included"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = 0
+        self.chats: set[str] = set()
+
+    def stats(self) -> dict:
+        return {**super().stats(), 'messages': self.messages, 'chats': len(self.chats)}
+
+    def rate_limited(self):
+        return 429, {'Retry-After': '1', 'Content-Type': 'application/json'}, json.dumps(
+            {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+             'parameters': {'retry_after': 1}}).encode()
+
+    def respond(self, method, path, query, headers, body):
+        api_method = path.rsplit('/', 1)[-1]
+        if api_method == 'getMe':
+            return json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Benchmark',
+                                                         'username': 'benchmark_bot'}})
+        if api_method == 'sendMessage':
+            if headers.get('content-type', '').startswith('application/json'):
+                params = json.loads(body)
+            else:
+                params = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+            chat_id = str(params['chat_id'])
+            self.messages += 1
+            self.chats.add(chat_id)
+            return json_response({'ok': True, 'result': {
+                'message_id': self.messages, 'date': int(time.time()), 'text': params.get('text', ''),
+                'chat': {'id': int(chat_id), 'type': 'private'}}})
+        return 404, {}, b'{"ok": false, "error_code": 404, "description": "Not Found"}'
+
+
+async def _serve(options: dict, conn) -> None:
+    newest = options['newest']
+    upstreams = {
+        'owm': OpenWeatherMap(**options['owm']),
+        'rss': RssFeeds(newest, options['feed_entries'], **options['rss']),
+        'dex': MangaDex(newest, options['chapters'], **options['dex']),
+        'telegram': TelegramBotApi(**options['telegram']),
+    }
+    servers = {name: await asyncio.start_server(upstream.serve, HOST, 0) for name, upstream in upstreams.items()}
+    conn.send({name: f'http://{HOST}:{server.sockets[0].getsockname()[1]}' for name, server in servers.items()})
+
+    loop = asyncio.get_running_loop()
+    while (command := await loop.run_in_executor(None, conn.recv)) != 'stop':
+        if command == 'stats':
+            conn.send({name: upstream.stats() for name, upstream in upstreams.items()})
+    for server in servers.values():
+        server.close()
+
+
+def _run(options: dict, conn) -> None:
+    asyncio.run(_serve(options, conn))
+
+
+class FakeApis:
+    """
+    Starts every stand-in in a child process, `urls` holds their base urls.
+    :param latency: seconds every upstream waits before answering, per upstream name
+    :param rate: requests per second each upstream accepts, 0 for unlimited
+    :param newest: date of the latest feed entry and manga chapter
+    """
+
+    def __init__(self, latency: dict[str, float], rate: dict[str, float], newest: datetime,
+                 feed_entries: int = 50, chapters: int = 2):
+        self.options = {name: {'latency': latency.get(name, 0.0), 'rate': rate.get(name, 0.0)}
+                        for name in ('owm', 'rss', 'dex', 'telegram')}
+        self.options.update(newest=newest, feed_entries=feed_entries, chapters=chapters)
+        self.urls: dict[str, str] = {}
+        self._conn = None
+        self._process = None
+
+    def start(self) -> dict[str, str]:
+        context = multiprocessing.get_context('spawn')
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_run, args=(self.options, child_conn), daemon=True)
+        self._process.start()
+        self.urls = self._conn.recv()
+        return self.urls
+
+    def stats(self) -> dict[str, dict]:
+        """Request counters of every upstream since it started"""
+        self._conn.send('stats')
+        return self._conn.recv()
+
+    def stop(self) -> None:
+        if self._process is None:
+            return
+        self._conn.send('stop')
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+
+    def __enter__(self) -> 'FakeApis':
+        self.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.stop()
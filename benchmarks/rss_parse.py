@@ -0,0 +1,73 @@
+"""
+Micro-benchmark: feedparser against the streaming parser on large feeds.
+
+feedparser parses the whole document and every date before the top 10 entries are kept. The streaming
+parser stops at the watermark (a chat that is up to date) or after 10 entries (a new subscriber).
+
+    python -m benchmarks.rss_parse --entries 1000 10000
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import feedparser
+
+from tgbot import rss
+
+NEWEST = datetime(2024, 1, 31, 12, 0, 0)
+
+
+def build_feed(entries: int) -> bytes:
+    items = []
+    for i in range(entries):
+        published = (NEWEST - timedelta(hours=i)).strftime('%a, %d %b %Y %H:%M:%S +0000')
+        items.append(f'<item><title>Post number {i}</title><link>https://blog.example/{i}</link>'
+                     f'<description>{"Lorem ipsum dolor sit amet. " * 20}</description>'
+                     f'<pubDate>{published}</pubDate></item>')
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Benchmark</title>'
+            + ''.join(items) + '</channel></rss>').encode()
+
+
+def feedparser_top10(content: bytes, since: datetime) -> list:
+    """What get_rss_feed did before the streaming parser"""
+    news_feed = feedparser.parse(content)
+    return [(d, e['title']) for e in news_feed.entries[:10] if (d := rss.entry_date(e)) > since]
+
+
+def measure(func, *args, repeat: int = 3) -> tuple[float, float, list]:
+    """Best wall time in ms and peak traced memory in MiB"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best * 1000, peak / 2 ** 20, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, nargs='+', default=[1_000, 10_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    scenarios = {
+        'up to date (3 new)': NEWEST - timedelta(hours=3),
+        'new subscriber': datetime(2000, 1, 1),
+    }
+    print(f"{'entries':>8} {'scenario':>20} {'feedparser ms':>14} {'MiB':>7} {'stream ms':>10} {'MiB':>7}")
+    for entries in args.entries:
+        content = build_feed(entries)
+        for scenario, since in scenarios.items():
+            fp_ms, fp_mib, fp_result = measure(feedparser_top10, content, since, repeat=args.repeat)
+            st_ms, st_mib, st_result = measure(rss.parse_feed, content, since, repeat=args.repeat)
+            assert fp_result == st_result, 'parsers disagree'
+            print(f"{entries:>8} {scenario:>20} {fp_ms:>14.1f} {fp_mib:>7.1f} {st_ms:>10.2f} {st_mib:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+Scale benchmark: the scheduled fan-out against local stand-ins of OpenWeatherMap, the RSS feeds, MangaDex and the
+Telegram Bot API (see benchmarks.fake_apis).
+
+For every size a fresh database is seeded with that many chats, each following the weather at one of --locations
+places, one of --feeds blogs and one of --mangas mangas. Then load_saved_jobs, weather_update, blog_update and
+dex_updates are run, and their messages go through the send queue to the fake Bot API. Each phase reports its wall
+time, upstream requests, messages per second, the peak RSS of the process and the event loop lag.
+
+    python -m benchmarks.scale --chats 1000 10000 100000
+    python -m benchmarks.scale --chats 1000 --latency 0.2 --tg-rate 30 --tg-limit 30   # production limits
+
+The send queue is not held to Telegram's 30 msg/s by default, at that pace 100k chats take almost an hour per slot
+and the benchmark would only measure the limit. Results are appended to benchmarks/results/scale.jsonl and every
+phase is compared with the previous run of the same size and options.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import resource
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+from telegram.ext import Application, CallbackContext
+
+import db.db_funcs as dbf
+import tgbot.bot as bot
+import tgbot.my_apis as my_apis
+from benchmarks.fake_apis import FakeApis
+from settings.config import ServiceType, DEFAULT_TIMEZONE
+from tgbot import http_client
+from tgbot.digest import build_digests
+from tgbot.ratelimit import TokenBucket
+from tgbot.sender import send_queue
+
+RESULTS_FILE = os.path.join(os.path.dirname(__file__), 'results', 'scale.jsonl')
+
+PRODUCERS = {
+    'weather_update': (ServiceType.WEATHER, bot.weather_update),
+    'blog_update': (ServiceType.BLOG, bot.blog_update),
+    'dex_updates': (ServiceType.DEX, bot.dex_updates),
+    # The next day's dex slot, the dormant mangas should be packed with the rest by then
+    'dex_updates_next': (ServiceType.DEX, bot.dex_updates),
+}
+
+
+def weather_location(i: int, locations: int) -> str:
+    """One degree apart so each location is a grid cell of its own, no location follows the default one"""
+    if not locations:
+        return ''
+    cell = i % locations
+    return my_apis.format_location(-45 + cell % 90, -170 + cell // 90)
+
+
+def seed_db(db_filepath: str, chats: int, feeds: int, mangas: int, feed_base_url: str,
+            last_updated: datetime.datetime, locations: int = 0, dormant: int = 0) -> None:
+    """
+    Every chat is active and follows the weather at one of the locations, one of the feeds and one of the mangas.
+    The first `dormant` mangas have had no chapters since the chats subscribed, their watermark is still the 2000
+    one new subscriptions start with.
+    """
+    dbf.initialize_db(db_filepath)
+    conn = sqlite3.connect(db_filepath)
+    conn.executemany("INSERT INTO chat(id, active, last_updated) VALUES(?, 1, ?)",
+                     ((str(i), last_updated) for i in range(chats)))
+    optional_urls = {
+        ServiceType.WEATHER: lambda i: weather_location(i, locations),
+        ServiceType.BLOG: lambda i: f'{feed_base_url}/feed/{i % feeds}.xml',
+        ServiceType.DEX: lambda i: f'dormant-{i % mangas}' if i % mangas < dormant else f'manga-{i % mangas}',
+    }
+    never = datetime.datetime(2000, 1, 1)
+    services = ((str(i), stype.value, never if optional_urls[stype](i).startswith('dormant-') else last_updated,
+                 optional_urls[stype](i))
+                for i in range(chats) for stype in ServiceType)
+    conn.executemany("INSERT INTO service(id_chat, id_type, active, last_updated, optional_url) "
+                     "VALUES(?, ?, 1, ?, ?)", services)
+    conn.commit()
+    conn.close()
+
+
+class LoopLag:
+    """Samples how late the event loop wakes up a task that sleeps for `interval`"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - start - self.interval)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+        # Yield once so the sampler is already asleep when the first phase starts
+        await asyncio.sleep(0)
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def collect(self) -> tuple[float, float]:
+        """Max and p99 lag in ms since the last call"""
+        samples, self.samples = sorted(self.samples), []
+        if not samples:
+            return 0.0, 0.0
+        return samples[-1] * 1000, samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def upstream_requests(before: dict, after: dict) -> dict[str, int]:
+    return {name: after[name]['requests'] - before[name]['requests'] for name in after}
+
+
+async def run_phase(name: str, application: Application, fakes: FakeApis, lag: LoopLag) -> dict:
+    stats_before = fakes.stats()
+    lag.collect()
+    start = time.perf_counter()
+    if name == 'load_saved_jobs':
+        # Blocks the loop as it does at startup, the lag shows for how long
+        bot.load_saved_jobs(CallbackContext(application))
+    else:
+        stype, producer = PRODUCERS[name]
+        # Each phase stands for a slot of its own, not for another timezone in the same one
+        my_apis._slot_polls.clear()
+        services = await bot.get_slot_services(DEFAULT_TIMEZONE, stype)
+        bot.notify(build_digests([await producer(services)]))
+        await send_queue.join()
+    wall = time.perf_counter() - start
+    # Let the sampler wake up, so a phase that blocked the loop is charged its own lag
+    await asyncio.sleep(lag.interval * 2)
+    stats_after = fakes.stats()
+    lag_max, lag_p99 = lag.collect()
+    messages = stats_after['telegram']['messages'] - stats_before['telegram']['messages']
+    return {
+        'phase': name,
+        'wall_s': round(wall, 3),
+        'requests': upstream_requests(stats_before, stats_after),
+        'rate_limited': {upstream: stats_after[upstream]['limited'] - stats_before[upstream]['limited']
+                         for upstream in stats_after},
+        'messages': messages,
+        'msgs_per_s': round(messages / wall, 1) if wall else 0.0,
+        'peak_rss_mib': round(peak_rss_mib(), 1),
+        'loop_lag_max_ms': round(lag_max, 1),
+        'loop_lag_p99_ms': round(lag_p99, 1),
+    }
+
+
+async def run_size(chats: int, args, fakes: FakeApis) -> list[dict]:
+    urls = fakes.urls
+    my_apis.OWM_BASE_URL = urls['owm']
+    my_apis.DEX_BASE_URL = urls['dex']
+    my_apis._weather_cache.clear()
+    my_apis._feed_cache.clear()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_filepath = os.path.join(tmp, 'db.sqlite3')
+        bot.db_file = my_apis.db_file = db_filepath
+        # Seeded a day back, so every chat has a few new entries and chapters and the dex poll is batched
+        seed_db(db_filepath, chats, args.feeds, args.mangas, urls['rss'],
+                datetime.datetime.now() - datetime.timedelta(days=1), args.locations, args.dormant)
+
+        application = Application.builder().token('0:benchmark').base_url(f"{urls['telegram']}/bot").build()
+        await application.initialize()
+        await http_client.start_client()
+        send_queue.global_bucket = TokenBucket('Telegram', args.tg_rate, args.tg_rate)
+        send_queue.chat_buckets.clear()
+        send_queue.start(application.bot)
+        lag = LoopLag()
+        await lag.start()
+        try:
+            for phase in ('load_saved_jobs', *PRODUCERS):
+                result = await run_phase(phase, application, fakes, lag)
+                results.append(result)
+                print_result(chats, result)
+        finally:
+            await lag.stop()
+            await send_queue.stop()
+            await http_client.close_client()
+            await application.shutdown()
+            dbf.close_connections()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def load_previous(results_file: str) -> list[dict]:
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_wall(previous: list[dict], record: dict) -> float | None:
+    """Wall time of the latest stored run of the same phase, size and options"""
+    for old in reversed(previous):
+        if (old['phase'], old['chats'], old['options']) == (record['phase'], record['chats'], record['options']):
+            return old['wall_s']
+    return None
+
+
+def print_result(chats: int, result: dict) -> None:
+    requests = ' '.join(f'{name}={count}' for name, count in result['requests'].items() if count)
+    print(f"{chats:>8} {result['phase']:>16} {result['wall_s']:>9.2f} {result['messages']:>8} "
+          f"{result['msgs_per_s']:>9.1f} {result['peak_rss_mib']:>8.1f} {result['loop_lag_max_ms']:>8.1f} "
+          f"{result['loop_lag_p99_ms']:>8.1f}  {requests}")
+
+
+async def run(args) -> list[dict]:
+    latency = {'owm': args.latency, 'rss': args.latency, 'dex': args.latency, 'telegram': args.tg_latency}
+    rate = {'dex': args.dex_limit, 'telegram': args.tg_limit}
+    newest = datetime.datetime.now() - datetime.timedelta(minutes=1)
+    print(f"{'chats':>8} {'phase':>16} {'wall (s)':>9} {'msgs':>8} {'msgs/s':>9} {'RSS MiB':>8} "
+          f"{'lag max':>8} {'lag p99':>8}  upstream requests")
+    results = []
+    with FakeApis(latency, rate, newest, feed_entries=args.feed_entries) as fakes:
+        for chats in args.chats:
+            for result in await run_size(chats, args, fakes):
+                results.append({'chats': chats, **result})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--locations', type=int, default=100, help='distinct weather locations of the chats')
+    parser.add_argument('--feeds', type=int, default=100, help='distinct feeds the chats follow')
+    parser.add_argument('--mangas', type=int, default=1_000, help='distinct mangas the chats follow')
+    parser.add_argument('--dormant', type=int, default=100, help='mangas without chapters since 2000')
+    parser.add_argument('--feed-entries', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds OWM, the feeds and MangaDex take')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='seconds the Bot API takes')
+    parser.add_argument('--dex-limit', type=float, default=5, help='requests/s MangaDex accepts, 0 for no limit')
+    parser.add_argument('--tg-limit', type=float, default=0, help='requests/s the Bot API accepts, 0 for no limit')
+    parser.add_argument('--tg-rate', type=float, default=1000, help='messages/s the send queue is allowed')
+    parser.add_argument('--results', default=RESULTS_FILE, help='jsonl file the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='only print the results')
+    args = parser.parse_args()
+
+    # Keep the per-request logging of the bot out of the report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(run(args))
+
+    options = {name: getattr(args, name) for name in ('locations', 'feeds', 'mangas', 'dormant', 'feed_entries',
+                                                      'latency', 'tg_latency', 'dex_limit', 'tg_limit', 'tg_rate')}
+    stamp = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+             'options': options}
+    records = [{**stamp, **result} for result in results]
+
+    previous = load_previous(args.results)
+    if previous:
+        print('\nChange against the previous run')
+        for record in records:
+            old = previous_wall(previous, record)
+            if old:
+                change = (record['wall_s'] - old) / old * 100
+                print(f"{record['chats']:>8} {record['phase']:>16} {old:>9.2f} -> {record['wall_s']:>9.2f} "
+                      f"{change:>+7.1f}%")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+        with open(args.results, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
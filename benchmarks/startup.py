@@ -0,0 +1,90 @@
+"""
+Startup benchmark: time spent loading the saved jobs for a growing number of chats.
+
+Compares the previous load_saved_jobs, which built a TChat of every active chat to collect their
+timezones, with the current one, which asks the database for the distinct timezones.
+
+    python -m benchmarks.startup --chats 10000 100000
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+
+from telegram.ext import Application, CallbackContext
+
+import db.db_funcs as dbf
+import tgbot.bot as bot
+from settings.config import ServiceType, DEFAULT_TIMEZONE
+from tgbot.models import TChat
+
+
+# Timezones of the seeded chats, one in four keeps the default
+TIMEZONES = [None, 'Europe/Madrid', 'Asia/Tokyo', 'America/New_York']
+
+
+def seed_db(db_filepath: str, chats: int) -> None:
+    """Every chat is active and follows the weather, the blog and one manga"""
+    dbf.initialize_db(db_filepath)
+    now = datetime.datetime.now()
+    conn = sqlite3.connect(db_filepath)
+    conn.executemany("INSERT INTO chat(id, active, last_updated, timezone) VALUES(?, 1, ?, ?)",
+                     ((str(i), now, TIMEZONES[i % len(TIMEZONES)]) for i in range(chats)))
+    services = ((str(i), stype.value, now, f'manga-{i % 1000}' if stype == ServiceType.DEX else '')
+                for i in range(chats) for stype in ServiceType)
+    conn.executemany("INSERT INTO service(id_chat, id_type, active, last_updated, optional_url) "
+                     "VALUES(?, ?, 1, ?, ?)", services)
+    conn.commit()
+    conn.close()
+
+
+def previous_load(db_filepath: str) -> set[str]:
+    """The timezones as load_saved_jobs collected them before asking the database for the distinct ones"""
+    timezones = {DEFAULT_TIMEZONE}
+    for row in dbf.get_active_chat_list(db_filepath):
+        tchat = TChat(row)
+        if tchat.timezone:
+            timezones.add(tchat.timezone)
+    return timezones
+
+
+def current_load(db_filepath: str, application: Application) -> None:
+    bot.db_file = db_filepath
+    bot.load_saved_jobs(CallbackContext(application))
+
+
+def timed(func, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--skip-previous', action='store_true', help='only time the current load')
+    args = parser.parse_args()
+
+    print(f"{'chats':>8} {'previous (s)':>12} {'current (s)':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        # The first jobs ever scheduled pay for setting up the job queue, keep it out of the timings
+        db_filepath = os.path.join(tmp, 'warmup.sqlite3')
+        seed_db(db_filepath, 1)
+        current_load(db_filepath, Application.builder().token('0:benchmark').build())
+    for chats in args.chats:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_filepath = os.path.join(tmp, 'bench.sqlite3')
+            seed_db(db_filepath, chats)
+            application = Application.builder().token('0:benchmark').build()
+            current, _ = timed(current_load, db_filepath, application)
+            if args.skip_previous:
+                print(f"{chats:>8} {'-':>12} {current:>12.3f} {'-':>8}")
+                continue
+            previous, _ = timed(previous_load, db_filepath)
+            print(f"{chats:>8} {previous:>12.3f} {current:>12.3f} {previous / current:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
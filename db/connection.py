@@ -0,0 +1,66 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from settings.config import DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_CACHED_STATEMENTS, DB_BUSY_TIMEOUT_MS, DB_THREADS
+from monitoring import profiling
+
+logger = logging.getLogger()
+
+# Long-lived connections, one per (thread, database file) since sqlite3 connections are not shared across threads
+_connections: dict[tuple[int, str], sqlite3.Connection] = {}
+_connections_lock = threading.Lock()
+
+# Threads the event loop hands its db calls to, WAL lets their reads run while another one writes
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+
+
+def chat_shard(id_chat: str, shards: int) -> int:
+    """Partition a chat belongs to, stable across processes and restarts"""
+    return zlib.crc32(str(id_chat).encode()) % shards
+
+
+def _connect(db_filepath: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_filepath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                           cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # NORMAL is durable under WAL except for the last transactions on a power loss
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    # Lets the worker processes select the chats of their shard in SQL
+    conn.create_function('shard_of', 2, chat_shard, deterministic=True)
+    return conn
+
+
+def get_connection(db_filepath: str) -> sqlite3.Connection:
+    """Returns the connection of the calling thread, opening it the first time"""
+    key = (threading.get_ident(), db_filepath)
+    conn = _connections.get(key)
+    if conn is None:
+        conn = _connect(db_filepath)
+        with _connections_lock:
+            _connections[key] = conn
+    return conn
+
+
+def close_connections() -> None:
+    """Closes every connection, the next call from any thread opens a new one"""
+    with _connections_lock:
+        for conn in _connections.values():
+            conn.close()
+        _connections.clear()
+    logger.info('Database connections closed')
+
+
+async def offload(func, *args, **kwargs):
+    """Runs a blocking db function in the db threads so the event loop keeps serving other chats"""
+    loop = asyncio.get_running_loop()
+    with profiling.phase('db'):
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
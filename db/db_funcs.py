@@ -1,7 +1,12 @@
 import datetime
-import sqlite3
+import json
+import time
 from contextlib import contextmanager
-from settings.config import log_config, ServiceType
+from db.connection import get_connection, close_connections, offload  # noqa: F401  (re-exported for callers)
+from db.migrations import migrate
+from db import subscriptions
+from settings.config import log_config, ServiceType, DEFAULT_TIMEZONE
+from monitoring import metrics
 import logging
 from logging import config as logging_config
 
@@ -10,26 +15,29 @@ logger = logging.getLogger()
 
 
 @contextmanager
-def db_ops(db_filepath):
+def db_ops(db_filepath, query: str = 'other'):
+    """Cursor in a transaction, its duration up to the commit is recorded under `query`"""
+    conn = get_connection(db_filepath)
+    cursor = conn.cursor()
+    start = time.perf_counter()
     try:
-        conn = sqlite3.connect(db_filepath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        cursor = conn.cursor()
         yield cursor
         conn.commit()
     except Exception as _:
+        conn.rollback()
         logger.error('Exception while performing db operation', exc_info=True)
         raise
     finally:
         cursor.close()
-        conn.close()
+        metrics.db_duration.observe(time.perf_counter() - start, query=query)
 
 
 def initialize_db(db_filepath) -> None:
     """
-    Creates a connection to the database and creates the tables if they don't exist.
+    Creates a connection to the database, creates the tables if they don't exist and applies the pending migrations.
     """
 
-    with db_ops(db_filepath) as cursor:
+    with db_ops(db_filepath, 'initialize_db') as cursor:
         cursor.execute('CREATE TABLE IF NOT EXISTS chat (id TEXT PRIMARY KEY, active INTEGER DEFAULT 0, '
                        'last_updated timestamp)')
         cursor.execute('CREATE TABLE IF NOT EXISTS service_type (id INTEGER PRIMARY KEY, name TEXT)')
@@ -37,10 +45,65 @@ def initialize_db(db_filepath) -> None:
                        'active INTEGER DEFAULT 0,last_updated timestamp, optional_url TEXT, '
                        'FOREIGN KEY (id_chat) REFERENCES chat (id), FOREIGN KEY (id_type) REFERENCES service_type(id), ' 
                        'UNIQUE(id_chat, id_type, optional_url) ON CONFLICT IGNORE)')
+    # Everything after the original schema is a versioned migration
+    migrate(db_filepath)
     for member in ServiceType:
         add_or_upd_service_type(db_filepath, member.value, member.name)
 
 
+CHAT_UPSERT = ("INSERT INTO chat(id,active,last_updated) VALUES(?,?,CURRENT_TIMESTAMP) "
+               "ON CONFLICT(id) DO UPDATE SET active=excluded.active, last_updated=excluded.last_updated")
+
+SERVICE_UPSERT = ("INSERT INTO service(id_chat,id_type,active,last_updated,optional_url) VALUES(?,?,?,?,?) "
+                  "ON CONFLICT(id_chat, id_type, optional_url) "
+                  "DO UPDATE SET active=excluded.active, last_updated=excluded.last_updated")
+
+# Queries run by every command or slot job, their plans are checked by db.migrations.check_query_plans
+ACTIVE_CHATS = "SELECT * FROM chat WHERE active=1"
+CHAT_SERVICES = "SELECT * FROM service WHERE active=1 AND id_chat=?"
+CHAT_SERVICES_BY_TYPE = "SELECT * FROM service WHERE active=1 AND id_chat=? AND id_type=?"
+CHAT_MANGAS = "SELECT * FROM service WHERE active=1 AND id_type=? AND id_chat=?"
+ACTIVE_TIMEZONES = "SELECT DISTINCT COALESCE(timezone, ?) FROM chat WHERE active=1"
+SERVICES_BY_TYPE = ("SELECT service.* FROM service JOIN chat ON chat.id = service.id_chat "
+                    "WHERE service.active=1 AND chat.active=1 AND service.id_type=?")
+TIMEZONE_FILTER = " AND COALESCE(chat.timezone, ?)=?"
+CHAT_SHARD_FILTER = " AND shard_of(chat.id, ?)=?"
+MANGA_METADATA = ("SELECT id, title, alt_titles, status, fetched_at FROM manga "
+                  "WHERE id IN (SELECT value FROM json_each(?))")
+DUE_MANGAS = ("SELECT followed.id FROM (SELECT DISTINCT service.optional_url AS id FROM service "
+              "JOIN chat ON chat.id = service.id_chat WHERE service.active=1 AND chat.active=1 "
+              "AND service.id_type=?) followed LEFT JOIN manga_poll ON manga_poll.id = followed.id "
+              "WHERE manga_poll.next_poll_at IS NULL OR manga_poll.next_poll_at <= ? "
+              "ORDER BY manga_poll.next_poll_at LIMIT ?")
+# Without the hint the planner prefers walking every DEX service in the covering index by type
+DEX_SERVICES = ("SELECT service.* FROM service INDEXED BY idx_service_active_url "
+                "JOIN chat ON chat.id = service.id_chat WHERE service.active=1 AND chat.active=1 "
+                "AND service.id_type=? AND service.optional_url IN (SELECT value FROM json_each(?))")
+DUE_OUTBOX = "SELECT id, id_chat, text FROM outbox WHERE send_at <= ?"
+OUTBOX_SHARD_FILTER = " AND shard_of(id_chat, ?)=?"
+OUTBOX_ORDER = " ORDER BY send_at, id LIMIT ?"
+HELD_NOTIFICATIONS = ("SELECT id, id_chat, text FROM pending WHERE id_type=? "
+                      "AND id_chat IN (SELECT value FROM json_each(?)) ORDER BY id")
+
+# Each hot query with sample parameters, once per combination of the optional filters used
+HOT_QUERIES = {
+    'get_active_chat_list': (ACTIVE_CHATS, ()),
+    'get_active_services_from_chat': (CHAT_SERVICES, ('0',)),
+    'get_active_manga_by_chat': (CHAT_MANGAS, (ServiceType.DEX.value, '0')),
+    'get_services_by_chatid': (CHAT_SERVICES_BY_TYPE, ('0', ServiceType.BLOG.value)),
+    'get_active_services_by_type': (SERVICES_BY_TYPE + TIMEZONE_FILTER, (ServiceType.DEX.value, 'UTC', 'UTC')),
+    'get_active_services_by_type shard': (SERVICES_BY_TYPE + TIMEZONE_FILTER + CHAT_SHARD_FILTER,
+                                          (ServiceType.DEX.value, 'UTC', 'UTC', 2, 0)),
+    'get_manga_metadata': (MANGA_METADATA, ('["0"]',)),
+    'get_due_mangas': (DUE_MANGAS, (ServiceType.DEX.value, '2000-01-01', 100)),
+    'get_dex_services': (DEX_SERVICES, (ServiceType.DEX.value, '["0"]')),
+    'take_due_outbox': (DUE_OUTBOX + OUTBOX_ORDER, ('2000-01-01', 100)),
+    'take_due_outbox shard': (DUE_OUTBOX + OUTBOX_SHARD_FILTER + OUTBOX_ORDER, ('2000-01-01', 2, 0, 100)),
+    'get_active_timezones': (ACTIVE_TIMEZONES, ('UTC',)),
+    'take_held_notifications': (HELD_NOTIFICATIONS, (ServiceType.DEX.value, '["0"]')),
+}
+
+
 def add_or_upd_chat(db_filepath: str, id_chat: str, active: int) -> int:
     """
     Create a new chat
@@ -49,13 +112,18 @@ def add_or_upd_chat(db_filepath: str, id_chat: str, active: int) -> int:
     :param active:
     :return: chat id
     """
-    sql = '''INSERT OR IGNORE INTO chat(id,active,last_updated) VALUES(?,?,CURRENT_TIMESTAMP)'''
-    with db_ops(db_filepath) as cursor:
-        cursor.execute(sql, (id_chat, active))
-        if cursor.lastrowid == 0:
-            cursor.execute("UPDATE chat SET active=?, last_updated=CURRENT_TIMESTAMP WHERE id=?", (active, id_chat))
-        lastrowid = cursor.lastrowid
-    return lastrowid
+    with db_ops(db_filepath, 'add_or_upd_chat') as cursor:
+        cursor.execute(CHAT_UPSERT + " RETURNING rowid", (id_chat, active))
+        rowid = cursor.fetchone()[0]
+    return rowid
+
+
+def set_chat_timezone(db_filepath: str, id_chat: str, timezone: str) -> None:
+    """
+    Set the timezone in which the chat receives its updates
+    """
+    with db_ops(db_filepath, 'set_chat_timezone') as cursor:
+        cursor.execute("UPDATE chat SET timezone=? WHERE id=?", (timezone, id_chat))
 
 
 def add_or_upd_service_type(db_filepath: str, id_servicetype: int, name: str) -> int:
@@ -67,16 +135,16 @@ def add_or_upd_service_type(db_filepath: str, id_servicetype: int, name: str) ->
     :return: service_type id
     """
     sql = '''INSERT OR IGNORE INTO service_type(id,name) VALUES(?,?)'''
-    with db_ops(db_filepath) as cursor:
+    with db_ops(db_filepath, 'add_or_upd_service_type') as cursor:
         cursor.execute(sql, (id_servicetype, name))
-        if cursor.lastrowid == 0:
+        if cursor.rowcount == 0:  # ignored, the row already exists
             cursor.execute("UPDATE service_type SET name=? WHERE id=?", (name, id_servicetype))
         lastrowid = cursor.lastrowid
     return lastrowid
 
 
 def add_or_upd_service(db_filepath: str, id_chat: str, id_type: int, active: int, optional_url='',
-                       last_updated: datetime.datetime = datetime.datetime.now()) -> int:
+                       last_updated: datetime.datetime = None) -> int:
     """
     Create a new service
     :param db_filepath:
@@ -84,30 +152,84 @@ def add_or_upd_service(db_filepath: str, id_chat: str, id_type: int, active: int
     :param id_type:
     :param active:
     :param optional_url:
-    :param last_updated:
+    :param last_updated: defaults to now
     :return: service id
     """
-    sql = '''INSERT OR IGNORE INTO service(id_chat,id_type,active,last_updated,optional_url) 
-    VALUES(?,?,?,?,?)'''
-    with db_ops(db_filepath) as cursor:
-        cursor.execute(sql, (id_chat, id_type, active, last_updated, optional_url))
-        if cursor.lastrowid == 0:
-            cursor.execute("SELECT * FROM service WHERE id_chat=? AND id_type=? AND optional_url=?",
-                           (id_chat, id_type, optional_url))
-            first_row = cursor.fetchall()[0]
-            upd_id = first_row[0]  # this is a tuple and the id is the first element
-            cursor.execute("UPDATE service SET id_chat=?, id_type=?, active=?, last_updated=?, "
-                           "optional_url=? WHERE id=?", (id_chat, id_type, active, last_updated, optional_url, upd_id))
-        lastrowid = cursor.lastrowid
-    return lastrowid
+    if last_updated is None:
+        last_updated = datetime.datetime.now()
+    with db_ops(db_filepath, 'add_or_upd_service') as cursor:
+        cursor.execute(SERVICE_UPSERT + " RETURNING id", (id_chat, id_type, active, last_updated, optional_url))
+        service_id = cursor.fetchone()[0]
+    subscriptions.upsert(id_chat, id_type, active, last_updated, optional_url, service_id)
+    return service_id
+
+
+class ServiceBatch:
+    """
+    Unit of work for service and chat writes. Upserts and deactivations are collected in memory
+    and flushed with executemany in a single transaction, so a fan-out or a bulk command commits once.
+
+        batch = ServiceBatch(db_file)
+        batch.upsert(id_chat, ServiceType.DEX.value, IsActive.YES, optional_url=manga_id, last_updated=lu)
+        await offload(batch.flush)
+    """
+
+    def __init__(self, db_filepath: str):
+        self.db_filepath = db_filepath
+        # Keyed by the unique columns, a later write to the same service replaces the earlier one
+        self.services: dict[tuple[str, int, str], tuple[int, datetime.datetime]] = {}
+        self.chats: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.services) + len(self.chats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def upsert(self, id_chat: str, id_type: int, active: int, optional_url='',
+               last_updated: datetime.datetime = None) -> None:
+        if last_updated is None:
+            last_updated = datetime.datetime.now()
+        self.services[(str(id_chat), id_type, optional_url)] = (active, last_updated)
+
+    def deactivate(self, id_chat: str, id_type: int, optional_url='', last_updated: datetime.datetime = None) -> None:
+        self.upsert(id_chat, id_type, 0, optional_url=optional_url, last_updated=last_updated)
+
+    def set_chat(self, id_chat: str, active: int) -> None:
+        self.chats[str(id_chat)] = active
+
+    def flush(self) -> int:
+        """
+        Writes everything collected so far in one transaction and empties the batch
+        :return: number of rows written
+        """
+        if not self:
+            return 0
+        services = [(id_chat, id_type, active, last_updated, optional_url)
+                    for (id_chat, id_type, optional_url), (active, last_updated) in self.services.items()]
+        chats = list(self.chats.items())
+        with db_ops(self.db_filepath, 'service_batch_flush') as cursor:
+            if chats:
+                cursor.executemany(CHAT_UPSERT, chats)
+            if services:
+                cursor.executemany(SERVICE_UPSERT, services)
+        subscriptions.upsert_many(services)
+        written = len(self)
+        self.services.clear()
+        self.chats.clear()
+        return written
 
 
 def get_active_chat_list(db_filepath: str) -> list:
     """
     Query all rows in the chat table that are labeled as active
     """
-    with db_ops(db_filepath) as cursor:
-        cursor.execute("SELECT * FROM chat WHERE active=1")
+    with db_ops(db_filepath, 'get_active_chat_list') as cursor:
+        cursor.execute(ACTIVE_CHATS)
         rows = cursor.fetchall()
     return rows
 
@@ -116,19 +238,258 @@ def get_active_services_from_chat(db_filepath: str, id_chat: str) -> list:
     """
     Query all rows in the service table that are labeled as active for a specific chat
     """
-    with db_ops(db_filepath) as cursor:
-        cursor.execute("SELECT * FROM service WHERE active=1 AND id_chat=?", (id_chat,))
+    with db_ops(db_filepath, 'get_active_services_from_chat') as cursor:
+        cursor.execute(CHAT_SERVICES, (id_chat,))
+        rows = cursor.fetchall()
+    return rows
+
+
+def get_active_timezones(db_filepath: str) -> list[str]:
+    """
+    Timezones the active chats get their updates in, DEFAULT_TIMEZONE for the chats that never set one
+    """
+    with db_ops(db_filepath, 'get_active_timezones') as cursor:
+        cursor.execute(ACTIVE_TIMEZONES, (DEFAULT_TIMEZONE,))
+        rows = cursor.fetchall()
+    return [row[0] for row in rows]
+
+
+def load_subscriptions(db_filepath: str) -> int:
+    """
+    Load every active service in the subscription index
+    :return: number of services loaded
+    """
+    with db_ops(db_filepath, 'load_subscriptions') as cursor:
+        cursor.execute("SELECT * FROM service WHERE active=1")
+        loaded = subscriptions.load(row for rows in iter(lambda: cursor.fetchmany(10000), []) for row in rows)
+    return loaded
+
+
+def reload_chat_subscriptions(db_filepath: str, id_chat: str) -> None:
+    """
+    Read the services of a chat again, for the watermarks moved by the worker processes
+    """
+    with db_ops(db_filepath, 'reload_chat_subscriptions') as cursor:
+        cursor.execute(CHAT_SERVICES, (id_chat,))
+        subscriptions.reload_chat(id_chat, cursor.fetchall())
+
+
+def get_active_services_by_type(db_filepath: str, id_type: int, timezone: str = None,
+                                shard: tuple[int, int] = None) -> list:
+    """
+    Query all active services of a type that belong to an active chat, optionally only for chats in a timezone
+    and in a shard, given as (index, number of shards)
+    """
+    sql = SERVICES_BY_TYPE
+    params = (id_type,)
+    if timezone:
+        sql += TIMEZONE_FILTER
+        params += (DEFAULT_TIMEZONE, timezone)
+    if shard:
+        sql += CHAT_SHARD_FILTER
+        params += (shard[1], shard[0])
+    with db_ops(db_filepath, 'get_active_services_by_type') as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    return rows
+
+
+def claim_slot(db_filepath: str, slot: str, timezone: str, run_on: datetime.date, shard: tuple[int, int],
+               timeout: float) -> bool:
+    """
+    Claim a shard of a slot run, only the first process to ask for it gets it, unless it never finished the run
+    and claimed it more than `timeout` seconds ago
+    :return: whether this process should run it
+    """
+    key = (slot, timezone, run_on.isoformat(), *shard)
+    with db_ops(db_filepath, 'claim_slot') as cursor:
+        cursor.execute("INSERT OR IGNORE INTO slot_claim(slot, timezone, run_on, shard, shards, claimed_at) "
+                       "VALUES(?,?,?,?,?,CURRENT_TIMESTAMP)", key)
+        if cursor.rowcount == 0:
+            cursor.execute("UPDATE slot_claim SET claimed_at=CURRENT_TIMESTAMP WHERE slot=? AND timezone=? "
+                           "AND run_on=? AND shard=? AND shards=? AND done_at IS NULL AND claimed_at < ?",
+                           key + (stale_since(timeout),))
+        claimed = cursor.rowcount == 1
+        # A week of claims is plenty to tell whether today's run already happened
+        cursor.execute("DELETE FROM slot_claim WHERE run_on < ?",
+                       ((run_on - datetime.timedelta(days=7)).isoformat(),))
+    return claimed
+
+
+def finish_slot(db_filepath: str, slot: str, timezone: str, run_on: datetime.date, shard: tuple[int, int]) -> None:
+    """Marks a claimed slot run as done, so it is never taken over"""
+    with db_ops(db_filepath, 'finish_slot') as cursor:
+        cursor.execute("UPDATE slot_claim SET done_at=CURRENT_TIMESTAMP WHERE slot=? AND timezone=? AND run_on=? "
+                       "AND shard=? AND shards=?", (slot, timezone, run_on.isoformat(), *shard))
+
+
+def get_abandoned_slots(db_filepath: str, shard: tuple[int, int], timeout: float) -> list:
+    """Slot runs of a shard, as (slot, timezone, run_on), claimed more than `timeout` seconds ago and never finished"""
+    with db_ops(db_filepath, 'get_abandoned_slots') as cursor:
+        cursor.execute("SELECT slot, timezone, run_on FROM slot_claim WHERE shard=? AND shards=? AND done_at IS NULL "
+                       "AND claimed_at < ?", (*shard, stale_since(timeout)))
+        rows = cursor.fetchall()
+    return rows
+
+
+def stale_since(timeout: float) -> str:
+    """claimed_at is CURRENT_TIMESTAMP, UTC text, so the cutoff is too"""
+    return (datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def queue_outbox(db_filepath: str, rows: list[tuple]) -> None:
+    """Stores digests as (id_chat, send_at, text) until their wave is due, in the order they are to be sent"""
+    with db_ops(db_filepath, 'queue_outbox') as cursor:
+        cursor.executemany("INSERT INTO outbox(id_chat, send_at, text) VALUES(?,?,?)", rows)
+
+
+def take_due_outbox(db_filepath: str, now: datetime.datetime, limit: int, shard: tuple[int, int] = None) -> list:
+    """
+    Removes and returns, as (id_chat, text), up to `limit` digests due by `now`, oldest first,
+    only those of the chats in a shard, given as (index, number of shards)
+    """
+    sql = DUE_OUTBOX
+    params = (now,)
+    if shard:
+        sql += OUTBOX_SHARD_FILTER
+        params += (shard[1], shard[0])
+    sql += OUTBOX_ORDER
+    with db_ops(db_filepath, 'take_due_outbox') as cursor:
+        cursor.execute(sql, params + (limit,))
+        rows = cursor.fetchall()
+        cursor.execute("DELETE FROM outbox WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps([row[0] for row in rows]),))
+    return [(id_chat, text) for _, id_chat, text in rows]
+
+
+def hold_notifications(db_filepath: str, id_type: int, rows: list[tuple]) -> None:
+    """Stores (id_chat, text) notifications of a service type until the chat's next slot takes them"""
+    with db_ops(db_filepath, 'hold_notifications') as cursor:
+        cursor.executemany("INSERT INTO pending(id_chat, id_type, text) VALUES(?,?,?)",
+                           [(id_chat, id_type, text) for id_chat, text in rows])
+
+
+def take_held_notifications(db_filepath: str, id_type: int, chat_ids: list[str]) -> list:
+    """Removes and returns, as (id_chat, text), the held notifications of a service type for the given chats"""
+    with db_ops(db_filepath, 'take_held_notifications') as cursor:
+        cursor.execute(HELD_NOTIFICATIONS, (id_type, json.dumps(chat_ids)))
+        rows = cursor.fetchall()
+        cursor.execute("DELETE FROM pending WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps([row[0] for row in rows]),))
+    return [(id_chat, text) for _, id_chat, text in rows]
+
+
+def get_followed_manga_ids(db_filepath: str) -> list[str]:
+    """
+    Ids of every manga followed by at least one chat
+    """
+    with db_ops(db_filepath, 'get_followed_manga_ids') as cursor:
+        cursor.execute("SELECT DISTINCT optional_url FROM service WHERE active=1 AND id_type=?",
+                       (ServiceType.DEX.value,))
+        rows = cursor.fetchall()
+    return [row[0] for row in rows]
+
+
+def get_manga_metadata(db_filepath: str, manga_ids: list[str]) -> list:
+    """
+    Query the cached metadata of the given mangas, marking them as used
+    :return: rows of (id, title, alt_titles, status, fetched_at)
+    """
+    ids = json.dumps(manga_ids)
+    with db_ops(db_filepath, 'get_manga_metadata') as cursor:
+        cursor.execute(MANGA_METADATA, (ids,))
         rows = cursor.fetchall()
+        if rows:
+            cursor.execute("UPDATE manga SET used_at=? WHERE id IN (SELECT value FROM json_each(?))",
+                           (datetime.datetime.now(), ids))
     return rows
 
 
+def save_manga_metadata(db_filepath: str, rows: list[tuple], max_rows: int) -> None:
+    """
+    Store fetched metadata, then evict the least recently used mangas past max_rows
+    :param rows: (id, title, alt_titles, status, fetched_at)
+    """
+    now = datetime.datetime.now()
+    with db_ops(db_filepath, 'save_manga_metadata') as cursor:
+        cursor.executemany("INSERT INTO manga(id, title, alt_titles, status, fetched_at, used_at) "
+                           "VALUES(?,?,?,?,?,?) ON CONFLICT(id) DO UPDATE SET title=excluded.title, "
+                           "alt_titles=excluded.alt_titles, status=excluded.status, "
+                           "fetched_at=excluded.fetched_at, used_at=excluded.used_at",
+                           [(*row, now) for row in rows])
+        cursor.execute("DELETE FROM manga WHERE id IN "
+                       "(SELECT id FROM manga ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (max_rows,))
+
+
+def get_due_mangas(db_filepath: str, now: datetime.datetime, limit: int) -> list[str]:
+    """
+    Ids of the followed mangas due for a poll, never polled ones first, then the most overdue
+    """
+    with db_ops(db_filepath, 'get_due_mangas') as cursor:
+        cursor.execute(DUE_MANGAS, (ServiceType.DEX.value, now, limit))
+        rows = cursor.fetchall()
+    return [row[0] for row in rows]
+
+
+def get_dex_services(db_filepath: str, manga_ids: list[str]) -> list:
+    """
+    Query the active services of active chats following the given mangas
+    """
+    with db_ops(db_filepath, 'get_dex_services') as cursor:
+        cursor.execute(DEX_SERVICES, (ServiceType.DEX.value, json.dumps(manga_ids)))
+        rows = cursor.fetchall()
+    return rows
+
+
+def record_manga_releases(db_filepath: str, releases: dict[str, list[datetime.datetime]],
+                          history: int) -> dict[str, list[datetime.datetime]]:
+    """
+    Store the chapter publish times seen by a poll, keeping the latest `history` of each manga
+    :return: the publish times kept for each of the given mangas
+    """
+    with db_ops(db_filepath, 'record_manga_releases') as cursor:
+        cursor.executemany("INSERT OR IGNORE INTO manga_release(manga_id, publish_at) VALUES(?,?)",
+                           [(manga_id, publish_at) for manga_id, times in releases.items() for publish_at in times])
+        cursor.executemany("DELETE FROM manga_release WHERE manga_id=? AND publish_at < "
+                           "(SELECT publish_at FROM manga_release WHERE manga_id=? ORDER BY publish_at DESC "
+                           "LIMIT 1 OFFSET ?)",
+                           [(manga_id, manga_id, history - 1) for manga_id, times in releases.items() if times])
+        cursor.execute("SELECT manga_id, publish_at FROM manga_release WHERE manga_id IN "
+                       "(SELECT value FROM json_each(?))", (json.dumps(list(releases)),))
+        rows = cursor.fetchall()
+    kept: dict[str, list[datetime.datetime]] = {}
+    for manga_id, publish_at in rows:
+        kept.setdefault(manga_id, []).append(publish_at)
+    return kept
+
+
+def set_manga_polls(db_filepath: str, rows: list[tuple]) -> None:
+    """
+    Store when each manga was polled and is due again
+    :param rows: (id, polled_at, next_poll_at, interval_s)
+    """
+    with db_ops(db_filepath, 'set_manga_polls') as cursor:
+        cursor.executemany("INSERT INTO manga_poll(id, polled_at, next_poll_at, interval_s) VALUES(?,?,?,?) "
+                           "ON CONFLICT(id) DO UPDATE SET polled_at=excluded.polled_at, "
+                           "next_poll_at=excluded.next_poll_at, interval_s=excluded.interval_s", rows)
+
+
 def get_active_manga_by_chat(db_filepath: str, id_chat: str) -> list:
     """
     Query all rows in the service table that are labeled as active for a specific chat
     """
-    with db_ops(db_filepath) as cursor:
-        cursor.execute("SELECT * FROM service WHERE active=1 AND id_type=? "
-                       " AND  id_chat=?", (ServiceType.DEX.value, id_chat))
+    with db_ops(db_filepath, 'get_active_manga_by_chat') as cursor:
+        cursor.execute(CHAT_MANGAS, (ServiceType.DEX.value, id_chat))
+        rows = cursor.fetchall()
+    return rows
+
+
+def get_services_by_chatid(db_filepath: str, id_chat: str, id_type: int) -> list:
+    """
+    Query all active services of a type for a specific chat
+    """
+    with db_ops(db_filepath, 'get_services_by_chatid') as cursor:
+        cursor.execute(CHAT_SERVICES_BY_TYPE, (id_chat, id_type))
         rows = cursor.fetchall()
     return rows
 
@@ -137,8 +498,8 @@ def get_service_by_chatid(db_filepath: str, id_chat: str, id_type: int) -> tuple
     """
     Query all rows in the service table that are labeled as active for a specific chat
     """
-    with db_ops(db_filepath) as cursor:
-        cursor.execute("SELECT * FROM service WHERE active=1 AND id_chat=? AND id_type=?", (id_chat, id_type))
+    with db_ops(db_filepath, 'get_service_by_chatid') as cursor:
+        cursor.execute(CHAT_SERVICES_BY_TYPE, (id_chat, id_type))
         rows = cursor.fetchall()
     if len(rows) > 0:
         return rows[0]
@@ -150,8 +511,9 @@ def remove_manga(db_filepath: str, id_chat: str,  manga_id: str) -> int:
     Remove a manga from the service table
     """
     rows_affected = 0
-    with db_ops(db_filepath) as cursor:
+    with db_ops(db_filepath, 'remove_manga') as cursor:
         cursor.execute("DELETE FROM service WHERE id_chat=? AND id_type=? AND optional_url=?",
                        (id_chat, ServiceType.DEX.value, manga_id))
         rows_affected = cursor.rowcount
+    subscriptions.remove(id_chat, ServiceType.DEX.value, manga_id)
     return rows_affected
@@ -0,0 +1,154 @@
+"""
+Versioned schema migrations, the applied version is kept in PRAGMA user_version.
+
+    python -m db.migrations            # migrate db_file to the latest version
+    python -m db.migrations --check    # also fail if a hot query falls back to a full table scan
+"""
+import argparse
+import logging
+import sqlite3
+
+from db.connection import get_connection
+
+logger = logging.getLogger()
+
+
+def add_chat_timezone(cursor: sqlite3.Cursor) -> None:
+    # Databases created while the column was added in place already have it
+    cursor.execute('PRAGMA table_info(chat)')
+    if 'timezone' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE chat ADD COLUMN timezone TEXT')
+
+
+def add_service_indexes(cursor: sqlite3.Cursor) -> None:
+    # Commands look up the active services of one chat
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_service_active_chat ON service (id_chat, id_type) '
+                   'WHERE active=1')
+    # Slot jobs read every active service of a type, covering so the table is never touched
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_service_active_type ON service '
+                   '(id_type, id_chat, active, last_updated, optional_url) WHERE active=1')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_active ON chat (id, timezone) WHERE active=1')
+
+
+def add_slot_claims(cursor: sqlite3.Cursor) -> None:
+    # Each worker process claims its shard of a slot before running it, so no shard is processed twice
+    cursor.execute('CREATE TABLE IF NOT EXISTS slot_claim (slot TEXT, timezone TEXT, run_on TEXT, shard INTEGER, '
+                   'shards INTEGER, claimed_at timestamp, PRIMARY KEY (slot, timezone, run_on, shard, shards))')
+
+
+def add_manga_metadata(cursor: sqlite3.Cursor) -> None:
+    # Titles and status of the followed mangas, shown without asking MangaDex each time, least recently used evicted
+    cursor.execute('CREATE TABLE IF NOT EXISTS manga (id TEXT PRIMARY KEY, title TEXT, alt_titles TEXT, status TEXT, '
+                   'fetched_at timestamp, used_at timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_manga_used_at ON manga (used_at)')
+
+
+def add_manga_schedule(cursor: sqlite3.Cursor) -> None:
+    # Latest chapter publish times of each manga, its release cadence is estimated from them
+    cursor.execute('CREATE TABLE IF NOT EXISTS manga_release (manga_id TEXT, publish_at timestamp, '
+                   'PRIMARY KEY (manga_id, publish_at)) WITHOUT ROWID')
+    # When each manga was polled and is due again
+    cursor.execute('CREATE TABLE IF NOT EXISTS manga_poll (id TEXT PRIMARY KEY, polled_at timestamp, '
+                   'next_poll_at timestamp, interval_s REAL)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_manga_poll_next ON manga_poll (next_poll_at)')
+    # The adaptive poller looks up the followers of the mangas due
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_service_active_url ON service (id_type, optional_url, id_chat) '
+                   'WHERE active=1')
+
+
+def add_outbox(cursor: sqlite3.Cursor) -> None:
+    # Digests of a slot waiting for their dispatch wave, what a stop or a crash leaves behind is sent on restart
+    cursor.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, id_chat TEXT, send_at timestamp, '
+                   'text TEXT)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_send_at ON outbox (send_at)')
+
+
+def add_slot_claim_done(cursor: sqlite3.Cursor) -> None:
+    # Set once the slot's digests are in the outbox, a claim left without it was abandoned by a dead worker
+    cursor.execute('ALTER TABLE slot_claim ADD COLUMN done_at timestamp')
+
+
+def add_pending(cursor: sqlite3.Cursor) -> None:
+    # Notifications found between slots, held until the next slot of the chat that serves their service type
+    cursor.execute('CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY, id_chat TEXT, id_type INTEGER, '
+                   'text TEXT)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_type_chat ON pending (id_type, id_chat)')
+
+
+# Append only, the position of a migration in this list is its version
+MIGRATIONS = [
+    add_chat_timezone,
+    add_service_indexes,
+    add_slot_claims,
+    add_manga_metadata,
+    add_manga_schedule,
+    add_outbox,
+    add_slot_claim_done,
+    add_pending,
+]
+
+
+def migrate(db_filepath: str) -> int:
+    """
+    Applies the pending migrations, each one in its own transaction.
+    :return: the schema version of the database
+    """
+    conn = get_connection(db_filepath)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        cursor = conn.cursor()
+        try:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version={number}')
+            conn.commit()
+        except Exception as _:
+            conn.rollback()
+            logger.error(f'Migration {number} ({migration.__name__}) failed', exc_info=True)
+            raise
+        finally:
+            cursor.close()
+        logger.info(f'Applied migration {number} ({migration.__name__})')
+        version = number
+    return version
+
+
+def check_query_plans(db_filepath: str, queries: dict[str, tuple[str, tuple]]) -> dict[str, list[str]]:
+    """
+    Raises if any of the queries would scan a whole table instead of using an index.
+    :param queries: sql and sample parameters by name, db.db_funcs.HOT_QUERIES
+    :return: query plan of each query
+    """
+    conn = get_connection(db_filepath)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    plans = {}
+    full_scans = []
+    for name, (sql, params) in queries.items():
+        details = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        plans[name] = details
+        # "SCAN service USING INDEX ..." walks a partial index, a bare "SCAN service" reads every row.
+        # Scans of a subquery or of json_each only walk rows already narrowed down or given as parameter
+        if any(detail.startswith('SCAN') and 'USING' not in detail and detail.split()[1] in tables
+               for detail in details):
+            full_scans.append(f'{name}: {"; ".join(details)}')
+    if full_scans:
+        raise RuntimeError('Hot queries fall back to a full table scan:\n' + '\n'.join(full_scans))
+    return plans
+
+
+def main():
+    from db.db_funcs import initialize_db, HOT_QUERIES
+    from settings.config import db_file
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db_filepath', nargs='?', default=db_file)
+    parser.add_argument('--check', action='store_true', help='verify the query plans of the hot queries')
+    args = parser.parse_args()
+
+    initialize_db(args.db_filepath)
+    if args.check:
+        for name, details in check_query_plans(args.db_filepath, HOT_QUERIES).items():
+            print(f'{name}: {"; ".join(details)}')
+
+
+if __name__ == '__main__':
+    main()
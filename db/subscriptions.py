@@ -0,0 +1,142 @@
+"""
+Process-local index of the active services, by chat and by service type.
+
+It is loaded once with db_funcs.load_subscriptions and kept consistent by db_funcs, which writes every service
+change through to it after the transaction commits, so the commands read the subscriptions of a chat without
+touching the db. Until it is loaded the writes are ignored, the load reads them from the db anyway, except
+those committed while the load is reading, which are kept and applied after it.
+
+Only the writes made by this process are seen. With worker processes the bot process still owns every change of
+membership, the workers only move the last_updated watermarks, see db_funcs.reload_chat_subscriptions.
+"""
+import functools
+import sys
+import threading
+from typing import Callable, Iterable
+
+from tgbot.models import TService
+
+# id_chat -> id_type -> optional_url -> service
+_chats: dict[str, dict[int, dict[str, TService]]] = {}
+_loaded = False
+# Writes seen while a load reads the db, applied on top of what it read, None when no load is running
+_pending: list[Callable[[], None]] | None = None
+# Writes come from the db threads, reads from the event loop
+_lock = threading.Lock()
+
+
+def loaded() -> bool:
+    return _loaded
+
+
+def _add(chats: dict, row: tuple) -> None:
+    service = TService(row)
+    # Thousands of chats follow the same few mangas and feeds, they share one copy of each string
+    service.id_chat = sys.intern(str(service.id_chat))
+    service.optional_url = sys.intern(service.optional_url or '')
+    chats.setdefault(service.id_chat, {}).setdefault(service.id_type, {})[service.optional_url] = service
+
+
+def _set(id_chat: str, id_type: int, active: int, last_updated, optional_url: str, service_id=None) -> None:
+    types = _chats.get(id_chat)
+    services = types.get(id_type) if types else None
+    service = services.get(optional_url or '') if services else None
+    if not active:
+        if service is not None:
+            del services[service.optional_url]
+            if not services:
+                del types[id_type]
+            if not types:
+                del _chats[id_chat]
+    elif service is not None:
+        service.last_updated = last_updated
+    else:
+        # Rows written by a batch don't return their id, nothing reads it from the index
+        _add(_chats, (service_id, id_chat, id_type, active, last_updated, optional_url))
+
+
+def _apply(write: Callable[[], None]) -> None:
+    """Runs a write on the index and keeps it for the load in progress, called with the lock held"""
+    if _pending is not None:
+        _pending.append(write)
+    if _loaded:
+        write()
+
+
+def load(rows: Iterable[tuple]) -> int:
+    """
+    Replaces the index with the given service rows, returns how many were loaded.
+    The rows are read without the lock, so the commands keep reading the index meanwhile, and the writes
+    committed while they are read are applied again once the new index is in place.
+    """
+    global _chats, _loaded, _pending
+    with _lock:
+        _pending = []
+    chats = {}
+    count = 0
+    try:
+        for row in rows:
+            _add(chats, row)
+            count += 1
+    except BaseException:
+        with _lock:
+            _pending = None
+        raise
+    with _lock:
+        _chats = chats
+        for write in _pending:
+            write()
+        _pending = None
+        _loaded = True
+    return count
+
+
+def _reload_chat(id_chat: str, rows: list[tuple]) -> None:
+    _chats.pop(id_chat, None)
+    for row in rows:
+        _add(_chats, row)
+
+
+def reload_chat(id_chat: str, rows: Iterable[tuple]) -> None:
+    """Replaces the services of a chat with the given rows"""
+    rows = list(rows)
+    with _lock:
+        _apply(functools.partial(_reload_chat, str(id_chat), rows))
+
+
+def upsert(id_chat: str, id_type: int, active: int, last_updated, optional_url: str = '', service_id=None) -> None:
+    """Applies a committed service upsert, an inactive service leaves the index"""
+    with _lock:
+        _apply(functools.partial(_set, str(id_chat), id_type, active, last_updated, optional_url, service_id))
+
+
+def upsert_many(rows: Iterable[tuple]) -> None:
+    """Applies committed (id_chat, id_type, active, last_updated, optional_url) upserts"""
+    rows = [(str(id_chat), *rest) for id_chat, *rest in rows]
+
+    def write():
+        for row in rows:
+            _set(*row)
+
+    with _lock:
+        _apply(write)
+
+
+def remove(id_chat: str, id_type: int, optional_url: str = '') -> None:
+    upsert(id_chat, id_type, 0, None, optional_url)
+
+
+def services(id_chat: str, id_type: int = None) -> list[TService]:
+    """Active services of a chat, only those of a type if given"""
+    with _lock:
+        types = _chats.get(str(id_chat))
+        if not types:
+            return []
+        if id_type is not None:
+            return list(types.get(id_type, {}).values())
+        return [service for by_url in types.values() for service in by_url.values()]
+
+
+def count() -> int:
+    with _lock:
+        return sum(len(by_url) for types in _chats.values() for by_url in types.values())
@@ -1,7 +1,8 @@
 import logging
 from tgbot.bot import main
+from tgbot.workers import start_workers, stop_workers
 from logging import config as logging_config
-from settings.config import log_config, PRODUCTION, db_file
+from settings.config import log_config, PRODUCTION, db_file, WORKER_PROCESSES
 from db.db_funcs import initialize_db, add_or_upd_chat
 
 logging_config.dictConfig(log_config)
@@ -13,4 +14,10 @@ if __name__ == '__main__':
 
     initialize_db(db_file)
 
-    main()
+    # The scheduled slots run in the workers, this process only answers commands
+    if WORKER_PROCESSES:
+        start_workers()
+    try:
+        main()
+    finally:
+        stop_workers()
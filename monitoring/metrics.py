@@ -0,0 +1,232 @@
+"""
+Process metrics rendered in the Prometheus text format and served on a local HTTP endpoint.
+Counters, gauges and histograms live in memory and are rendered on every scrape, no client library is needed.
+
+    curl http://127.0.0.1:9108/metrics
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from settings.config import METRICS_HOST, METRICS_PORT, METRICS_LOOP_LAG_INTERVAL
+
+logger = logging.getLogger()
+
+# Seconds, from a cached lookup up to a MangaDex poll paced by the rate limiter
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+REGISTRY: list['Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        # Observations come from the event loop and from the db threads
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_str(self, key: tuple[str, ...], extra: tuple[tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self.values.items())
+        return [f'{self.name}{self._label_str(key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Metric):
+    """Gauge set directly, or for an unlabelled one read from a function on every scrape"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple[str, ...], float] = {} if labels else {(): 0.0}
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def set_function(self, function) -> None:
+        self._function = function
+
+    def samples(self) -> list[str]:
+        if self._function:
+            return [f'{self.name} {_format_value(self._function())}']
+        with self._lock:
+            values = list(self.values.items())
+        return [f'{self.name}{self._label_str(key)} {_format_value(value)}' for key, value in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per label set: count of each bucket (not cumulative), sum and count
+        self.series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+        lines = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                label_str = self._label_str(key, (('le', _format_value(bound)),))
+                lines.append(f'{self.name}_bucket{label_str} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_str(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{self._label_str(key)} {count}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+# Hot paths
+handler_duration = Histogram('tgbot_handler_duration_seconds', 'Time spent answering a command',
+                             ('handler', 'outcome'))
+upstream_duration = Histogram('tgbot_upstream_request_duration_seconds',
+                              'Duration of each upstream request, by api call and response status',
+                              ('call', 'status'))
+db_duration = Histogram('tgbot_db_query_duration_seconds', 'Duration of each db_ops transaction', ('query',))
+job_start_lag = Histogram('tgbot_job_start_lag_seconds', 'Delay between the scheduled time of a slot and its start',
+                          ('slot',))
+upstream_retries = Counter('tgbot_upstream_retries_total', 'Upstream requests retried after a failed attempt',
+                           ('call',))
+breaker_state = Gauge('tgbot_upstream_breaker_state', 'Circuit breaker of each upstream host, 0 closed, '
+                      '1 half open, 2 open', ('upstream',))
+send_queue_depth = Gauge('tgbot_send_queue_depth', 'Messages queued or being delivered')
+event_loop_lag = Histogram('tgbot_event_loop_lag_seconds', 'How late the event loop wakes up a sleeping task',
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+def timed_handler(name: str, callback):
+    """Wraps a handler callback so its latency is recorded under `name`"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await callback(update, context)
+        except Exception as _:
+            outcome = 'error'
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - start, handler=name, outcome=outcome)
+
+    return wrapper
+
+
+# Endpoint
+_server: asyncio.AbstractServer | None = None
+_lag_task: asyncio.Task | None = None
+
+
+async def _watch_loop_lag() -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(METRICS_LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(max(0.0, time.perf_counter() - start - METRICS_LOOP_LAG_INTERVAL))
+
+
+async def _scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+    """Serves /metrics and starts sampling the event loop lag, a port of 0 disables the endpoint"""
+    global _server, _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(_watch_loop_lag(), name='metrics-loop-lag')
+    if port and _server is None:
+        _server = await asyncio.start_server(_scrape, host, port)
+        logger.info(f'Metrics served on http://{host}:{port}/metrics')
+
+
+async def stop_server() -> None:
+    global _server, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        await asyncio.gather(_lag_task, return_exceptions=True)
+        _lag_task = None
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
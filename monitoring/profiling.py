@@ -0,0 +1,167 @@
+"""
+Opt-in profiling of the next runs of a scheduled producer (dex_updates, blog_update, ...) or of a command.
+
+A target is armed for a number of runs, from PROFILE_TARGETS at startup or with the admin /profile command.
+Each armed run is executed under cProfile and leaves two files in VOLUME_PATH/profiles:
+<target>-<time>.prof, to open with pstats or snakeviz, and <target>-<time>.json with the time spent in
+each phase (fetch, parse, db, send) and in total.
+
+While nothing is armed a run costs a dict lookup and every phase a context variable lookup.
+cProfile sees the whole thread, so whatever the event loop runs meanwhile also shows in the profile.
+"""
+import cProfile
+import functools
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from settings.config import VOLUME_PATH, PROFILE_TARGETS, PROFILE_RUNS
+
+logger = logging.getLogger()
+
+PROFILES_DIR = VOLUME_PATH + 'profiles'
+PHASES = ('fetch', 'parse', 'db', 'send')
+
+# Runs left per target, empty unless something is armed
+_remaining: dict[str, int] = {}
+_current_run: ContextVar['Run | None'] = ContextVar('profiling_run', default=None)
+_current_phase: ContextVar['_Phase | None'] = ContextVar('profiling_phase', default=None)
+# Only one cProfile can be enabled at a time, concurrent runs only get their timings
+_profiler_busy = False
+
+
+class Run:
+    """A profiled run, phases add up their exclusive time, summed over the concurrent tasks of the run"""
+
+    def __init__(self, target: str):
+        self.target = target
+        self.started_at = datetime.now()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.wall = 0.0
+        self.profiler: cProfile.Profile | None = None
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self) -> None:
+        """Writes the profile and the timing breakdown of the run"""
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        base = os.path.join(PROFILES_DIR, f"{self.target}-{self.started_at.strftime('%Y%m%d-%H%M%S-%f')}")
+        if self.profiler:
+            self.profiler.dump_stats(base + '.prof')
+        timings = {'target': self.target, 'started_at': self.started_at.isoformat(timespec='seconds'),
+                   'wall_s': round(self.wall, 4), 'profiled': self.profiler is not None,
+                   'phases_s': {phase: round(seconds, 4) for phase, seconds in self.phases.items()}}
+        with open(base + '.json', 'w') as f:
+            json.dump(timings, f, indent=2)
+        breakdown = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.phases.items())
+        logger.info(f'Profiled {self.target} in {self.wall:.2f}s ({breakdown}), saved to {base}')
+
+
+class _Phase:
+    def __init__(self, run: Run, name: str):
+        self.run = run
+        self.name = name
+        self.child_time = 0.0
+
+    def __enter__(self):
+        self.parent = _current_phase.get()
+        self.token = _current_phase.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        elapsed = time.perf_counter() - self.start
+        _current_phase.reset(self.token)
+        # Nested phases are exclusive, e.g. parsing while a feed streams in is not counted as fetch
+        self.run.add(self.name, elapsed - self.child_time)
+        if self.parent is not None:
+            self.parent.child_time += elapsed
+
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return None
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name: str):
+    """Times a block as one of PHASES of the current run, does nothing outside a profiled run"""
+    run = _current_run.get()
+    if run is None:
+        return _NO_PHASE
+    return _Phase(run, name)
+
+
+def arm(target: str, runs: int = 1) -> None:
+    """Profile the next `runs` runs of the target"""
+    if runs > 0:
+        _remaining[target] = runs
+    else:
+        _remaining.pop(target, None)
+
+
+def armed() -> dict[str, int]:
+    return dict(_remaining)
+
+
+def take(target: str) -> Run | None:
+    """A new run if the target is armed, counting it against the runs left"""
+    if not _remaining or target not in _remaining:
+        return None
+    _remaining[target] -= 1
+    if _remaining[target] <= 0:
+        del _remaining[target]
+    return Run(target)
+
+
+async def measure(run: Run | None, awaitable):
+    """Awaits under the run's profiler and phases, or just awaits when there is no run"""
+    global _profiler_busy
+    if run is None:
+        return await awaitable
+    token = _current_run.set(run)
+    if not _profiler_busy:
+        _profiler_busy = True
+        run.profiler = cProfile.Profile()
+        run.profiler.enable()
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        run.wall += time.perf_counter() - start
+        if run.profiler:
+            run.profiler.disable()
+            _profiler_busy = False
+        _current_run.reset(token)
+
+
+def profiled(target: str, callback):
+    """Wraps a handler callback so its armed runs are profiled"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        run = take(target)
+        if run is None:
+            return await callback(update, context)
+        try:
+            return await measure(run, callback(update, context))
+        finally:
+            run.finish()
+
+    return wrapper
+
+
+def arm_from_config() -> None:
+    for target in PROFILE_TARGETS:
+        arm(target, PROFILE_RUNS)
+    if _remaining:
+        logger.info(f'Profiling armed for {", ".join(f"{t} x{n}" for t, n in _remaining.items())}')
@@ -9,6 +9,132 @@ PRODUCTION = os.getenv('PRODUCTION') == 'True'
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 WEATHER_KEY = os.getenv('WEATHER_KEY')
 FEED_URL = os.getenv('FEED_URL')
+# Upstream base urls, pointed at local stand-ins by the benchmarks
+OWM_BASE_URL = os.getenv('OWM_BASE_URL', 'https://api.openweathermap.org')
+DEX_BASE_URL = os.getenv('DEX_BASE_URL', 'https://api.mangadex.org')
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
+# How updates reach the bot, 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Webhook server, WEBHOOK_URL is the public url registered with Telegram, left empty when set up elsewhere.
+# Listens on localhost behind a reverse proxy, set WEBHOOK_LISTEN=0.0.0.0 to take Telegram's requests directly
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Required unless the bot registers WEBHOOK_URL itself, then a random one is generated on each start
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
+# Seconds a client has to send a whole request, a keep-alive connection idle for as long is closed
+WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', 10))
+# Updates waiting to be processed, past it Telegram is told to retry later
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+# Updates processed at the same time
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 32))
+# Seconds a fetched forecast is served to every chat before asking OWM again
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', 3600))
+# Chats within the same grid cell (0.1 degrees is about 11km) share a forecast
+WEATHER_GRID_DEGREES = float(os.getenv('WEATHER_GRID_DEGREES', 0.1))
+# Grid cells whose forecast is kept, the least recently used are dropped first
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', 10000))
+# OWM requests a slot may make, cells past it get their last forecast or nothing
+WEATHER_MAX_CALLS_PER_SLOT = int(os.getenv('WEATHER_MAX_CALLS_PER_SLOT', 1000))
+
+# Slot times are local to each chat, chats without a timezone use this one
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'America/Lima')
+
+# Each slot is a dispatch window, chats are spread over it in waves by a hash of their id (0 sends at once)
+DISPATCH_WINDOW = int(os.getenv('DISPATCH_WINDOW', 15 * 60))
+DISPATCH_STEP = int(os.getenv('DISPATCH_STEP', 60))
+# Random delay added to the start of each wave, seconds
+DISPATCH_JITTER = float(os.getenv('DISPATCH_JITTER', 10))
+# Seconds between the looks for digests whose wave is due, they wait in the outbox table until then
+DISPATCH_TICK = float(os.getenv('DISPATCH_TICK', 1))
+# Seconds a feed or manga poll is reused by the slots of the other timezones that run at the same time
+SLOT_SHARE_TTL = float(os.getenv('SLOT_SHARE_TTL', 60))
+
+# Outbound Telegram queue, the Bot API allows ~30 messages/s overall and about one per second per chat
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 30))
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', 1))
+TG_SEND_WORKERS = int(os.getenv('TG_SEND_WORKERS', 20))
+TG_SEND_RETRIES = int(os.getenv('TG_SEND_RETRIES', 5))
+# Connections kept open to the Bot API, the send workers and the update handlers share them
+TG_POOL_SIZE = int(os.getenv('TG_POOL_SIZE', 256))
+
+# Worker processes running the scheduled slots, each for its shard of the chats, 0 runs them in the bot process
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))
+# Seconds between the workers' scans for timezones added since they started
+WORKER_REFRESH_INTERVAL = int(os.getenv('WORKER_REFRESH_INTERVAL', 600))
+# Seconds after which a slot claimed by a worker that never finished it is run again by its shard's worker
+SLOT_CLAIM_TIMEOUT = int(os.getenv('SLOT_CLAIM_TIMEOUT', 2 * 60 * 60))
+
+# SQLite tuning, connections are kept open for the whole life of the process
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 64 * 1024 * 1024))
+DB_CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', 256))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+DB_THREADS = int(os.getenv('DB_THREADS', 2))
+
+# Shared HTTP client pool
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 20))
+HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+# Seconds a request waits for a connection of the pool, a wait that runs out is not the upstream's failure
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', 60))
+
+# Upstream deadlines in seconds, to connect and between two reads of the response
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+OWM_READ_TIMEOUT = float(os.getenv('OWM_READ_TIMEOUT', 10))
+RSS_READ_TIMEOUT = float(os.getenv('RSS_READ_TIMEOUT', 15))
+# Feeds a poll fetches at once, below HTTP_MAX_CONNECTIONS so the others keep a share of the pool
+RSS_CONCURRENCY = int(os.getenv('RSS_CONCURRENCY', 50))
+DEX_READ_TIMEOUT = float(os.getenv('DEX_READ_TIMEOUT', 20))
+# Retries of a timed out or 5xx request, after a random delay of up to HTTP_RETRY_BACKOFF * 2^retry seconds
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+# Failed attempts in a row that open the breaker of an upstream host, and seconds before it lets a trial through
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', 60))
+# Chats of a slot whose upstream is down are served later, up to this many hours after the slot
+BREAKER_DEFER_HOURS = float(os.getenv('BREAKER_DEFER_HOURS', 6))
+
+# MangaDex allows around 5 requests per second per client
+DEX_RATE_LIMIT = float(os.getenv('DEX_RATE_LIMIT', 4))
+DEX_RATE_BURST = int(os.getenv('DEX_RATE_BURST', 4))
+# Mangas packed in each chapter query of the nightly poll
+DEX_IDS_PER_REQUEST = int(os.getenv('DEX_IDS_PER_REQUEST', 100))
+# Watermarks older than this are polled one manga at a time, with the latest chapters only
+DEX_BATCH_MAX_AGE_DAYS = int(os.getenv('DEX_BATCH_MAX_AGE_DAYS', 30))
+
+# Mangas are polled on their own cadence, estimated from their release history, instead of once a day in the
+# night slot, which still sends the chapters found. DEX_POLL_TICK seconds between looks for the mangas due,
+# DEX_POLL_BUDGET MangaDex requests a day at most
+DEX_ADAPTIVE_POLLING = os.getenv('DEX_ADAPTIVE_POLLING', '1') == '1'
+DEX_POLL_TICK = int(os.getenv('DEX_POLL_TICK', 15 * 60))
+DEX_POLL_BUDGET = int(os.getenv('DEX_POLL_BUDGET', 5000))
+# Seconds between two polls of a manga, and for mangas without a release history yet
+DEX_POLL_MIN_INTERVAL = int(os.getenv('DEX_POLL_MIN_INTERVAL', 60 * 60))
+DEX_POLL_MAX_INTERVAL = int(os.getenv('DEX_POLL_MAX_INTERVAL', 7 * 24 * 60 * 60))
+DEX_POLL_DEFAULT_INTERVAL = int(os.getenv('DEX_POLL_DEFAULT_INTERVAL', 24 * 60 * 60))
+
+# Manga titles and status are fetched again after this many days, at most DEX_METADATA_CACHE_SIZE are kept
+DEX_METADATA_TTL_DAYS = int(os.getenv('DEX_METADATA_TTL_DAYS', 7))
+DEX_METADATA_CACHE_SIZE = int(os.getenv('DEX_METADATA_CACHE_SIZE', 20000))
+
+# Prometheus endpoint, local only by default, a port of 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# Seconds between event loop lag samples
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv('METRICS_LOOP_LAG_INTERVAL', 0.5))
+
+# Chats allowed to use the admin commands, comma separated ids
+ADMIN_CHAT_IDS = {chat_id.strip() for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()}
+# Producers or commands profiled from startup, comma separated (e.g. dex_updates,blog_update,getw)
+PROFILE_TARGETS = [target.strip() for target in os.getenv('PROFILE_TARGETS', '').split(',') if target.strip()]
+PROFILE_RUNS = int(os.getenv('PROFILE_RUNS', 1))
+# Profiling hooks are only installed when enabled, on by default when there are PROFILE_TARGETS
+PROFILING = os.getenv('PROFILING', '1' if PROFILE_TARGETS else '0') == '1'
 
 
 
@@ -17,7 +143,8 @@ if PRODUCTION:
 else:
     VOLUME_PATH = ''
 
-logging_file = VOLUME_PATH + 'app.log'
+# The tests and the benchmarks log to the temp dir instead, see their package __init__
+logging_file = os.getenv('LOG_FILE', VOLUME_PATH + 'app.log')
 db_file = VOLUME_PATH + 'db.sqlite3'
 
 # Nice guide to logging config with dictionary
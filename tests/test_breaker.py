@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+from tgbot import breaker
+from tgbot.breaker import CircuitBreaker, CircuitOpen, CLOSED, HALF_OPEN, OPEN
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch.object(breaker.time, 'monotonic', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.breaker = CircuitBreaker('upstream.test', failures=3, reset=60)
+
+    def fail(self, times: int) -> None:
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_failures_in_a_row(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.check()
+        self.assertEqual(self.breaker.retry_in(), 60)
+
+    def test_a_single_trial_after_the_reset(self):
+        self.fail(3)
+        self.now += 60
+        self.breaker.check()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # The others keep failing fast while the trial is out
+        with self.assertRaises(CircuitOpen):
+            self.breaker.check()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.check()
+
+    def test_a_failed_trial_opens_it_again(self):
+        self.fail(3)
+        self.now += 60
+        self.breaker.check()
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.retry_in(), 60)
+
+    def test_a_trial_that_never_reports_back_expires(self):
+        self.fail(3)
+        self.now += 60
+        self.breaker.check()
+        self.now += 60
+        self.breaker.check()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+    def test_one_breaker_per_host(self):
+        host = 'down.test'
+        self.addCleanup(breaker._breakers.pop, host, None)
+        self.assertFalse(breaker.is_down(host))
+        for _ in range(breaker.breaker_for(host).failures):
+            breaker.breaker_for(host).record_failure()
+        self.assertTrue(breaker.is_down(host))
+        self.assertFalse(breaker.is_down('up.test'))
+        self.assertGreater(breaker.retry_in(host), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
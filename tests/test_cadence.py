@@ -0,0 +1,60 @@
+import unittest
+from datetime import datetime, timedelta
+
+from settings.config import DEX_POLL_MIN_INTERVAL, DEX_POLL_MAX_INTERVAL, DEX_POLL_DEFAULT_INTERVAL
+from tgbot import cadence
+
+NOW = datetime(2026, 6, 1, 12)
+WEEK = timedelta(days=7)
+
+
+def weekly(last: datetime, count: int = 6) -> list[datetime]:
+    """Publish times of a weekly series whose latest release was at `last`"""
+    return [last - WEEK * i for i in range(count)]
+
+
+class NextPollTest(unittest.TestCase):
+
+    def test_unknown_history_uses_the_default_interval(self):
+        next_at, interval = cadence.next_poll([], NOW)
+        self.assertEqual(next_at, NOW + timedelta(seconds=DEX_POLL_DEFAULT_INTERVAL))
+        self.assertIsNone(interval)
+
+    def test_chapters_released_together_are_one_release(self):
+        publish_times = weekly(NOW - timedelta(days=1)) + [NOW - timedelta(days=1, hours=2)]
+        self.assertEqual(len(cadence.releases(publish_times)), 6)
+        self.assertEqual(cadence.next_poll(publish_times, NOW)[1], WEEK)
+
+    def test_waits_for_the_window_before_the_expected_release(self):
+        last = NOW - timedelta(days=1)
+        next_at, interval = cadence.next_poll(weekly(last), NOW)
+        self.assertEqual(interval, WEEK)
+        self.assertEqual(next_at, last + WEEK - WEEK * cadence.WINDOW_BEFORE)
+
+    def test_polls_often_inside_the_window(self):
+        # Due today, the window spans from a day before to a couple of days after
+        next_at, _ = cadence.next_poll(weekly(NOW - WEEK), NOW)
+        self.assertEqual(next_at, NOW + WEEK * cadence.WINDOW_STEP)
+
+    def test_backs_off_when_overdue(self):
+        since_last = timedelta(days=14)
+        next_at, _ = cadence.next_poll(weekly(NOW - since_last), NOW)
+        self.assertEqual(next_at, NOW + since_last / 4)
+        # The longer the series stays quiet, the rarer the polls
+        later_at, _ = cadence.next_poll(weekly(NOW - since_last * 2), NOW)
+        self.assertGreater(later_at - NOW, next_at - NOW)
+
+    def test_dormant_series_are_polled_at_the_max_interval(self):
+        next_at, _ = cadence.next_poll(weekly(NOW - timedelta(days=365)), NOW)
+        self.assertEqual(next_at, NOW + timedelta(seconds=DEX_POLL_MAX_INTERVAL))
+
+    def test_frequent_series_are_polled_at_the_min_interval(self):
+        # Due now, inside the window a step would be under an hour
+        daily = [NOW - timedelta(days=i) for i in range(1, 7)]
+        next_at, interval = cadence.next_poll(daily, NOW)
+        self.assertEqual(interval, timedelta(days=1))
+        self.assertEqual(next_at, NOW + timedelta(seconds=DEX_POLL_MIN_INTERVAL))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import httpx
+
+import db.db_funcs as dbf
+from settings.config import ServiceType, IsActive
+from tgbot import bot, my_apis
+from tgbot.models import TService
+
+MANGA = 'manga-1'
+
+
+def chapter(publish_at: datetime) -> dict:
+    return {'id': f'chapter-{publish_at:%H%M}',
+            'attributes': {'chapter': '10', 'title': 'Chapter 10', 'translatedLanguage': 'en',
+                           'publishAt': publish_at.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+            'relationships': [{'type': 'manga', 'id': MANGA}]}
+
+
+class ManualPollTest(unittest.TestCase):
+    """A chat checking its mangas by hand does not move the schedule of the other chats following them"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_filepath = os.path.join(self.tmp.name, 'db.sqlite3')
+        dbf.initialize_db(self.db_filepath)
+        self.watermark = datetime.utcnow() - timedelta(days=2)
+        for chat_id in ('1', '2'):
+            dbf.add_or_upd_chat(self.db_filepath, chat_id, IsActive.YES)
+            dbf.add_or_upd_service(self.db_filepath, chat_id, ServiceType.DEX.value, IsActive.YES,
+                                   optional_url=MANGA, last_updated=self.watermark)
+        self.chapters = {'result': 'ok', 'data': [chapter(datetime.utcnow() - timedelta(hours=1))], 'total': 1}
+        patches = [mock.patch.object(my_apis, 'db_file', self.db_filepath),
+                   mock.patch.object(my_apis, 'fetch_chapters', mock.AsyncMock(return_value=self.chapters)),
+                   mock.patch.object(my_apis, 'manga_metadata', mock.AsyncMock(return_value={}))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        my_apis._slot_polls.clear()
+
+    def tearDown(self):
+        dbf.close_connections()
+        self.tmp.cleanup()
+
+    def services(self, chat_id: str = None) -> list[TService]:
+        rows = dbf.get_dex_services(self.db_filepath, [MANGA])
+        return [TService(row) for row in rows if chat_id is None or row[1] == chat_id]
+
+    def due(self) -> list[str]:
+        return dbf.get_due_mangas(self.db_filepath, datetime.utcnow(), 10)
+
+    def test_manual_poll_leaves_the_manga_due_for_the_other_chats(self):
+        messages = asyncio.run(my_apis.poll_mangadex(self.services('1')))
+        self.assertEqual(list(messages), ['1'])
+        self.assertEqual(self.due(), [MANGA])
+
+        my_apis._slot_polls.clear()
+        messages = asyncio.run(my_apis.poll_mangadex(self.services(), schedule=True))
+        # The chat that polled by hand has seen the chapter already
+        self.assertEqual(list(messages), ['2'])
+        self.assertEqual(self.due(), [])
+
+    def test_chapters_found_between_slots_wait_for_the_chat_slot(self):
+        with mock.patch.object(bot, 'db_file', self.db_filepath):
+            messages = asyncio.run(my_apis.poll_mangadex(self.services(), schedule=True))
+            dbf.hold_notifications(self.db_filepath, ServiceType.DEX.value,
+                                   [(chat_id, text) for chat_id, texts in messages.items() for text in texts])
+            # Only the chats of the slot take theirs, once
+            held = asyncio.run(bot.held_dex_updates(self.services('1')))
+            self.assertEqual(held, {'1': messages['1']})
+            self.assertEqual(asyncio.run(bot.held_dex_updates(self.services('1'))), {})
+            self.assertEqual(asyncio.run(bot.held_dex_updates(self.services())), {'2': messages['2']})
+
+    def test_one_failed_manga_leaves_the_others_notified(self):
+        dbf.add_or_upd_service(self.db_filepath, '1', ServiceType.DEX.value, IsActive.YES,
+                               optional_url='manga-2', last_updated=self.watermark)
+
+        async def fetch_chapters(manga_ids, since):
+            if 'manga-2' in manga_ids:
+                raise httpx.ConnectError('Connection refused')
+            return self.chapters
+
+        services = [TService(row) for row in dbf.get_dex_services(self.db_filepath, [MANGA, 'manga-2'])]
+        failed = []
+        with mock.patch.object(my_apis, 'DEX_IDS_PER_REQUEST', 1), \
+                mock.patch.object(my_apis, 'fetch_chapters', fetch_chapters):
+            messages = asyncio.run(my_apis.poll_mangadex(services, failed))
+        self.assertEqual(sorted(messages), ['1', '2'])
+        self.assertEqual([service.optional_url for service in failed], ['manga-2'])
+        # Only the manga that failed keeps its watermark
+        watermarks = {row[5]: row[4] for row in dbf.get_dex_services(self.db_filepath, [MANGA, 'manga-2'])}
+        self.assertGreater(watermarks[MANGA], self.watermark)
+        self.assertEqual(watermarks['manga-2'], self.watermark)
+
+
+class UtcTest(unittest.TestCase):
+    """Chapter times, watermarks and the cutoffs they are compared with are all UTC, whatever the local time"""
+
+    def setUp(self):
+        # Local time 14 hours ahead of UTC
+        patch = mock.patch.dict(os.environ, {'TZ': 'Etc/GMT-14'})
+        patch.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(patch.stop)
+        time.tzset()
+
+    def test_publish_times_in_utc(self):
+        self.assertEqual(my_apis.chapter_date(chapter(datetime(2024, 5, 1, 10, 0))), datetime(2024, 5, 1, 10, 0))
+        offset = {'attributes': {'publishAt': '2024-05-01T12:00:00+02:00'}}
+        self.assertEqual(my_apis.chapter_date(offset), datetime(2024, 5, 1, 10, 0))
+
+    def test_recent_watermarks_are_packed(self):
+        # Newer than the cutoff in UTC, older than it in local time
+        since = datetime.utcnow() - timedelta(days=my_apis.DEX_BATCH_MAX_AGE_DAYS, hours=-7)
+        services = [TService((i, '1', ServiceType.DEX.value, 1, since, f'manga-{i}')) for i in range(2)]
+        self.assertEqual(my_apis.within_budget(['manga-0', 'manga-1'], services, 1), ['manga-0', 'manga-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from tgbot.digest import render_digest, build_digests, TELEGRAM_MAX_LENGTH, _split_section
+
+
+class RenderDigestTest(unittest.TestCase):
+
+    def test_sections_share_one_message(self):
+        self.assertEqual(render_digest(['weather\n', '', 'news']), ['weather\n\nnews'])
+
+    def test_splits_between_sections_first(self):
+        first, second = 'a' * 3000, 'b' * 2000
+        self.assertEqual(render_digest([first, second]), [first, second])
+
+    def test_a_long_section_is_split_between_lines(self):
+        lines = [f'{i:04d} ' + 'x' * 95 for i in range(100)]
+        messages = render_digest(['intro', '\n'.join(lines)])
+        self.assertTrue(all(len(message) <= TELEGRAM_MAX_LENGTH for message in messages))
+        self.assertEqual(messages[0], 'intro')
+        # No line is cut
+        self.assertEqual([line for message in messages[1:] for line in message.split('\n')], lines)
+
+    def test_a_line_longer_than_a_message_is_cut(self):
+        self.assertEqual(_split_section('ab\n' + 'c' * 25 + '\nd', 10), ['ab', 'c' * 10, 'c' * 10, 'ccccc\nd'])
+
+
+class BuildDigestsTest(unittest.TestCase):
+
+    def test_one_digest_per_chat_in_service_order(self):
+        weather = {'1': ['sunny'], '2': ['rain']}
+        news = {'1': ['headline', 'another']}
+        self.assertEqual(build_digests([weather, news]), {'1': ['sunny\n\nheadline\n\nanother'], '2': ['rain']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import tempfile
+import unittest
+
+import db.db_funcs as dbf
+from db.migrations import check_query_plans
+
+
+class QueryPlanTest(unittest.TestCase):
+    """The hot queries run as db_funcs builds them, on a freshly migrated database"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_filepath = os.path.join(self.tmp.name, 'db.sqlite3')
+        dbf.initialize_db(self.db_filepath)
+
+    def tearDown(self):
+        dbf.close_connections()
+        self.tmp.cleanup()
+
+    def test_hot_queries_use_indexes(self):
+        plans = check_query_plans(self.db_filepath, dbf.HOT_QUERIES)
+        self.assertEqual(set(plans), set(dbf.HOT_QUERIES))
+
+    def test_full_scan_is_reported(self):
+        with self.assertRaises(RuntimeError):
+            check_query_plans(self.db_filepath, {'scan': ("SELECT * FROM service WHERE optional_url=?", ('0',))})
+
+
+if __name__ == '__main__':
+    unittest.main()
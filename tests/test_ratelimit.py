@@ -0,0 +1,62 @@
+import asyncio
+import time
+import unittest
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+from tgbot.ratelimit import TokenBucket, parse_retry_after
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_up_to_the_capacity_then_the_rate(self):
+        bucket = TokenBucket('test', rate=10, capacity=3)
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+        wait = bucket.try_acquire()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+    def test_acquire_waits_for_a_token(self):
+        bucket = TokenBucket('test', rate=20)
+
+        async def take(count: int) -> float:
+            start = time.monotonic()
+            for _ in range(count):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        # The first token is there, the other four come 50ms apart
+        self.assertGreaterEqual(asyncio.run(take(5)), 0.19)
+
+    def test_pause_holds_every_caller_and_drops_the_burst(self):
+        bucket = TokenBucket('test', rate=100, capacity=10)
+        bucket.pause(5)
+        self.assertGreater(bucket.try_acquire(), 4.9)
+        self.assertLess(bucket.tokens, 1)
+
+    def test_retry_after_header_pauses(self):
+        bucket = TokenBucket('test', rate=100)
+        bucket.update_from_headers({'Retry-After': '3'})
+        self.assertGreater(bucket.try_acquire(), 2.9)
+
+    def test_exhausted_window_pauses_until_the_reset(self):
+        bucket = TokenBucket('test', rate=100)
+        reset_at = str(int(time.time()) + 10)
+        bucket.update_from_headers({'X-RateLimit-Remaining': '0', 'X-RateLimit-Retry-After': reset_at})
+        self.assertGreater(bucket.try_acquire(), 8)
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+
+    def test_seconds_and_http_dates(self):
+        self.assertEqual(parse_retry_after('2.5'), 2.5)
+        later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(later), 30, delta=2)
+
+    def test_missing_or_unreadable(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from datetime import datetime
+
+from tgbot.rss import FeedStream, MalformedFeed, parse_feed, parse_with_feedparser
+
+WATERMARK = datetime(2024, 5, 1, 12, 0)
+
+
+def rss(*items: tuple[str, str]) -> bytes:
+    entries = ''.join(f'<item><title>{title}</title><pubDate>{date}</pubDate></item>' for title, date in items)
+    return f'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed</title>{entries}</channel></rss>'.encode()
+
+
+FEED = rss(('Third', 'Thu, 02 May 2024 10:00:00 GMT'),
+           ('Second', 'Wed, 01 May 2024 15:30:00 +0200'),
+           ('First', 'Wed, 01 May 2024 11:00:00 GMT'),
+           ('Old', 'Tue, 30 Apr 2024 09:00:00 GMT'))
+
+
+class FeedStreamTest(unittest.TestCase):
+
+    def read(self, content: bytes, since: datetime = WATERMARK, limit: int = 10, chunk: int = 7) -> FeedStream:
+        stream = FeedStream(since, limit)
+        for i in range(0, len(content), chunk):
+            stream.feed(content[i:i + chunk])
+        stream.close()
+        return stream
+
+    def test_stops_at_the_watermark(self):
+        stream = self.read(FEED)
+        # Dates keep the wall time of the feed, the offset is dropped
+        self.assertEqual(stream.entries, [(datetime(2024, 5, 2, 10, 0), 'Third'),
+                                          (datetime(2024, 5, 1, 15, 30), 'Second')])
+        self.assertTrue(stream.done)
+        self.assertFalse(stream.complete)
+
+    def test_stops_at_the_limit(self):
+        stream = self.read(FEED, limit=1)
+        self.assertEqual([title for _, title in stream.entries], ['Third'])
+        self.assertTrue(stream.complete)
+
+    def test_reads_to_the_end_when_everything_is_new(self):
+        stream = self.read(FEED, since=datetime(2000, 1, 1))
+        self.assertEqual(len(stream.entries), 4)
+        self.assertTrue(stream.complete)
+
+    def test_atom_entries(self):
+        feed = (b'<feed xmlns="http://www.w3.org/2005/Atom"><entry><title>Atom</title>'
+                b'<updated>2024-05-03T08:00:00Z</updated></entry></feed>')
+        self.assertEqual(self.read(feed).entries, [(datetime(2024, 5, 3, 8, 0), 'Atom')])
+
+    def test_malformed(self):
+        with self.assertRaises(MalformedFeed):
+            self.read(b'<rss><channel><item><title>Broken & unescaped</title></item></channel></rss>')
+        with self.assertRaises(MalformedFeed):
+            self.read(b'<html><body>Not a feed</body></html>')
+
+
+class ParseFeedTest(unittest.TestCase):
+
+    def test_streams_well_formed_feeds(self):
+        self.assertEqual([title for _, title in parse_feed(FEED, WATERMARK, chunk_size=16)], ['Third', 'Second'])
+
+    def test_falls_back_to_feedparser(self):
+        feed = rss(('Fish & chips', 'Thu, 02 May 2024 10:00:00 GMT'), ('Old', 'Tue, 30 Apr 2024 09:00:00 GMT'))
+        expected = [(datetime(2024, 5, 2, 10, 0), 'Fish & chips')]
+        self.assertEqual(parse_with_feedparser(feed, WATERMARK), expected)
+        self.assertEqual(parse_feed(feed, WATERMARK), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
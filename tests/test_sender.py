@@ -0,0 +1,82 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from telegram.error import NetworkError, Forbidden
+
+from tgbot import sender
+from tgbot.sender import SendQueue
+
+
+class FakeBot:
+    """Records what it is asked to send, fails the texts listed in `failures` once each"""
+
+    def __init__(self, failures: dict[str, Exception] = None):
+        self.failures = dict(failures or {})
+        self.calls: list[tuple[str, str, float]] = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        error = self.failures.pop(text, None)
+        if error is not None:
+            raise error
+        self.calls.append((chat_id, text, time.monotonic()))
+
+
+class SendQueueTest(unittest.TestCase):
+
+    def deliver(self, queue: SendQueue, bot: FakeBot, messages: list[tuple[str, str]]) -> None:
+        async def run():
+            queue.start(bot)
+            for chat_id, text in messages:
+                queue.send(chat_id, text)
+            await queue.join()
+            await queue.stop()
+
+        asyncio.run(run())
+
+    def texts(self, bot: FakeBot, chat_id: str) -> list[str]:
+        return [text for chat, text, _ in bot.calls if chat == chat_id]
+
+    def test_each_chat_gets_its_messages_in_order(self):
+        bot = FakeBot()
+        queue = SendQueue(global_rate=1000, chat_rate=1000, workers=4, max_retries=1)
+        messages = [(str(i % 3), f'message {i}') for i in range(30)]
+        self.deliver(queue, bot, messages)
+        for chat_id in ('0', '1', '2'):
+            self.assertEqual(self.texts(bot, chat_id), [text for chat, text in messages if chat == chat_id])
+        self.assertEqual((queue.sent, queue.failed, queue.depth), (30, 0, 0))
+
+    def test_a_retried_message_stays_ahead_of_the_later_ones(self):
+        bot = FakeBot({'first': NetworkError('reset')})
+        queue = SendQueue(global_rate=1000, chat_rate=1000, workers=2, max_retries=1)
+        with mock.patch.object(sender.random, 'random', return_value=0.0):
+            self.deliver(queue, bot, [('1', 'first'), ('1', 'second'), ('2', 'other')])
+        self.assertEqual(self.texts(bot, '1'), ['first', 'second'])
+        # The other chat does not wait for the retry
+        self.assertEqual(bot.calls[0][1], 'other')
+
+    def test_the_chat_rate_spaces_the_messages_of_a_chat(self):
+        bot = FakeBot()
+        queue = SendQueue(global_rate=1000, chat_rate=20, workers=4, max_retries=1)
+        self.deliver(queue, bot, [('1', f'message {i}') for i in range(5)] + [('2', 'other')])
+        times = [at for chat, _, at in bot.calls if chat == '1']
+        self.assertGreaterEqual(times[-1] - times[0], 0.19)
+        self.assertLess(bot.calls[1][2] - bot.calls[0][2], 0.05)
+
+    def test_refused_messages_are_not_retried(self):
+        bot = FakeBot({'blocked': Forbidden('bot was blocked by the user')})
+        queue = SendQueue(global_rate=1000, chat_rate=1000, workers=1, max_retries=3)
+        self.deliver(queue, bot, [('1', 'blocked'), ('1', 'after')])
+        self.assertEqual(self.texts(bot, '1'), ['after'])
+        self.assertEqual((queue.sent, queue.failed), (1, 1))
+
+    def test_join_needs_the_workers(self):
+        queue = SendQueue(global_rate=1000, chat_rate=1000, workers=1, max_retries=0)
+        queue.send('1', 'text')
+        with self.assertRaises(RuntimeError):
+            asyncio.run(queue.join())
+
+
+if __name__ == '__main__':
+    unittest.main()
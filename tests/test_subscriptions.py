@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import db.db_funcs as dbf
+from db import subscriptions
+from settings.config import ServiceType, IsActive
+
+WEATHER, BLOG, DEX = ServiceType.WEATHER.value, ServiceType.BLOG.value, ServiceType.DEX.value
+EARLIER, LATER = datetime(2024, 1, 1), datetime(2024, 2, 1)
+
+
+def urls(chat_id: str, id_type: int = None) -> list[str]:
+    return sorted(service.optional_url for service in subscriptions.services(chat_id, id_type))
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.multiple(subscriptions, _chats={}, _loaded=False, _pending=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_writes_before_the_load_are_ignored(self):
+        subscriptions.upsert('1', WEATHER, 1, EARLIER)
+        self.assertEqual(subscriptions.services('1'), [])
+        self.assertFalse(subscriptions.loaded())
+
+    def test_load_then_write_through(self):
+        rows = [(1, '1', DEX, 1, EARLIER, 'manga-1'), (2, '2', WEATHER, 1, EARLIER, '')]
+        self.assertEqual(subscriptions.load(rows), 2)
+        subscriptions.upsert('1', DEX, 1, EARLIER, 'manga-2')
+        subscriptions.upsert('1', WEATHER, 1, EARLIER)
+        self.assertEqual(urls('1', DEX), ['manga-1', 'manga-2'])
+        self.assertEqual(len(subscriptions.services('1')), 3)
+
+        subscriptions.upsert('1', DEX, 1, LATER, 'manga-1')
+        self.assertEqual([s.last_updated for s in subscriptions.services('1', DEX) if s.optional_url == 'manga-1'],
+                         [LATER])
+
+        subscriptions.remove('1', DEX, 'manga-1')
+        subscriptions.remove('2', WEATHER)
+        self.assertEqual(urls('1', DEX), ['manga-2'])
+        self.assertEqual(subscriptions.services('2'), [])
+        self.assertEqual(subscriptions.count(), 2)
+
+    def test_reload_chat_replaces_its_services(self):
+        subscriptions.load([(1, '1', DEX, 1, EARLIER, 'manga-1'), (2, '2', DEX, 1, EARLIER, 'manga-1')])
+        subscriptions.reload_chat('1', [(1, '1', DEX, 1, LATER, 'manga-1'), (3, '1', BLOG, 1, LATER, '')])
+        self.assertEqual({(s.id_type, s.last_updated) for s in subscriptions.services('1')},
+                         {(DEX, LATER), (BLOG, LATER)})
+        self.assertEqual([s.last_updated for s in subscriptions.services('2')], [EARLIER])
+
+    def test_writes_during_a_load_are_replayed(self):
+        def rows():
+            yield 1, '1', DEX, 1, EARLIER, 'manga-1'
+            # Committed while the load reads, the rows it already read or will read don't have these
+            subscriptions.upsert('1', DEX, 1, LATER, 'manga-1')
+            subscriptions.upsert('2', BLOG, 1, LATER)
+            subscriptions.remove('3', WEATHER)
+            yield 2, '3', WEATHER, 1, EARLIER, ''
+
+        subscriptions.load(rows())
+        self.assertEqual([s.last_updated for s in subscriptions.services('1')], [LATER])
+        self.assertEqual([s.id_type for s in subscriptions.services('2')], [BLOG])
+        self.assertEqual(subscriptions.services('3'), [])
+
+    def test_a_failed_load_keeps_the_index(self):
+        subscriptions.load([(1, '1', DEX, 1, EARLIER, 'manga-1')])
+
+        def rows():
+            yield 2, '2', DEX, 1, EARLIER, 'manga-1'
+            raise OSError('disk I/O error')
+
+        with self.assertRaises(OSError):
+            subscriptions.load(rows())
+        self.assertEqual(urls('1'), ['manga-1'])
+        self.assertEqual(subscriptions.services('2'), [])
+
+
+class ServiceBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_filepath = os.path.join(self.tmp.name, 'db.sqlite3')
+        dbf.initialize_db(self.db_filepath)
+        patch = mock.patch.multiple(subscriptions, _chats={}, _loaded=False, _pending=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        dbf.close_connections()
+        self.tmp.cleanup()
+
+    def test_flush_writes_the_last_write_of_each_service(self):
+        dbf.load_subscriptions(self.db_filepath)
+        batch = dbf.ServiceBatch(self.db_filepath)
+        batch.set_chat('1', IsActive.YES)
+        batch.upsert('1', DEX, IsActive.YES, optional_url='manga-1', last_updated=EARLIER)
+        batch.upsert('1', DEX, IsActive.YES, optional_url='manga-1', last_updated=LATER)
+        batch.upsert('1', DEX, IsActive.YES, optional_url='manga-2', last_updated=EARLIER)
+        batch.upsert('1', WEATHER, IsActive.YES, last_updated=EARLIER)
+        batch.deactivate('1', WEATHER)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(batch.flush(), 4)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.flush(), 0)
+
+        rows = dbf.get_active_services_from_chat(self.db_filepath, '1')
+        self.assertEqual(sorted((row[2], row[5]) for row in rows), [(DEX, 'manga-1'), (DEX, 'manga-2')])
+        self.assertEqual([chat[0] for chat in dbf.get_active_chat_list(self.db_filepath)], ['1'])
+        # Written through to the index as well
+        self.assertEqual(urls('1'), ['manga-1', 'manga-2'])
+        self.assertEqual([s.last_updated for s in subscriptions.services('1') if s.optional_url == 'manga-1'], [LATER])
+
+    def test_flushed_when_the_block_succeeds(self):
+        with dbf.ServiceBatch(self.db_filepath) as batch:
+            batch.upsert('1', BLOG, IsActive.YES)
+        with self.assertRaises(RuntimeError), dbf.ServiceBatch(self.db_filepath) as batch:
+            batch.upsert('2', BLOG, IsActive.YES)
+            raise RuntimeError()
+        self.assertEqual(len(dbf.get_active_services_from_chat(self.db_filepath, '1')), 1)
+        self.assertEqual(dbf.get_active_services_from_chat(self.db_filepath, '2'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
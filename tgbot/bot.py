@@ -1,23 +1,37 @@
 import asyncio
 import datetime
 import logging
+import math
+import random
+import zlib
 from datetime import time
 import db.db_funcs as dbf
+from db import subscriptions
 
 
-from pytz import timezone
+from pytz import timezone, UnknownTimeZoneError
 from telegram import Update
+from telegram.request import HTTPXRequest
 from telegram.ext import CommandHandler, CallbackContext, MessageHandler, Application, ContextTypes, filters
 
-from tgbot.my_apis import get_rss_feed, get_weather, check_manga_exists, get_mangadex
-from tgbot.models import TChat, TService
-from settings.config import TELEGRAM_TOKEN, db_file, ServiceType, IsActive
-
-tz = timezone("America/Lima")
-
-TIME_MORNING = time(6, 1, tzinfo=tz)
-TIME_NOON = time(13, 1, tzinfo=tz)
-TIME_NIGHT = time(18, 30, tzinfo=tz)
+from tgbot.my_apis import poll_rss_feeds, get_weather, check_manga_exists, poll_mangadex, poll_weather, \
+    parse_location, format_location, service_location, DEFAULT_LOCATION, manga_metadata, service_host, \
+    within_budget
+from monitoring import metrics, profiling
+from tgbot import breaker, http_client, webhook
+from tgbot.sender import send_queue, ProfiledRequest
+from tgbot.digest import build_digests, render_digest
+from tgbot.models import TService
+from settings.config import TELEGRAM_TOKEN, TELEGRAM_BASE_URL, FEED_URL, db_file, ServiceType, IsActive, \
+    DEFAULT_TIMEZONE, ADMIN_CHAT_IDS, BOT_MODE, WEBHOOK_QUEUE_SIZE, WEBHOOK_CONCURRENCY, WORKER_PROCESSES, \
+    DISPATCH_WINDOW, DISPATCH_STEP, DISPATCH_JITTER, DISPATCH_TICK, BREAKER_RESET, BREAKER_DEFER_HOURS, \
+    DEX_ADAPTIVE_POLLING, DEX_POLL_TICK, DEX_POLL_BUDGET, DEX_IDS_PER_REQUEST, SLOT_CLAIM_TIMEOUT, \
+    PROFILING, TG_POOL_SIZE
+
+# Local time of each slot, applied in the timezone of every chat
+TIME_MORNING = time(6, 1)
+TIME_NOON = time(13, 1)
+TIME_NIGHT = time(18, 30)
 
 
 MORNING = "MORNING"
@@ -31,33 +45,69 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
+# Commands arriving before the subscription index is loaded wait for a single load
+_subscriptions_load = asyncio.Lock()
+
+
+async def chat_services(chat_id: int, stype: ServiceType = None) -> list[TService]:
+    """Active services of the chat, only those of a type if given, read from the subscription index"""
+    if not subscriptions.loaded():
+        async with _subscriptions_load:
+            if not subscriptions.loaded():
+                await dbf.offload(dbf.load_subscriptions, db_file)
+    return subscriptions.services(str(chat_id), stype.value if stype else None)
+
+
+async def fresh_chat_services(chat_id: int, stype: ServiceType) -> list[TService]:
+    """Like chat_services, for the commands that poll from the watermarks the worker processes move"""
+    if WORKER_PROCESSES and subscriptions.loaded():
+        await dbf.offload(dbf.reload_chat_subscriptions, db_file, str(chat_id))
+    return await chat_services(chat_id, stype)
+
 
 # region Weather
 async def get_my_weather(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-    """Checks for weather update and returns it immediately"""
-    my_text = get_weather()
+    """Checks for weather update at the chat's location and returns it immediately"""
+    chat_id = update.effective_message.chat_id
+    services = await chat_services(chat_id, ServiceType.WEATHER)
+    location = service_location(services[0]) if services else DEFAULT_LOCATION
+    my_text = await get_weather(*location)
     await update.message.reply_text(my_text)
 
 
-async def weather_update(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send the weather update message."""
-    job = context.job
-    my_text = get_weather()
-    await context.bot.send_message(job.chat_id, text=my_text)
+async def weather_update(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """Fetch the forecast once per area and hand it to every weather subscriber of the slot in it."""
+    return await poll_weather(services, failed)
 
 
 async def set_daily_weather_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a job to the queue."""
+    """Subscribe the chat to the morning and noon forecasts, optionally for a location given as lat lon."""
     chat_id = update.effective_message.chat_id
     try:
-        job_removed = set_weather_job(context, chat_id)
+        # Without a location the chat follows the default one, stored as an empty location
+        location = ''
+        if context.args:
+            coordinates = parse_location(' '.join(context.args))
+            if coordinates is None:
+                await update.effective_message.reply_text('Please provide a location as latitude and longitude, '
+                                                          'e.g. /setw 4.62 -74.06')
+                return
+            location = format_location(*coordinates)
+
+        services = await chat_services(chat_id, ServiceType.WEATHER)
 
         text = 'Weather updates successfully set!'
-        if job_removed:
+        if services:
             text += ' Old one was removed.'
 
-        # Persist
-        dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.WEATHER.value, IsActive.YES)
+        # Persist, the previous location is replaced in the same transaction
+        batch = dbf.ServiceBatch(db_file)
+        for service in services:
+            batch.deactivate(chat_id, ServiceType.WEATHER.value, optional_url=service.optional_url,
+                             last_updated=service.last_updated)
+        batch.upsert(chat_id, ServiceType.WEATHER.value, IsActive.YES, optional_url=location)
+        batch.set_chat(chat_id, IsActive.YES)
+        await dbf.offload(batch.flush)
 
         await update.effective_message.reply_text(text)
 
@@ -65,29 +115,19 @@ async def set_daily_weather_job(update: Update, context: ContextTypes.DEFAULT_TY
         await update.effective_message.reply_text('Failed to set a weather update job')
 
 
-def set_weather_job(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
-    job_morning = get_job_name(chat_id, MORNING)
-    job_noon = get_job_name(chat_id, NOON)
-    job_removed = remove_job_if_exists(job_morning, context)
-    job_removed = remove_job_if_exists(job_noon, context)
-    context.job_queue.run_daily(weather_update, time=TIME_MORNING, chat_id=chat_id, name=job_morning)
-    context.job_queue.run_daily(weather_update, time=TIME_NOON, chat_id=chat_id, name=job_noon)
-
-    return job_removed
-
-
-async def unset_weather_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove the job if the user changed their mind."""
+async def unset_weather_job(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    """Unsubscribe the chat if the user changed their mind."""
     chat_id = update.message.chat_id
 
-    job_morning = get_job_name(chat_id, MORNING)
-    job_noon = get_job_name(chat_id, NOON)
-    job_removed = remove_job_if_exists(job_morning, context)
-    job_removed = remove_job_if_exists(job_noon, context)
-    text = 'Weather updates successfully cancelled!' if job_removed else 'You have no active timer.'
+    services = await chat_services(chat_id, ServiceType.WEATHER)
+    text = 'Weather updates successfully cancelled!' if services else 'You have no active timer.'
 
     # Persist
-    dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.WEATHER.value, IsActive.NO)
+    batch = dbf.ServiceBatch(db_file)
+    for service in services:
+        batch.deactivate(chat_id, ServiceType.WEATHER.value, optional_url=service.optional_url,
+                         last_updated=service.last_updated)
+    await dbf.offload(batch.flush)
 
     await update.message.reply_text(text)
 
@@ -97,36 +137,38 @@ async def unset_weather_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # region Blog
 async def get_blog(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Checks for blog update and returns it immediately"""
-    new_posts, my_text = get_rss_feed(update.effective_message.chat_id)
-    if new_posts:
+    chat_id = update.effective_message.chat_id
+    services = await fresh_chat_services(chat_id, ServiceType.BLOG)
+    if not services:
+        await update.message.reply_text('You are not watching any blog.')
+        return
+    messages = await poll_rss_feeds(services)
+    for my_text in render_digest(messages.get(str(chat_id), [])):
         await update.message.reply_text(my_text)
     return
 
 
-async def blog_update(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Check if there is an update on the feed and notifies it."""
-    job = context.job
-    new_posts, my_text = get_rss_feed(job.chat_id)
-    if new_posts:
-        await context.bot.send_message(job.chat_id, text=my_text)
-    return
+async def blog_update(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """Fetch every watched feed once and collect the entries each chat has not seen."""
+    return await poll_rss_feeds(services, failed)
 
 
 async def set_blog_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a job to the queue."""
+    """Add a feed to the chat's watch list, the nightly poll picks it up."""
     chat_id = update.effective_message.chat_id
     try:
-        job_blog = get_job_name(chat_id, ServiceType.BLOG.name)
-        job_removed = remove_job_if_exists(job_blog, context)
-        context.job_queue.run_daily(blog_update, time=TIME_NIGHT, chat_id=chat_id, name=job_blog)
-        # context.job_queue.run_once(blog_update, when=delta, context=chat_id, name=job_blog)
+        # Without an url the chat follows the default FEED_URL, stored as an empty url
+        url = context.args[0] if context.args else ''
+        if url and not url.startswith(('http://', 'https://')):
+            await update.message.reply_text('Please provide a valid feed url')
+            return
+
         text = 'Blog watch successfully set!'
-        if job_removed:
-            text += ' Old one was removed.'
 
         # Persist, first persist with a fixed date
-        dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.BLOG.value, IsActive.YES,
-                               last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
+        await dbf.offload(dbf.add_or_upd_chat, db_file, str(chat_id), IsActive.YES)
+        await dbf.offload(dbf.add_or_upd_service, db_file, str(chat_id), ServiceType.BLOG.value, IsActive.YES,
+                          optional_url=url, last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
 
         await update.message.reply_text(text)
 
@@ -135,14 +177,20 @@ async def set_blog_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def unset_blog_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove the job if the user changed their mind."""
+    """Stop watching the given feed, or every feed of the chat if none is given."""
     chat_id = update.message.chat_id
-    job_blog = get_job_name(chat_id, ServiceType.BLOG.name)
-    job_removed = remove_job_if_exists(job_blog, context)
-    text = 'Blog watch successfully cancelled!' if job_removed else 'You have no active timer.'
+    url = context.args[0] if context.args else None
+
+    services = await chat_services(chat_id, ServiceType.BLOG)
+    if url:
+        services = [s for s in services if s.optional_url == url or (url == FEED_URL and not s.optional_url)]
+    text = 'Blog watch successfully cancelled!' if services else 'You have no active timer.'
 
     # Persist
-    dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.BLOG.value, IsActive.NO)
+    batch = dbf.ServiceBatch(db_file)
+    for s in services:
+        batch.deactivate(chat_id, ServiceType.BLOG.value, optional_url=s.optional_url, last_updated=s.last_updated)
+    await dbf.offload(batch.flush)
 
     await update.message.reply_text(text)
 # endregion
@@ -150,7 +198,7 @@ async def unset_blog_watch_job(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # region Dex
 async def set_dex_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a job to the queue."""
+    """Add a manga to the chat's watch list, the nightly poll picks it up."""
     try:
         if not context.args:
             await update.message.reply_text('Please provide a manga id')
@@ -162,13 +210,9 @@ async def set_dex_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         chat_id = update.effective_message.chat_id
 
-        rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-        if len(rows) > 0:
-            for row in rows:
-                service = TService(row)
-                if service.optional_url == manga_id:
-                    await update.message.reply_text('Manga already being watched')
-                    return
+        if any(service.optional_url == manga_id for service in await chat_services(chat_id, ServiceType.DEX)):
+            await update.message.reply_text('Manga already being watched')
+            return
 
         exists, msg = await check_manga_exists(manga_id)
         if not exists:
@@ -177,16 +221,12 @@ async def set_dex_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         await update.message.reply_text(msg)
 
-        job_dex = get_job_name(chat_id, ServiceType.DEX.name)
-        job_removed = remove_job_if_exists(job_dex, context)
-        context.job_queue.run_daily(dex_updates, time=TIME_NIGHT, chat_id=chat_id, name=job_dex)
         text = 'Dex watch successfully set!'
-        if job_removed:
-            text += ' Old one was removed.'
 
         # Persist, first persist with a fixed date
-        dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.DEX.value, IsActive.YES, optional_url=manga_id,
-                               last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
+        await dbf.offload(dbf.add_or_upd_chat, db_file, str(chat_id), IsActive.YES)
+        await dbf.offload(dbf.add_or_upd_service, db_file, str(chat_id), ServiceType.DEX.value, IsActive.YES,
+                          optional_url=manga_id, last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
 
         await update.message.reply_text(text)
     except (IndexError, ValueError):
@@ -196,36 +236,57 @@ async def set_dex_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def get_dex_upd(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Check if there is an update on the feed and notifies it."""
     chat_id = update.message.chat_id
-    rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-    services = [TService(row) for row in rows]
-    mangas = await asyncio.gather(*(chain_manga(idx, service) for idx, service in enumerate(services)))
-    for manga in mangas:
-        if manga:
-            await update.message.reply_text(manga)
+    services = await fresh_chat_services(chat_id, ServiceType.DEX)
+    messages = await poll_mangadex(services)
+    for manga in render_digest(messages.get(str(chat_id), [])):
+        await update.message.reply_text(manga)
     return
 
 
-async def dex_updates(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Check if there is an update on the feed and notifies it."""
-    job = context.job
-    chat_id = job.chat_id
-    rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-    services = [TService(row) for row in rows]
-    mangas = await asyncio.gather(*(chain_manga(idx, service) for idx, service in enumerate(services)))
-    for manga in mangas:
-        if manga:
-            await context.bot.send_message(job.chat_id, text=manga)
-    return
+async def dex_updates(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """Poll every followed manga once and collect the chapters each chat has not seen."""
+    return await poll_mangadex(services, failed)
+
+
+async def held_dex_updates(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """The chapters poll_due_mangas found for the chats of the slot since their previous one"""
+    chat_ids = list({service.id_chat for service in services})
+    rows = await dbf.offload(dbf.take_held_notifications, db_file, ServiceType.DEX.value, chat_ids)
+    messages: dict[str, list[str]] = {}
+    for chat_id, text in rows:
+        messages.setdefault(chat_id, []).append(text)
+    return messages
 
 
-async def chain_manga(idx: int, service: TService) -> str:
-    await asyncio.sleep(idx*2)
-    msg = get_mangadex(service.optional_url, service.last_updated, service.id_chat)
-    return msg
+async def poll_due_mangas(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Polls the mangas due on their release cadence, for every chat following them, within the share of
+    DEX_POLL_BUDGET of a tick. What doesn't fit stays due for the next tick, the most overdue first.
+    The chapters found are held until each chat's NIGHT slot, which sends them in its digest.
+    """
+    if breaker.is_down(service_host(ServiceType.DEX, None)):
+        return
+    max_requests = max(1, math.ceil(DEX_POLL_BUDGET * DEX_POLL_TICK / (24 * 60 * 60)))
+    due = await dbf.offload(dbf.get_due_mangas, db_file, datetime.datetime.utcnow(),
+                            max_requests * DEX_IDS_PER_REQUEST)
+    if not due:
+        return
+    services = [TService(row) for row in await dbf.offload(dbf.get_dex_services, db_file, due)]
+    selected = set(within_budget(due, services, max_requests))
+    if len(selected) < len(due):
+        logger.warning(f'{len(due) - len(selected)} mangas due are over the poll budget, left for the next tick')
+
+    run = profiling.take('poll_due_mangas')
+    messages = await profiling.measure(run, poll_mangadex([s for s in services if s.optional_url in selected],
+                                                          schedule=True))
+    await dbf.offload(dbf.hold_notifications, db_file, ServiceType.DEX.value,
+                      [(chat_id, text) for chat_id, texts in messages.items() for text in texts])
+    if run:
+        run.finish()
 
 
 async def unset_manga_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove the selected manga and remove job if there are no mangas left."""
+    """Remove the selected manga from the chat's watch list."""
 
     if not context.args:
         await update.message.reply_text('Please provide a manga id')
@@ -238,14 +299,11 @@ async def unset_manga_watch_job(update: Update, context: ContextTypes.DEFAULT_TY
     chat_id = update.message.chat_id
 
     # Remove manga from db
-    rows_deleted = dbf.remove_manga(db_file, str(chat_id), manga_id)
+    rows_deleted = await dbf.offload(dbf.remove_manga, db_file, str(chat_id), manga_id)
 
-    rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-    services = [TService(row) for row in rows]
+    services = await chat_services(chat_id, ServiceType.DEX)
     if len(services) == 0:
-        job_dex = get_job_name(chat_id, ServiceType.DEX.name)
-        job_removed = remove_job_if_exists(job_dex, context)
-        text = 'Dex watch successfully cancelled!' if job_removed else 'You have no active timer.'
+        text = 'Dex watch successfully cancelled!' if rows_deleted > 0 else 'You have no active timer.'
         await update.message.reply_text(text)
         return
 
@@ -258,167 +316,464 @@ async def unset_dex_watch_job(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = update.message.chat_id
 
     # deactivate dex services associated to chat_id
-    rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-    services = [TService(row) for row in rows]
+    services = await chat_services(chat_id, ServiceType.DEX)
+    batch = dbf.ServiceBatch(db_file)
     for s in services:
-        dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.DEX.value, IsActive.NO, optional_url=s.optional_url,
-                               last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
+        batch.deactivate(chat_id, ServiceType.DEX.value, optional_url=s.optional_url,
+                         last_updated=datetime.datetime(2000, 1, 1, 0, 0, 0))
+    await dbf.offload(batch.flush)
 
-    job_dex = get_job_name(chat_id, ServiceType.DEX.name)
-    job_removed = remove_job_if_exists(job_dex, context)
-    text = 'Dex watch successfully cancelled!' if job_removed else ('You have no dex active job (This message might '
-                                                                    'repeat if you were watching multiple mangas)')
+    text = 'Dex watch successfully cancelled!' if services else ('You have no dex active job (This message might '
+                                                                 'repeat if you were watching multiple mangas)')
     await update.message.reply_text(text)
 
 
 async def get_manga_list(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Get the list of mangas being watched"""
     chat_id = update.message.chat_id
-    rows = dbf.get_active_manga_by_chat(db_file, str(chat_id))
-    services = [TService(row) for row in rows]
+    services = await chat_services(chat_id, ServiceType.DEX)
+    mangas = await manga_metadata(service.optional_url for service in services)
     msg = 'Mangas being watched:\n'
     for service in services:
-        msg += f'{service.optional_url}\n'
+        manga = mangas.get(service.optional_url)
+        if manga:
+            msg += f'{manga.title} ({manga.status}) - {service.optional_url}\n'
+        else:
+            msg += f'{service.optional_url}\n'
     await update.message.reply_text(msg)
 
+
+async def warm_manga_metadata(_: ContextTypes.DEFAULT_TYPE) -> None:
+    """Fetches the missing or expired metadata of every followed manga in bulk"""
+    manga_ids = await dbf.offload(dbf.get_followed_manga_ids, db_file)
+    mangas = await manga_metadata(manga_ids)
+    logger.info(f'Metadata cached for {len(mangas)} of {len(manga_ids)} followed mangas')
+
 # endregion
 
 
-async def deactivate_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def deactivate_chat(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Marks chat and its services as inactive."""
     chat_id = update.message.chat_id
 
-    # Persist
-    rows = dbf.get_active_services_from_chat(db_file, str(chat_id))
-    tservices = [TService(row) for row in rows]
+    # Persist, the chat and all of its services in a single transaction
+    tservices = await chat_services(chat_id)
 
+    batch = dbf.ServiceBatch(db_file)
     for service in tservices:
-        if service.id_type == ServiceType.WEATHER.value:
-            await unset_weather_job(update, context)
-        if service.id_type == ServiceType.BLOG.value:
-            await unset_blog_watch_job(update, context)
-        if service.id_type == ServiceType.DEX.value:
-            await unset_dex_watch_job(update, context)
-
-        dbf.add_or_upd_service(db_file, str(chat_id), service.id_type, IsActive.NO,
-                               optional_url=service.optional_url, last_updated=service.last_updated)
-
-    dbf.add_or_upd_chat(db_file, str(chat_id), IsActive.NO)
+        batch.deactivate(chat_id, service.id_type, optional_url=service.optional_url,
+                         last_updated=service.last_updated)
+    batch.set_chat(chat_id, IsActive.NO)
+    await dbf.offload(batch.flush)
 
     await update.message.reply_text("Your you have successfully deactivated the chat and it's associated services.")
 
 
-def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Remove job with given name. Returns whether job was removed."""
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
-        return False
-    for job in current_jobs:
-        job.schedule_removal()
-    return True
-
-
 async def simple_reply(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Basic reply"""
     # Save chat id and set it to active
     chat_id = update.effective_message.chat_id
-    dbf.add_or_upd_chat(db_file, str(chat_id), IsActive.YES)
+    await dbf.offload(dbf.add_or_upd_chat, db_file, str(chat_id), IsActive.YES)
 
     await update.message.reply_text("Hi! To view the options type /options ")
 
 
-def get_job_name(chat_id: int, job_type: str) -> str:
-    return str(chat_id) + job_type
+# region Slots
+# Each slot runs one job per timezone, whatever the number of subscribers.
+# The producers of a slot collect the notifications of their service type, digests merge them per chat.
+SLOTS = {
+    MORNING: (TIME_MORNING, {ServiceType.WEATHER: weather_update}),
+    NOON: (TIME_NOON, {ServiceType.WEATHER: weather_update}),
+    # With adaptive polling the mangas are polled by poll_due_mangas on their own cadence, the slot sends what it found
+    NIGHT: (TIME_NIGHT, {ServiceType.BLOG: blog_update,
+                         ServiceType.DEX: held_dex_updates if DEX_ADAPTIVE_POLLING else dex_updates}),
+}
+
+
+async def get_slot_services(tz_name: str, stype: ServiceType, shard: tuple[int, int] = None) -> list:
+    """Active services of a type for the chats living in a timezone, only those of a shard in a worker process"""
+    rows = await dbf.offload(dbf.get_active_services_by_type, db_file, stype.value, timezone=tz_name, shard=shard)
+    return [TService(row) for row in rows]
+
+
+def slot_start_lag(slot_time: time, tz_name: str) -> float:
+    """Seconds since the slot was due today in the timezone"""
+    tz = timezone(tz_name)
+    now = datetime.datetime.now(tz)
+    return (now - tz.localize(datetime.datetime.combine(now.date(), slot_time))).total_seconds()
+
+
+def dispatch_wave(id_chat: str, waves: int) -> int:
+    """Wave of the dispatch window a chat is served in, the same one every day"""
+    # Salted, so the wave does not follow the worker shard, which hashes the same id
+    return zlib.crc32(f'dispatch:{id_chat}'.encode()) % waves
+
+
+def queue_digests(digests: dict[str, list[str]], spread: bool = True) -> list[tuple]:
+    """
+    Outbox rows of the digests, each chat's sent in its wave of the dispatch window when spread, else right away.
+    Each wave starts at a random offset of up to DISPATCH_JITTER seconds.
+    """
+    waves = max(1, DISPATCH_WINDOW // DISPATCH_STEP) if spread else 1
+    offsets = [wave * DISPATCH_STEP + random.uniform(0, DISPATCH_JITTER) for wave in range(waves)] if waves > 1 else [0]
+    now = datetime.datetime.now()
+    send_at = [now + datetime.timedelta(seconds=offset) for offset in offsets]
+    return [(chat_id, send_at[dispatch_wave(chat_id, waves)], text)
+            for chat_id, texts in digests.items() for text in texts]
+
+
+async def send_outbox(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Hands the digests whose wave is due to the send queue, no more than it delivers in DISPATCH_STEP seconds.
+    The spread adapts to the backlog, later waves slide back instead of piling onto the queue.
+    """
+    limit = int((DISPATCH_STEP - send_queue.drain_estimate()) * send_queue.global_bucket.rate)
+    if limit <= 0:
+        return
+    rows = await dbf.offload(dbf.take_due_outbox, db_file, datetime.datetime.now(), limit,
+                             context.bot_data.get('shard'))
+    for chat_id, text in rows:
+        send_queue.send(chat_id, text)
+
+
+def defer_services(context: ContextTypes.DEFAULT_TYPE, slot: str, tz_name: str, stype: ServiceType,
+                   services: list[TService], deadline: datetime.datetime, attempt: int = 0) -> None:
+    """
+    Schedules the services for when their upstreams let a trial call through, or gives up past the deadline.
+    Each attempt waits twice as long as the previous one, from BREAKER_RESET seconds.
+    """
+    delay = max(BREAKER_RESET * 2 ** attempt, *(breaker.retry_in(service_host(stype, s)) for s in services))
+    delay += random.uniform(0, DISPATCH_JITTER)
+    if datetime.datetime.now() + datetime.timedelta(seconds=delay) > deadline:
+        logger.error(f'{slot} {stype} still failing, {len(services)} chats in {tz_name} skip this slot')
+        return
+    logger.warning(f'{slot} {stype} failed, {len(services)} chats in {tz_name} deferred by {delay:.0f}s')
+    context.job_queue.run_once(run_deferred, when=delay, name=f'deferred {slot} {stype.name} {tz_name}',
+                               data={'slot': slot, 'timezone': tz_name, 'stype': stype, 'services': services,
+                                     'deadline': deadline, 'attempt': attempt + 1})
+
+
+async def run_deferred(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Serves the chats of a slot put off while their upstream was down"""
+    data = context.job.data
+    slot, tz_name, stype = data['slot'], data['timezone'], data['stype']
+    producers = {stype: SLOTS[slot][1][stype]}
+    digests = await collect_slot(context, slot, tz_name, producers, {stype: data['services']}, {stype: None},
+                                 data['deadline'], data['attempt'])
+    # Already late, sent as soon as the queue allows
+    await dbf.offload(dbf.queue_outbox, db_file, queue_digests(digests, spread=False))
+
+
+async def run_slot(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Collect every notification due in the slot and send each chat a single digest.
+    The upstreams are polled once for the whole slot, then the digests wait in the outbox and go out over
+    DISPATCH_WINDOW seconds in waves DISPATCH_STEP apart, so the sends are not all due in the same second.
+    """
+    slot, tz_name, shard = context.job.data['slot'], context.job.data['timezone'], context.job.data.get('shard')
+    slot_time, producers = SLOTS[slot]
+    metrics.job_start_lag.observe(max(0.0, slot_start_lag(slot_time, tz_name)), slot=slot)
+    run_on = context.job.data.get('run_on') or datetime.datetime.now(timezone(tz_name)).date()
+    running = context.bot_data.setdefault('running_slots', set())
+    if shard:
+        if (slot, tz_name, run_on) in running or \
+                not await dbf.offload(dbf.claim_slot, db_file, slot, tz_name, run_on, shard, SLOT_CLAIM_TIMEOUT):
+            logger.warning(f'{slot} {tz_name} shard {shard[0]}/{shard[1]} already ran on {run_on}, skipping')
+            return
+    running.add((slot, tz_name, run_on))
+    try:
+        await run_claimed_slot(context, slot, tz_name, shard, producers)
+    finally:
+        running.discard((slot, tz_name, run_on))
+    if shard:
+        # The digests are in the outbox, from here on a restart sends them without running the slot again
+        await dbf.offload(dbf.finish_slot, db_file, slot, tz_name, run_on, shard)
+
+
+async def run_claimed_slot(context: ContextTypes.DEFAULT_TYPE, slot: str, tz_name: str, shard: tuple[int, int],
+                           producers: dict) -> None:
+    runs = {stype: profiling.take(producer.__name__) for stype, producer in producers.items()}
+    services = {stype: await get_slot_services(tz_name, stype, shard) for stype in producers}
+    digests = await collect_slot(context, slot, tz_name, producers, services, runs)
+
+    profiled_runs = [run for run in runs.values() if run]
+    if not profiled_runs:
+        await dbf.offload(dbf.queue_outbox, db_file, queue_digests(digests))
+        return
+    # A profiled run sends at once, so it is charged the delivery of its digests and not the dispatch window.
+    # The digests are shared by the producers of the slot, each profiled run is charged the whole delivery
+    notify(digests)
+    start = datetime.datetime.now()
+    await send_queue.join()
+    delivery = (datetime.datetime.now() - start).total_seconds()
+    for run in profiled_runs:
+        run.add('send', delivery)
+        run.wall += delivery
+        run.finish()
+
+
+async def collect_slot(context: ContextTypes.DEFAULT_TYPE, slot: str, tz_name: str, producers: dict,
+                       services: dict[ServiceType, list], runs: dict, deadline: datetime.datetime = None,
+                       attempt: int = 0) -> dict[str, list[str]]:
+    """
+    Collect the notifications of the services of a slot, merged into a single digest per chat.
+    Services whose upstream is down or whose fetch failed are deferred and tried again, with a backoff and once
+    the circuit breaker lets calls through, until BREAKER_DEFER_HOURS after the slot.
+    """
+    deferred = {stype: [s for s in services[stype] if breaker.is_down(service_host(stype, s))] for stype in producers}
+    services = {stype: [s for s in services[stype] if not breaker.is_down(service_host(stype, s))]
+                for stype in producers}
+
+    failed = {stype: [] for stype in producers}
+
+    async def produce(stype: ServiceType, producer) -> dict[str, list[str]]:
+        if not services[stype]:
+            return {}
+        return await profiling.measure(runs[stype], producer(services[stype], failed[stype]))
+
+    results = await asyncio.gather(*(produce(stype, producer) for stype, producer in producers.items()),
+                                   return_exceptions=True)
+    collected = []
+    for stype, result in zip(producers, results):
+        if isinstance(result, Exception):
+            logger.error(f'{slot} {stype} updates failed for {tz_name}', exc_info=result)
+            failed[stype] = services[stype]
+            result = {}
+        collected.append(result)
+        deferred[stype] += failed[stype]
+
+    deadline = deadline or datetime.datetime.now() + datetime.timedelta(hours=BREAKER_DEFER_HOURS)
+    for stype, stype_services in deferred.items():
+        if stype_services:
+            defer_services(context, slot, tz_name, stype, stype_services, deadline, attempt)
+    return build_digests(collected)
+
+
+def notify(messages: dict[str, list[str]]) -> None:
+    """Hand the messages of every chat to the send queue, which paces them within Telegram's limits"""
+    for chat_id, texts in messages.items():
+        for text in texts:
+            send_queue.send(chat_id, text)
+    if send_queue.depth:
+        logger.info(f'Send queue depth {send_queue.depth}, about {send_queue.drain_estimate():.0f}s to drain')
+
+
+def set_slot_jobs(context: ContextTypes.DEFAULT_TYPE, tz_name: str) -> None:
+    """
+    Register the slot jobs of a timezone, unless they are already in the queue.
+    With worker processes the jobs only run in the workers, each one for its shard.
+    """
+    shard = context.bot_data.get('shard')
+    if WORKER_PROCESSES and not shard:
+        return
+    tz = timezone(tz_name)
+    for slot, (slot_time, _) in SLOTS.items():
+        name = f'{slot}_{tz_name}'
+        if context.job_queue.get_jobs_by_name(name):
+            continue
+        context.job_queue.run_daily(run_slot, time=slot_time.replace(tzinfo=tz), name=name,
+                                    data={'slot': slot, 'timezone': tz_name, 'shard': shard})
+
+
+def resume_abandoned_slots(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Run again today's slots of the worker's shard claimed by a worker that died before finishing them.
+    Older ones are left alone, the next run of the slot catches up from the watermarks.
+    """
+    shard = context.bot_data.get('shard')
+    if not shard:
+        return
+    for slot, tz_name, run_on in dbf.get_abandoned_slots(db_file, shard, SLOT_CLAIM_TIMEOUT):
+        try:
+            today = datetime.datetime.now(timezone(tz_name)).date()
+        except UnknownTimeZoneError:
+            continue
+        if slot not in SLOTS or run_on != today.isoformat():
+            continue
+        logger.warning(f'{slot} {tz_name} shard {shard[0]}/{shard[1]} was left unfinished, running it again')
+        context.job_queue.run_once(run_slot, when=0, name=f'resumed {slot}_{tz_name}',
+                                   data={'slot': slot, 'timezone': tz_name, 'shard': shard, 'run_on': today})
+
+
+def set_outbox_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Register the job sending the digests of the slots as their waves come due, unless it is already in the queue.
+    It runs wherever the slots do, so it also sends what a previous run of the process left in the outbox.
+    """
+    if WORKER_PROCESSES and not context.bot_data.get('shard'):
+        return
+    if context.job_queue.get_jobs_by_name('send_outbox'):
+        return
+    context.job_queue.run_repeating(send_outbox, interval=DISPATCH_TICK, first=0, name='send_outbox')
+
 
+def set_dex_poll_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Register the adaptive manga poll, unless it is already in the queue.
+    It runs in a single process for every chat, the bot process or, with worker processes, the first worker.
+    """
+    shard = context.bot_data.get('shard')
+    if not DEX_ADAPTIVE_POLLING or (shard[0] != 0 if shard else WORKER_PROCESSES):
+        return
+    if context.job_queue.get_jobs_by_name('poll_due_mangas'):
+        return
+    context.job_queue.run_repeating(poll_due_mangas, interval=DEX_POLL_TICK, first=60, name='poll_due_mangas')
 
-def load_saved_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Read info from db and load saved jobs for the chat"""
 
-    tchat = []
-    rows = dbf.get_active_chat_list(db_file)
-    for row in rows:
-        tchat.append(TChat(row))
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set the timezone used to deliver the chat's updates"""
+    if not context.args:
+        await update.message.reply_text(f'Please provide a timezone, e.g. {DEFAULT_TIMEZONE}')
+        return
+    tz_name = context.args[0]
+    try:
+        timezone(tz_name)
+    except UnknownTimeZoneError:
+        await update.message.reply_text(f'Unknown timezone {tz_name}')
+        return
 
-    tservices = []
-    for chat in tchat:
-        rows = dbf.get_active_services_from_chat(db_file, chat.id)
-        for row in rows:
-            tservices.append(TService(row))
+    chat_id = update.effective_message.chat_id
+    await dbf.offload(dbf.add_or_upd_chat, db_file, str(chat_id), IsActive.YES)
+    await dbf.offload(dbf.set_chat_timezone, db_file, str(chat_id), tz_name)
+    set_slot_jobs(context, tz_name)
 
-    for service in tservices:
-        chat_id = service.id_chat
-        stype = ServiceType(service.id_type).value
-        if stype == ServiceType.BLOG.value:
-            try:
-                job_blog = get_job_name(chat_id, ServiceType.BLOG.name)
-                job_removed = remove_job_if_exists(job_blog, context)
-                context.job_queue.run_daily(blog_update, time=TIME_NIGHT, chat_id=chat_id, name=job_blog)
-            except (IndexError, ValueError):
-                logger.error("Failed to set a blog watch job")
-        elif stype == ServiceType.WEATHER.value:
-            try:
-                job_removed = set_weather_job(context, chat_id)
-            except (IndexError, ValueError):
-                logger.error("Failed to set a weather job")
-        elif stype == ServiceType.DEX.value:
-            try:
-                job_dex = get_job_name(chat_id, ServiceType.DEX.name)
-                job_removed = remove_job_if_exists(job_dex, context)
-                context.job_queue.run_daily(dex_updates, time=TIME_NIGHT, chat_id=chat_id, name=job_dex)
-            except (IndexError, ValueError):
-                logger.error("Failed to set a dex watch job")
+    await update.message.reply_text(f'Updates will be delivered in {tz_name} time.')
+# endregion
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin only, profile the next runs of a producer or a command: /profile dex_updates [runs]"""
+    if str(update.effective_message.chat_id) not in ADMIN_CHAT_IDS:
+        return
+    if not PROFILING:
+        await update.message.reply_text('Profiling is disabled, start the bot with PROFILING=1')
+        return
+    if not context.args:
+        armed = ', '.join(f'{target} x{runs}' for target, runs in profiling.armed().items()) or 'nothing'
+        await update.message.reply_text(f'Usage: /profile target [runs]\nArmed: {armed}')
+        return
+    target = context.args[0]
+    try:
+        runs = int(context.args[1]) if len(context.args) > 1 else 1
+    except ValueError:
+        await update.message.reply_text('The number of runs must be an integer')
+        return
+    profiling.arm(target, runs)
+    text = f'Profiling the next {runs} runs of {target}' if runs > 0 else f'Profiling of {target} cancelled'
+    if WORKER_PROCESSES:
+        text += ' in the bot process, the slots run in the workers, which arm PROFILE_TARGETS at startup'
+    await update.message.reply_text(text)
+
+
+def load_saved_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Read the timezones of the active chats from db and load a set of slot jobs for each of them"""
+
+    timezones = {DEFAULT_TIMEZONE, *dbf.get_active_timezones(db_file)}
+    logger.info(f'Active chats in {len(timezones)} timezones')
+    set_dex_poll_job(context)
+    set_outbox_job(context)
+    resume_abandoned_slots(context)
+
+    for tz_name in timezones:
+        try:
+            set_slot_jobs(context, tz_name)
+        except UnknownTimeZoneError:
+            logger.error(f"Failed to set the slot jobs for timezone {tz_name}")
 
 
 async def options(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends explanation on how to use the bot."""
-    long_msg = "Use /setw to receive updates on the weather in the morning and at noon\n" \
+    long_msg = "Use /setw [lat lon] to receive updates on the weather in the morning and at noon\n" \
                "Use /unsetw to cancel the weather updates\n" \
                "Use /getw to get weather update now\n" \
-               "Use /setblog to watch if there are new posts in the evening\n" \
-               "Use /unsetblog to cancel the blog watch\n" \
+               "Use /setblog [feed_url] to watch if there are new posts in the evening\n" \
+               "Use /unsetblog [feed_url] to cancel the blog watch\n" \
                "Use /getblog to check for blog updates now\n" \
                "Use /setdex manga_id to set a watch job on a specific manga\n" \
                "Use /unsetmanga manga_id to get the mangadex updates\n" \
                "Use /unsetdex to remove all mangadex updates\n" \
                "Use /getdexupdates to get the mangadex updates now\n" \
                "Use /getmangalist to get the list of mangas you're following\n" \
+               "Use /settz timezone to receive the updates in your local time\n" \
                "Use /forgetme deactivate current chat and it's services\n" \
                "Have fun :)"
     await update.message.reply_text(long_msg)
 
 
+async def post_init(application: Application) -> None:
+    """Starts the shared resources once the application is initialized"""
+    await http_client.start_client()
+    send_queue.start(application.bot)
+    await metrics.start_server()
+    if PROFILING:
+        profiling.arm_from_config()
+
+
+async def post_stop(_: Application) -> None:
+    """Delivers the queued messages while the bot can still send them"""
+    await send_queue.stop()
+
+
+async def post_shutdown(_: Application) -> None:
+    """Releases the shared resources once the application is shut down"""
+    await metrics.stop_server()
+    await http_client.close_client()
+    dbf.close_connections()
+
+
+def command(name: str, callback) -> CommandHandler:
+    """CommandHandler whose latency is recorded under the command name, and that can be profiled by that name"""
+    return CommandHandler(name, metrics.timed_handler(name, profiling.profiled(name, callback)))
+
+
 def main():
     """Start the bot."""
 
     # Create the Application, use your bot's token.
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Bot API requests are only timed as the send phase of profiled runs when profiling is enabled
+    request_class = ProfiledRequest if PROFILING else HTTPXRequest
+    builder = (Application.builder().token(TELEGRAM_TOKEN).base_url(TELEGRAM_BASE_URL)
+               .request(request_class(connection_pool_size=TG_POOL_SIZE))
+               .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown))
+    if BOT_MODE == 'webhook':
+        # The webhook answers 503 once this many updates are waiting, and Telegram delivers them again later
+        builder = builder.update_queue(asyncio.Queue(WEBHOOK_QUEUE_SIZE)).concurrent_updates(WEBHOOK_CONCURRENCY)
+    application = builder.build()
 
     # General
-    application.add_handler(CommandHandler("options", options))
-    application.add_handler(CommandHandler("forgetme", deactivate_chat))
+    application.add_handler(command("options", options))
+    application.add_handler(command("forgetme", deactivate_chat))
+    application.add_handler(command("settz", set_timezone))
+    application.add_handler(command("profile", profile))
     # Weather
-    application.add_handler(CommandHandler("setw", set_daily_weather_job))
-    application.add_handler(CommandHandler("unsetw", unset_weather_job))
-    application.add_handler(CommandHandler("getw", get_my_weather))
+    application.add_handler(command("setw", set_daily_weather_job))
+    application.add_handler(command("unsetw", unset_weather_job))
+    application.add_handler(command("getw", get_my_weather))
     # Blog
-    application.add_handler(CommandHandler("setblog", set_blog_watch_job))
-    application.add_handler(CommandHandler("unsetblog", unset_blog_watch_job))
-    application.add_handler(CommandHandler("getblog", get_blog))
+    application.add_handler(command("setblog", set_blog_watch_job))
+    application.add_handler(command("unsetblog", unset_blog_watch_job))
+    application.add_handler(command("getblog", get_blog))
     # Mangadex
-    application.add_handler(CommandHandler("setdex", set_dex_watch_job))
-    application.add_handler(CommandHandler("unsetmanga", unset_manga_watch_job))
-    application.add_handler(CommandHandler("unsetdex", unset_dex_watch_job))
-    application.add_handler(CommandHandler("getdexupdates", get_dex_upd))
-    application.add_handler(CommandHandler("getmangalist", get_manga_list))
+    application.add_handler(command("setdex", set_dex_watch_job))
+    application.add_handler(command("unsetmanga", unset_manga_watch_job))
+    application.add_handler(command("unsetdex", unset_dex_watch_job))
+    application.add_handler(command("getdexupdates", get_dex_upd))
+    application.add_handler(command("getmangalist", get_manga_list))
 
     # On non command i.e. message - return list of command options
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, simple_reply))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND,
+                                           metrics.timed_handler('text', simple_reply)))
 
     # Load saved jobs
     load_saved_jobs(CallbackContext(application))
+    logger.info(f'Loaded {dbf.load_subscriptions(db_file)} subscriptions in the index')
+    application.job_queue.run_once(warm_manga_metadata, when=0, name='warm_manga_metadata')
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        asyncio.run(webhook.run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,93 @@
+import logging
+import time
+
+import httpx
+
+from settings.config import BREAKER_FAILURES, BREAKER_RESET
+from monitoring import metrics
+
+logger = logging.getLogger()
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+# Exported as a number, so a dashboard can plot it
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(httpx.TransportError):
+    """Raised instead of calling an upstream whose breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Fails the calls to an upstream fast once `failures` attempts in a row failed.
+    After `reset` seconds a single trial call goes through, its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset: float = BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        metrics.breaker_state.set(STATE_VALUES[CLOSED], upstream=name)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f'Circuit breaker of {self.name} {self.state} -> {state}')
+        self.state = state
+        metrics.breaker_state.set(STATE_VALUES[state], upstream=self.name)
+
+    def retry_in(self) -> float:
+        """Seconds until a call may go through, 0 when it can now"""
+        now = time.monotonic()
+        if self.state == OPEN:
+            return max(0.0, self.opened_at + self.reset - now)
+        if self.state == HALF_OPEN:
+            # A trial that never reported back, e.g. cancelled, does not hold the breaker forever
+            return max(0.0, self.trial_started_at + self.reset - now)
+        return 0.0
+
+    def check(self) -> None:
+        """Lets a call through or raises CircuitOpen, the first call after the reset is the trial"""
+        if self.state == CLOSED:
+            return
+        retry_in = self.retry_in()
+        if retry_in > 0:
+            raise CircuitOpen(f'{self.name} is unavailable, retrying in {retry_in:.0f}s')
+        self._transition(HALF_OPEN)
+        self.trial_started_at = time.monotonic()
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+
+# One per host, a dead blog does not stop the others
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(host: str) -> CircuitBreaker:
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+
+def is_down(host: str) -> bool:
+    """Whether calls to the host would fail fast right now"""
+    breaker = _breakers.get(host)
+    return breaker is not None and breaker.retry_in() > 0
+
+
+def retry_in(host: str) -> float:
+    breaker = _breakers.get(host)
+    return breaker.retry_in() if breaker else 0.0
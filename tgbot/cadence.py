@@ -0,0 +1,63 @@
+"""
+Release cadence of a manga, estimated from the publish times of its chapters, and when to poll it next.
+
+Chapters published within RELEASE_MERGE of each other are one release, e.g. a batch of chapters dropped together.
+The interval between releases is the median of the last gaps, so one late or early release does not move it much.
+Polls are spread around the next expected release and become rarer the longer a series stays quiet.
+"""
+from datetime import datetime, timedelta
+from statistics import median
+
+from settings.config import DEX_POLL_MIN_INTERVAL, DEX_POLL_MAX_INTERVAL, DEX_POLL_DEFAULT_INTERVAL
+
+RELEASE_MERGE = timedelta(hours=12)
+# Publish times kept per manga, enough for the median of the last gaps
+HISTORY = 12
+# Around the expected release, as fractions of the interval: how early to start polling, how long to keep at it
+# and how often to poll meanwhile
+WINDOW_BEFORE = 1 / 7
+WINDOW_AFTER = 1 / 3
+WINDOW_STEP = 1 / 28
+
+
+def releases(publish_times: list[datetime]) -> list[datetime]:
+    """Distinct releases, oldest first, each one at the time of its first chapter"""
+    merged = []
+    for publish_at in sorted(publish_times):
+        if not merged or publish_at - merged[-1] > RELEASE_MERGE:
+            merged.append(publish_at)
+    return merged
+
+
+def release_interval(release_times: list[datetime]) -> timedelta | None:
+    """Typical time between releases, None until two releases are known"""
+    if len(release_times) < 2:
+        return None
+    return median(b - a for a, b in zip(release_times, release_times[1:]))
+
+
+def next_poll(publish_times: list[datetime], now: datetime) -> tuple[datetime, timedelta | None]:
+    """
+    When to poll a manga next, and its estimated release interval
+    :param publish_times: latest known chapter publish times
+    :param now: time of the poll that just happened
+    """
+    release_times = releases(publish_times)
+    interval = release_interval(release_times)
+    if not release_times:
+        delay = timedelta(seconds=DEX_POLL_DEFAULT_INTERVAL)
+    else:
+        since_last = now - release_times[-1]
+        expected = release_times[-1] + interval if interval else None
+        if expected is None:
+            # One release known, the default cadence until the series goes quiet
+            delay = max(timedelta(seconds=DEX_POLL_DEFAULT_INTERVAL), since_last / 4)
+        elif now < expected - interval * WINDOW_BEFORE:
+            delay = expected - interval * WINDOW_BEFORE - now
+        elif now < expected + interval * WINDOW_AFTER:
+            delay = interval * WINDOW_STEP
+        else:
+            # Overdue, backs off as the series stays quiet, up to DEX_POLL_MAX_INTERVAL for dormant ones
+            delay = max(interval * WINDOW_STEP, since_last / 4)
+    delay = min(max(delay, timedelta(seconds=DEX_POLL_MIN_INTERVAL)), timedelta(seconds=DEX_POLL_MAX_INTERVAL))
+    return now + delay, interval
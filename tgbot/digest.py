@@ -0,0 +1,67 @@
+# Longest text the Bot API accepts in a single message
+TELEGRAM_MAX_LENGTH = 4096
+SECTION_SEPARATOR = "\n\n"
+
+
+def merge_notifications(results: list[dict[str, list[str]]]) -> dict[str, list[str]]:
+    """Collects the notifications every service produced for a chat in a slot, in service order"""
+    merged: dict[str, list[str]] = {}
+    for result in results:
+        for chat_id, texts in result.items():
+            merged.setdefault(chat_id, []).extend(texts)
+    return merged
+
+
+def render_digest(sections: list[str], max_length: int = TELEGRAM_MAX_LENGTH) -> list[str]:
+    """
+    Joins the sections of a chat into as few messages as possible.
+    Messages are split between sections when they can, then between lines, and only cut mid-line as a last resort.
+    """
+    messages = []
+    current = ""
+    for section in sections:
+        section = section.strip("\n")
+        if not section:
+            continue
+        candidate = f"{current}{SECTION_SEPARATOR}{section}" if current else section
+        if len(candidate) <= max_length:
+            current = candidate
+            continue
+        if current:
+            messages.append(current)
+        current = ""
+        for piece in _split_section(section, max_length):
+            if current:
+                messages.append(current)
+            current = piece
+    if current:
+        messages.append(current)
+    return messages
+
+
+def _split_section(section: str, max_length: int) -> list[str]:
+    if len(section) <= max_length:
+        return [section]
+    pieces = []
+    current = ""
+    for line in section.split("\n"):
+        while len(line) > max_length:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:max_length])
+            line = line[max_length:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) <= max_length:
+            current = candidate
+        else:
+            pieces.append(current)
+            current = line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def build_digests(results: list[dict[str, list[str]]]) -> dict[str, list[str]]:
+    """One digest per chat, made of one message unless it runs past Telegram's length limit"""
+    return {chat_id: render_digest(sections) for chat_id, sections in merge_notifications(results).items()}
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from urllib.parse import urlsplit
+
+import httpx
+
+from settings.config import HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_MAX_PER_HOST, HTTP_KEEPALIVE_EXPIRY, \
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_TIMEOUT, HTTP_RETRIES, HTTP_RETRY_BACKOFF
+from monitoring import metrics, profiling
+from tgbot.breaker import breaker_for
+from tgbot.ratelimit import TokenBucket
+
+logger = logging.getLogger()
+
+try:
+    import h2  # noqa: F401  (only needed by httpx to negotiate HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_client: httpx.AsyncClient | None = None
+_host_slots: dict[str, asyncio.Semaphore] = {}
+
+
+def _build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                          keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    return httpx.AsyncClient(limits=limits, http2=HTTP2_AVAILABLE)
+
+
+async def start_client() -> None:
+    """Creates the shared client, called once when the application starts"""
+    global _client
+    if _client is None:
+        _client = _build_client()
+        logger.info(f'HTTP client started (http2={HTTP2_AVAILABLE})')
+
+
+async def close_client() -> None:
+    """Closes the pooled connections, called when the application shuts down"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        _host_slots.clear()
+        logger.info('HTTP client closed')
+
+
+def get_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it if the application did not start it yet"""
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
+
+
+def _host_slot(url: str) -> asyncio.Semaphore:
+    host = urlsplit(url).netloc
+    slot = _host_slots.get(host)
+    if slot is None:
+        slot = _host_slots[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return slot
+
+
+class Upstream:
+    """Deadlines and retry budget of the requests to an upstream"""
+
+    def __init__(self, name: str, read_timeout: float, retries: int = HTTP_RETRIES):
+        self.name = name
+        self.timeout = httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT)
+        self.retries = retries
+
+
+DEFAULT_UPSTREAM = Upstream('other', HTTP_READ_TIMEOUT)
+
+# Times a rate limited (429) request is retried once the limiter allows it
+RATE_LIMITED_RETRIES = 3
+# Server errors worth another attempt, the others won't go away by asking again
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+async def _backoff(call: str, retry: int) -> None:
+    """Exponential backoff with full jitter, so the retries of a failed burst don't arrive together"""
+    metrics.upstream_retries.inc(call=call)
+    await asyncio.sleep(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** retry))
+
+
+async def get(url: str, limiter: TokenBucket | None = None, call: str = 'other',
+              upstream: Upstream = DEFAULT_UPSTREAM, **kwargs) -> httpx.Response:
+    """
+    GET through the shared pool, never holding more than HTTP_MAX_PER_HOST connections to a host.
+    Timeouts and 5xx are retried up to upstream.retries times, and feed the circuit breaker of the host, which
+    raises CircuitOpen instead of calling a host that keeps failing.
+    When a limiter is given every attempt takes a token from it, and the response headers feed it back.
+    Each attempt is timed under `call` in the upstream metrics.
+    """
+    breaker = breaker_for(urlsplit(url).netloc)
+    kwargs.setdefault('timeout', upstream.timeout)
+    attempt = 0
+    retry = 0
+    while True:
+        breaker.check()
+        if limiter:
+            await limiter.acquire()
+        async with _host_slot(url):
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                with profiling.phase('fetch'):
+                    response = await get_client().get(url, **kwargs)
+                status = response.status_code
+            except httpx.PoolTimeout:
+                # Too many requests of this process at once, the host was never asked
+                status = 'pool_timeout'
+                raise
+            except httpx.TransportError:
+                breaker.record_failure()
+                if retry >= upstream.retries:
+                    raise
+            finally:
+                metrics.upstream_duration.observe(time.perf_counter() - start, call=call, status=status)
+        if status == 'error':
+            retry += 1
+            await _backoff(call, retry)
+            continue
+        if limiter:
+            limiter.update_from_headers(response.headers)
+            if response.status_code == 429 and attempt < RATE_LIMITED_RETRIES:
+                if 'Retry-After' not in response.headers:
+                    limiter.pause(2 ** attempt)
+                attempt += 1
+                continue
+        if response.status_code in RETRY_STATUSES:
+            breaker.record_failure()
+            if retry < upstream.retries:
+                retry += 1
+                await _backoff(call, retry)
+                continue
+        else:
+            breaker.record_success()
+        return response
+
+
+@asynccontextmanager
+async def stream(url: str, call: str = 'other', upstream: Upstream = DEFAULT_UPSTREAM,
+                 **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    Streaming GET, the caller may stop reading the body early and the connection goes back to the pool.
+    Failures before the response is handed to the caller are retried and feed the breaker like in get().
+    Timed under `call` until the caller is done with the body.
+    """
+    breaker = breaker_for(urlsplit(url).netloc)
+    kwargs.setdefault('timeout', upstream.timeout)
+    retry = 0
+    while True:
+        breaker.check()
+        handed_over = False
+        async with _host_slot(url):
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                with profiling.phase('fetch'):
+                    async with get_client().stream('GET', url, **kwargs) as response:
+                        status = response.status_code
+                        if status in RETRY_STATUSES:
+                            breaker.record_failure()
+                        if status not in RETRY_STATUSES or retry >= upstream.retries:
+                            if status not in RETRY_STATUSES:
+                                breaker.record_success()
+                            handed_over = True
+                            yield response
+                            return
+            except httpx.PoolTimeout:
+                # Too many requests of this process at once, the host was never asked
+                status = 'pool_timeout'
+                raise
+            except httpx.TransportError:
+                breaker.record_failure()
+                # A body that stops arriving halfway is the caller's to handle, it may have used part of it
+                if handed_over or retry >= upstream.retries:
+                    raise
+            finally:
+                metrics.upstream_duration.observe(time.perf_counter() - start, call=call, status=status)
+        retry += 1
+        await _backoff(call, retry)
@@ -1,8 +1,24 @@
+import json
+
+
 class TChat:
+    __slots__ = ('id', 'active', 'last_updated', 'timezone')
+
     def __init__(self, t):
-        self.id, self.active, self.last_updated = t
+        self.id, self.active, self.last_updated, self.timezone = t
 
 
 class TService:
+    # Kept by the million in the subscription index, slots save the per instance dict
+    __slots__ = ('id', 'id_chat', 'id_type', 'active', 'last_updated', 'optional_url')
+
+    def __init__(self, t):
+        self.id, self.id_chat, self.id_type, self.active, self.last_updated, self.optional_url = t
+
+
+class TManga:
+    __slots__ = ('id', 'title', 'alt_titles', 'status', 'fetched_at')
+
     def __init__(self, t):
-        self.id, self.id_chat, self.id_type, self.active, self.last_updated, self.optional_url = t
\ No newline at end of file
+        self.id, self.title, alt_titles, self.status, self.fetched_at = t
+        self.alt_titles = json.loads(alt_titles) if alt_titles else []
@@ -1,24 +1,216 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+from settings.config import WEATHER_KEY, FEED_URL, ServiceType, db_file, IsActive, WEATHER_CACHE_TTL, \
+    WEATHER_CACHE_SIZE, WEATHER_GRID_DEGREES, WEATHER_MAX_CALLS_PER_SLOT, DEX_RATE_LIMIT, DEX_RATE_BURST, \
+    DEX_IDS_PER_REQUEST, DEX_BATCH_MAX_AGE_DAYS, OWM_BASE_URL, DEX_BASE_URL, \
+    DEX_METADATA_TTL_DAYS, DEX_METADATA_CACHE_SIZE, OWM_READ_TIMEOUT, RSS_READ_TIMEOUT, DEX_READ_TIMEOUT, \
+    SLOT_SHARE_TTL, RSS_CONCURRENCY
 import httpx
-import feedparser
-from datetime import datetime, timedelta
-from settings.config import WEATHER_KEY, FEED_URL, ServiceType, db_file, IsActive
-from tgbot.models import TService
+from tgbot.models import TService, TManga
 import db.db_funcs as dbf
+from monitoring import profiling
+from tgbot import cadence, http_client, rss
+from tgbot.ratelimit import TokenBucket
+from tgbot.http_client import Upstream
+from tgbot.breaker import CircuitOpen
 
+logger = logging.getLogger()
 
-def get_weather():
-    owm_endpoint = "https://api.openweathermap.org/data/2.5/onecall"
+
+def failure_info(error: Exception) -> Exception | None:
+    """Traceback worth logging for a failed fetch, none when the circuit breaker failed it on purpose"""
+    return None if isinstance(error, CircuitOpen) else error
+
+
+# Polls of the last SLOT_SHARE_TTL seconds by (upstream, feed url or manga id), as (since, started, task).
+# The slots of the timezones that run at the same time follow many of the same feeds and mangas, the first one
+# polls them and the others reuse its result.
+_slot_polls: dict[tuple[str, str], tuple[datetime, float, asyncio.Task]] = {}
+
+
+def recent_poll(key: tuple[str, str], since: datetime) -> asyncio.Task | None:
+    """A poll still shared that covers everything published after `since`, failed ones are not reused"""
+    entry = _slot_polls.get(key)
+    if entry is None:
+        return None
+    polled_since, started, task = entry
+    if since < polled_since or time.monotonic() - started > SLOT_SHARE_TTL:
+        return None
+    if task.done() and (task.cancelled() or task.exception() is not None):
+        return None
+    return task
+
+
+def share_poll(keys: list[tuple[str, str]], since: datetime, task: asyncio.Task) -> None:
+    started = time.monotonic()
+    for key in keys:
+        _slot_polls[key] = (since, started, task)
+
+
+def expire_polls() -> None:
+    """Drops the polls older than SLOT_SHARE_TTL, called once per cycle"""
+    now = time.monotonic()
+    for key in [key for key, (_, started, _) in _slot_polls.items() if now - started > SLOT_SHARE_TTL]:
+        del _slot_polls[key]
+
+
+# Weather
+owm = Upstream('owm', OWM_READ_TIMEOUT)
+# Chats that never gave a location get the forecast of the original city
+DEFAULT_LOCATION = (4.62, -74.06)
+
+# Forecast and fetch time per grid cell, least recently used first, chats in the same cell share one OWM request
+_weather_cache: OrderedDict[tuple[float, float], tuple[str, datetime]] = OrderedDict()
+# Fetches in progress, callers asking for the same cell wait for the first one instead of repeating it
+_weather_fetches: dict[tuple[float, float], asyncio.Task] = {}
+
+
+def parse_location(text: str) -> tuple[float, float] | None:
+    """Reads 'lat,lon' or 'lat lon', None if it is not a valid coordinate"""
+    parts = text.replace(',', ' ').split()
+    if len(parts) != 2:
+        return None
+    try:
+        lat, lon = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def format_location(lat: float, lon: float) -> str:
+    return f"{lat:.4f},{lon:.4f}"
+
+
+def service_location(service: TService) -> tuple[float, float]:
+    """Weather services saved before locations were per chat have no location and follow DEFAULT_LOCATION"""
+    return parse_location(service.optional_url or '') or DEFAULT_LOCATION
+
+
+def weather_cell(lat: float, lon: float) -> tuple[float, float]:
+    """Center of the WEATHER_GRID_DEGREES cell a location falls in"""
+    return (round(round(lat / WEATHER_GRID_DEGREES) * WEATHER_GRID_DEGREES, 4),
+            round(round(lon / WEATHER_GRID_DEGREES) * WEATHER_GRID_DEGREES, 4))
+
+
+def _cached_forecast(cell: tuple[float, float], fresh_only: bool = True) -> str | None:
+    entry = _weather_cache.get(cell)
+    if entry is None:
+        return None
+    forecast, fetched_at = entry
+    if fresh_only and datetime.now() - fetched_at >= timedelta(seconds=WEATHER_CACHE_TTL):
+        return None
+    _weather_cache.move_to_end(cell)
+    return forecast
+
+
+def _store_forecast(cell: tuple[float, float], forecast: str) -> None:
+    _weather_cache[cell] = (forecast, datetime.now())
+    _weather_cache.move_to_end(cell)
+    while len(_weather_cache) > WEATHER_CACHE_SIZE:
+        _weather_cache.popitem(last=False)
+
+
+async def _fetch_cell(cell: tuple[float, float]) -> str:
+    try:
+        forecast = await fetch_weather(*cell)
+        _store_forecast(cell, forecast)
+        return forecast
+    finally:
+        del _weather_fetches[cell]
+
+
+async def forecast_for_cell(cell: tuple[float, float]) -> str:
+    """Returns the cached forecast of the cell while it is fresh, otherwise fetches and renders it again"""
+    forecast = _cached_forecast(cell)
+    if forecast is not None:
+        return forecast
+    task = _weather_fetches.get(cell)
+    if task is None:
+        task = _weather_fetches[cell] = asyncio.create_task(_fetch_cell(cell))
+    # Shielded, a caller giving up does not cancel the fetch the others are waiting for
+    return await asyncio.shield(task)
+
+
+async def get_weather(lat: float = DEFAULT_LOCATION[0], lon: float = DEFAULT_LOCATION[1]) -> str:
+    """Forecast of the grid cell around a location"""
+    return await forecast_for_cell(weather_cell(lat, lon))
+
+
+async def poll_weather(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """
+    Fetches the forecast of every distinct grid cell once and hands it to the chats in that cell.
+    At most WEATHER_MAX_CALLS_PER_SLOT cells are fetched, the most followed first, the rest get their last
+    cached forecast however old it is, or nothing in this slot.
+    :param services: active WEATHER services, from one chat or from all of them
+    :param failed: collects the services left without a forecast because its fetch failed
+    :return: list of messages per chat id
+    """
+    groups: dict[tuple[float, float], list[TService]] = {}
+    for service in services:
+        groups.setdefault(weather_cell(*service_location(service)), []).append(service)
+
+    forecasts: dict[tuple[float, float], str] = {}
+    expired = []
+    for cell in groups:
+        forecast = _cached_forecast(cell)
+        if forecast is None:
+            expired.append(cell)
+        else:
+            forecasts[cell] = forecast
+    expired.sort(key=lambda c: len(groups[c]), reverse=True)
+    fetched, over_budget = expired[:WEATHER_MAX_CALLS_PER_SLOT], expired[WEATHER_MAX_CALLS_PER_SLOT:]
+    if over_budget:
+        logger.warning(f'{len(over_budget)} cells over the budget of {WEATHER_MAX_CALLS_PER_SLOT} OWM calls per slot')
+
+    results = await asyncio.gather(*(forecast_for_cell(cell) for cell in fetched), return_exceptions=True)
+    failed_cells = set()
+    for cell, result in zip(fetched, results):
+        if isinstance(result, Exception):
+            logger.error(f'Failed to fetch the forecast for {format_location(*cell)}', exc_info=failure_info(result))
+            failed_cells.add(cell)
+            over_budget.append(cell)
+            continue
+        forecasts[cell] = result
+
+    skipped = 0
+    for cell in over_budget:
+        forecast = _cached_forecast(cell, fresh_only=False)
+        if forecast is None:
+            skipped += len(groups[cell])
+            if cell in failed_cells and failed is not None:
+                failed.extend(groups[cell])
+            continue
+        forecasts[cell] = forecast
+    if skipped:
+        logger.warning(f'No forecast to send to {skipped} chats in this slot')
+
+    return {service.id_chat: [forecasts[cell]] for cell, group in groups.items() if cell in forecasts
+            for service in group}
+
+
+async def fetch_weather(lat: float, lon: float) -> str:
+    owm_endpoint = f"{OWM_BASE_URL}/data/2.5/onecall"
     weather_params = {
-        "lat": 4.62,
-        "lon": -74.06,
+        "lat": lat,
+        "lon": lon,
         "appid": WEATHER_KEY,
         "exclude": "current,minutely,daily",
         "units": "metric",
     }
-    response = httpx.get(owm_endpoint, params=weather_params)
+    response = await http_client.get(owm_endpoint, params=weather_params, call='get_weather',
+                                     upstream=owm)
     response.raise_for_status()
     # get the next 8 hours of forecast to notify myself if it will rain
-    response_json = response.json()
+    with profiling.phase('parse'):
+        response_json = response.json()
     tz_offset = int(response_json['timezone_offset'])
     forecasts = response_json['hourly'][:8]
 
@@ -38,106 +230,559 @@ def get_weather():
     return forecast_str
 
 
-def entryd_to_date(date_str: str) -> datetime:
-    # Works only with the format of this feed
-    # Clean date string
-    date_str = date_str[5:-6]
-    # Convert to datetime obj
-    return datetime.strptime(date_str, '%d %b %Y %H:%M:%S')
+# Blog
+rss_feeds = Upstream('rss', RSS_READ_TIMEOUT)
+# Validators and parsed entries of every feed, a 304 reuses them without downloading or parsing
+_feed_cache: dict[str, dict] = {}
+
+
+def feed_url(service: TService) -> str:
+    """Blog services saved before feeds were per chat have no url and follow FEED_URL"""
+    return service.optional_url or FEED_URL
+
 
+def service_host(stype: ServiceType, service: TService) -> str:
+    """Upstream host a service is polled from, the one whose circuit breaker it depends on"""
+    if stype == ServiceType.WEATHER:
+        return urlsplit(OWM_BASE_URL).netloc
+    if stype == ServiceType.DEX:
+        return urlsplit(DEX_BASE_URL).netloc
+    return urlsplit(feed_url(service)).netloc
 
-def get_rss_feed(chat_id: int) -> tuple[bool, str]:
-    news_feed = feedparser.parse(FEED_URL)
 
-    # Get the latest date of an entry recorded by this script
-    row = dbf.get_service_by_chatid(db_file, str(chat_id), ServiceType.BLOG.value)
-    if not row:
-        raise ValueError(f"Blog service not found in database.")
+async def fetch_feed(url: str, since: datetime) -> list[tuple[datetime, str]]:
+    """
+    Downloads a feed with a conditional GET and returns up to its top 10 entries newer than `since`, as (date, title).
+    The body is parsed while it streams in and the download stops at the first entry that is not newer than `since`.
+    """
+    cached = _feed_cache.get(url)
+    headers = {}
+    # Entries cut at a later watermark do not cover `since`, the feed has to be read again
+    if cached and (cached['complete'] or since >= cached['since']):
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
 
-    tservice = TService(row)
+    async with http_client.stream(url, headers=headers, follow_redirects=True, call='get_rss_feed',
+                                  upstream=rss_feeds) as response:
+        if response.status_code == 304 and headers:
+            return cached['entries']
+        response.raise_for_status()
+
+        feed_stream = rss.FeedStream(since)
+        chunks = response.aiter_bytes()
+        try:
+            async for chunk in chunks:
+                with profiling.phase('parse'):
+                    feed_stream.feed(chunk)
+                if feed_stream.done:
+                    break
+            with profiling.phase('parse'):
+                entries = feed_stream.close()
+            complete = feed_stream.complete
+        except rss.MalformedFeed:
+            logger.warning(f'Falling back to feedparser for {url}')
+            content = bytes(feed_stream.raw) + b''.join([chunk async for chunk in chunks])
+            with profiling.phase('parse'):
+                entries = rss.parse_with_feedparser(content, since)
+            complete = False
+
+    _feed_cache[url] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'entries': entries,
+        'since': since,
+        'complete': complete,
+    }
+    return entries
 
-    # Take the top 10 entries and check whether they are new
-    new_entry_count = 0
-    msg_text = ""
-    last_date = tservice.last_updated
-    new_date = last_date
 
-    for e in news_feed.entries[:10]:
-        entry_date = entryd_to_date(e['published'])
-        if entry_date > last_date:
-            new_entry_count += 1
-            line = f"{entry_date} # {e['title']}\n"
-            msg_text += line
-            # Record the most recent date to log it in a file at the end of
-            # the process
-            if entry_date > new_date:
-                new_date = entry_date
+async def get_rss_feed(url: str, services: list[TService], batch: dbf.ServiceBatch) -> dict[str, str]:
+    """
+    Fetches a feed once for all the services following it and works out what each chat has not seen yet.
+    :param url:
+    :param services: active BLOG services sharing this feed
+    :param batch: collects the new last_updated of each service
+    :return: message per chat id, chats without new entries are left out
+    """
+    since = min(tservice.last_updated for tservice in services)
+    # Entries newer than an earlier watermark include the ones newer than this one
+    poll = recent_poll(('rss', url), since)
+    if poll is None:
+        poll = asyncio.create_task(fetch_feed(url, since))
+        share_poll([('rss', url)], since, poll)
+    # Shielded, a caller giving up does not cancel the poll the others are waiting for
+    entries = await asyncio.shield(poll)
 
-    if new_entry_count:
-        msg = f'There are {new_entry_count} new entries!\n{msg_text}'
-    else:
-        msg = 'There are no new entries.'
+    messages = {}
+    for tservice in services:
+        # Check whether the entries are new for this chat
+        new_entry_count = 0
+        msg_text = ""
+        last_date = tservice.last_updated
+        new_date = last_date
 
-    if new_entry_count:
-        dbf.add_or_upd_service(db_file, str(tservice.id_chat), tservice.id_type, IsActive.YES, last_updated=new_date)
+        for entry_dt, title in entries:
+            if entry_dt > last_date:
+                new_entry_count += 1
+                line = f"{entry_dt} # {title}\n"
+                msg_text += line
+                # Record the most recent date to log it in a file at the end of
+                # the process
+                if entry_dt > new_date:
+                    new_date = entry_dt
 
-    return new_entry_count > 0, msg
+        if new_entry_count:
+            messages[tservice.id_chat] = f'There are {new_entry_count} new entries in {url}!\n{msg_text}'
+            batch.upsert(tservice.id_chat, tservice.id_type, IsActive.YES,
+                         optional_url=tservice.optional_url, last_updated=new_date)
+
+    return messages
+
+
+async def poll_rss_feeds(services: list[TService], failed: list[TService] = None) -> dict[str, list[str]]:
+    """
+    Fetches every distinct feed once per cycle, RSS_CONCURRENCY at a time, and fans the news out to its subscribers.
+    :param services: active BLOG services, from one chat or from all of them
+    :param failed: collects the services of the feeds that could not be fetched
+    :return: list of messages per chat id
+    """
+    groups: dict[str, list[TService]] = {}
+    for service in services:
+        groups.setdefault(feed_url(service), []).append(service)
+
+    expire_polls()
+    batch = dbf.ServiceBatch(db_file)
+    # Thousands of feeds are on as many hosts, the per host limit does not keep them from draining the pool
+    feed_slots = asyncio.Semaphore(RSS_CONCURRENCY)
+
+    async def poll_feed(url: str, group: list[TService]) -> dict[str, str]:
+        async with feed_slots:
+            return await get_rss_feed(url, group, batch)
+
+    results = await asyncio.gather(*(poll_feed(url, group) for url, group in groups.items()),
+                                   return_exceptions=True)
+    await dbf.offload(batch.flush)
+
+    messages: dict[str, list[str]] = {}
+    for url, result in zip(groups, results):
+        if isinstance(result, Exception):
+            logger.error(f'Failed to poll feed {url}', exc_info=failure_info(result))
+            if failed is not None:
+                failed.extend(groups[url])
+            continue
+        for chat_id, msg in result.items():
+            messages.setdefault(chat_id, []).append(msg)
+    return messages
 
 
 # Dex
-def get_mangadex(manga_id: str, last_updated: datetime, chat_id: int):
+# Shared by every MangaDex call in the process, scheduled polls and commands alike
+dex_limiter = TokenBucket('MangaDex', DEX_RATE_LIMIT, DEX_RATE_BURST)
+mangadex = Upstream('mangadex', DEX_READ_TIMEOUT)
+
+
+DEX_LANGUAGES = ["en", "es", "es-la"]
+# Newest chapters reported per manga, what the single manga feed query has always returned
+DEX_CHAPTERS_PER_MANGA = 5
+# MangaDex caps a page at 100 results and offset + limit at 10000
+DEX_PAGE_SIZE = 100
+DEX_MAX_RESULTS = 10000
+DEX_CONTENT_RATINGS = ("safe", "suggestive", "erotica", "pornographic")
+
+
+def dex_filters(since: datetime) -> str:
+    str_languages = "&translatedLanguage[]=" + "&translatedLanguage[]=".join(DEX_LANGUAGES)
+    publish_since = "&publishAtSince=" + since.strftime("%Y-%m-%dT%H:%M:%S")
+    return "&includeFuturePublishAt=0&order[publishAt]=desc" + str_languages + publish_since
+
+
+async def fetch_manga_feed(manga_id: str, since: datetime) -> dict:
+    """Requests the latest chapters of a manga published after `since`"""
     # Api documentation: https://api.mangadex.org/docs/
+    options = f"?limit={DEX_CHAPTERS_PER_MANGA}" + dex_filters(since)
+    r = await http_client.get(f"{DEX_BASE_URL}/manga/{manga_id}/feed{options}", limiter=dex_limiter,
+                              call='get_mangadex', upstream=mangadex)
+    r.raise_for_status()
+    with profiling.phase('parse'):
+        return r.json()
 
-    base_url = "https://api.mangadex.org"
-    options = "?limit=5&includeFuturePublishAt=0&order[publishAt]=desc"
-    languages = ["en", "es", "es-la"]
-    str_languages = "&translatedLanguage[]=" + "&translatedLanguage[]=".join(languages)
-    publish_since = "&publishAtSince=" + last_updated.strftime("%Y-%m-%dT%H:%M:%S")
-    options += str_languages + publish_since
-    r = httpx.get(f"{base_url}/manga/{manga_id}/feed{options}")
+
+async def fetch_chapters(manga_ids: list[str], since: datetime) -> dict:
+    """Requests the chapters of several mangas published after `since` at once, following the pages"""
+    ids = "&".join(f"manga[]={manga_id}" for manga_id in manga_ids)
+    data = []
+    offset = 0
+    while True:
+        options = f"?{ids}&limit={DEX_PAGE_SIZE}&offset={offset}" + dex_filters(since)
+        r = await http_client.get(f"{DEX_BASE_URL}/chapter{options}", limiter=dex_limiter,
+                                  call='get_mangadex', upstream=mangadex)
+        r.raise_for_status()
+        with profiling.phase('parse'):
+            rdata = r.json()
+        if rdata["result"].lower() != "ok":
+            return rdata
+        data.extend(rdata["data"])
+        offset += DEX_PAGE_SIZE
+        if offset >= rdata["total"] or offset + DEX_PAGE_SIZE > DEX_MAX_RESULTS:
+            break
+    return {"result": "ok", "total": len(data), "data": data}
+
+
+def chapter_date(chapter: dict) -> datetime:
+    """Publish time of a chapter as naive UTC, like the DEX watermarks and the poll times"""
+    publish_at = chapter["attributes"]["publishAt"]
+    # MangaDex sends UTC, sliced directly as it is parsed for every chapter
+    if publish_at.endswith("+00:00"):
+        return datetime.strptime(publish_at[0:19], "%Y-%m-%dT%H:%M:%S")
+    return datetime.fromisoformat(publish_at).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def batch_cutoff() -> datetime:
+    """Mangas with a watermark older than this are polled alone, compared in naive UTC like the watermarks"""
+    return datetime.utcnow() - timedelta(days=DEX_BATCH_MAX_AGE_DAYS)
+
+
+def chapter_manga_id(chapter: dict) -> str | None:
+    for relationship in chapter.get("relationships", []):
+        if relationship["type"] == "manga":
+            return relationship["id"]
+    return None
+
+
+def parse_manga(data: dict) -> tuple:
+    """Metadata row of a manga object, the english title when there is one"""
+    attributes = data["attributes"]
+    titles = attributes.get("title") or {}
+    title = titles.get("en") or next(iter(titles.values()), data["id"])
+    alt_titles = [alt_title for alt in attributes.get("altTitles", []) for alt_title in alt.values()]
+    return data["id"], title, json.dumps(alt_titles, ensure_ascii=False), attributes.get("status"), datetime.now()
+
+
+async def fetch_manga_metadata(manga_ids: list[str]) -> list[tuple]:
+    """Requests the metadata of up to DEX_PAGE_SIZE mangas in one call"""
+    ids = "&".join(f"ids[]={manga_id}" for manga_id in manga_ids)
+    # The search hides erotica and pornographic titles unless asked for every rating
+    ratings = "&".join(f"contentRating[]={rating}" for rating in DEX_CONTENT_RATINGS)
+    r = await http_client.get(f"{DEX_BASE_URL}/manga?limit={len(manga_ids)}&{ids}&{ratings}", limiter=dex_limiter,
+                              call='get_manga_metadata', upstream=mangadex)
     r.raise_for_status()
+    with profiling.phase('parse'):
+        rdata = r.json()
+        if rdata["result"].lower() != "ok":
+            logger.warning(f'Manga metadata not available: {get_dex_error_msg(rdata)}')
+            return []
+        return [parse_manga(data) for data in rdata["data"]]
 
-    rdata = r.json()
-    if rdata["result"].lower() != "ok":
-        msg = f"{manga_id} error: \n"
-        msg += get_dex_error_msg(rdata)
-        return msg
 
-    if rdata["total"] == 0:
-        return ""
+async def manga_metadata(manga_ids) -> dict[str, TManga]:
+    """
+    Cached metadata of the mangas, what is missing or older than DEX_METADATA_TTL_DAYS is fetched in bulk first.
+    When MangaDex can't be reached the stale metadata is served, and mangas never fetched are left out.
+    """
+    manga_ids = list(dict.fromkeys(manga_ids))
+    if not manga_ids:
+        return {}
+    mangas = {row[0]: TManga(row) for row in await dbf.offload(dbf.get_manga_metadata, db_file, manga_ids)}
+    cutoff = datetime.now() - timedelta(days=DEX_METADATA_TTL_DAYS)
+    due = [manga_id for manga_id in manga_ids if manga_id not in mangas or mangas[manga_id].fetched_at < cutoff]
+    for i in range(0, len(due), DEX_PAGE_SIZE):
+        chunk = due[i:i + DEX_PAGE_SIZE]
+        try:
+            rows = await fetch_manga_metadata(chunk)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            # The chunks already fetched are kept, the rest is asked for again next time
+            logger.warning(f'Failed to fetch the metadata of {len(due) - i} mangas: {e!r}')
+            break
+        if rows:
+            await dbf.offload(dbf.save_manga_metadata, db_file, rows, DEX_METADATA_CACHE_SIZE)
+            mangas.update((row[0], TManga(row)) for row in rows)
+    return mangas
 
-    new_date: datetime = last_updated
 
-    result_str = f"New chapters for {manga_id}:\n"
-    for chapter in rdata["data"]:
-        publish_at = datetime.strptime(chapter["attributes"]["publishAt"][0:19], "%Y-%m-%dT%H:%M:%S")
-        if publish_at > new_date:
-            new_date = publish_at
+def manga_label(manga_id: str, manga: TManga | None) -> str:
+    return f"{manga.title} ({manga_id})" if manga else manga_id
+
+
+def render_chapters(manga_id: str, chapters: list, manga: TManga | None = None) -> str:
+    result_str = f"New chapters for {manga_label(manga_id, manga)}:\n"
+    for chapter in chapters:
         result_str += f"Ch:{chapter['attributes']['chapter']} - Title:{chapter['attributes']['title']}\n"
         result_str += (f"Language:{chapter['attributes']['translatedLanguage']} "
                        f"Date:{chapter['attributes']['publishAt'][0:19]}\n")
         result_str += f"Link: https://mangadex.org/chapter/{chapter['id']}\n\n"
+    return result_str
 
-    # Update service
-    lu = new_date + timedelta(seconds=1)  # Add 1 second to avoid repeating the last chapter in query
-    dbf.add_or_upd_service(db_file, str(chat_id), ServiceType.DEX.value,
-                           IsActive.YES, last_updated=lu, optional_url=manga_id)
 
-    return result_str
+def collect_unseen(manga_id: str, services: list[TService], chapters: list[dict],
+                   batch: dbf.ServiceBatch, manga: TManga | None = None) -> dict[str, str]:
+    """
+    Works out which of the chapters of a manga each chat has not seen yet.
+    :param manga_id:
+    :param services: active DEX services sharing this manga
+    :param chapters: newest first
+    :param batch: collects the new last_updated of each service
+    :param manga: cached metadata, for the title
+    :return: message per chat id, chats without news are left out
+    """
+    dated = [(chapter_date(chapter), chapter) for chapter in chapters[:DEX_CHAPTERS_PER_MANGA]]
+
+    messages = {}
+    for service in services:
+        unseen = [(publish_at, chapter) for publish_at, chapter in dated if publish_at >= service.last_updated]
+        if not unseen:
+            continue
+        messages[service.id_chat] = render_chapters(manga_id, [chapter for _, chapter in unseen], manga)
+
+        # Update service
+        new_date = max(publish_at for publish_at, _ in unseen)
+        lu = new_date + timedelta(seconds=1)  # Add 1 second to avoid repeating the last chapter in query
+        batch.upsert(service.id_chat, ServiceType.DEX.value, IsActive.YES, last_updated=lu, optional_url=manga_id)
+
+    return messages
+
+
+def advance_dormant(manga_id: str, services: list[TService], notified: dict[str, str], polled_at: datetime,
+                    batch: dbf.ServiceBatch) -> None:
+    """
+    Moves the watermark of the services a successful solo poll found nothing new for up to the time of the poll,
+    when it is older than DEX_BATCH_MAX_AGE_DAYS. Otherwise a manga without new chapters is queried alone forever.
+    """
+    cutoff = batch_cutoff()
+    for service in services:
+        if service.last_updated < cutoff and service.id_chat not in notified:
+            batch.upsert(service.id_chat, ServiceType.DEX.value, IsActive.YES, last_updated=polled_at,
+                         optional_url=manga_id)
+
+
+def dex_error_messages(manga_ids: list[str], groups: dict[str, list[TService]], rdata: dict) -> dict[str, list[str]]:
+    messages: dict[str, list[str]] = {}
+    for manga_id in manga_ids:
+        msg = f"{manga_id} error: \n"
+        msg += get_dex_error_msg(rdata)
+        for service in groups[manga_id]:
+            messages.setdefault(service.id_chat, []).append(msg)
+    return messages
+
+
+async def poll_manga_feed(manga_id: str, since: datetime) -> tuple[datetime, dict]:
+    """The time of the poll, chapter publish times are UTC, and the latest chapters of a manga"""
+    polled_at = datetime.utcnow()
+    return polled_at, await fetch_manga_feed(manga_id, since)
+
+
+async def poll_chapters(manga_ids: list[str], since: datetime) -> tuple[datetime, dict]:
+    """The time of the poll and the chapters of several mangas"""
+    polled_at = datetime.utcnow()
+    return polled_at, await fetch_chapters(manga_ids, since)
+
+
+async def get_mangadex(manga_id: str, services: list[TService], poll: asyncio.Task, batch: dbf.ServiceBatch,
+                       mangas: dict[str, TManga] = None,
+                       releases: dict[str, list[datetime]] = None) -> dict[str, list[str]]:
+    """
+    Hands the services following a single manga the result of its poll_manga_feed.
+    :param releases: collects the publish times of the chapters seen, per manga, only when the poll succeeded
+    :return: messages per chat id
+    """
+    # Shielded, the slots of other timezones may be waiting for the same poll
+    polled_at, rdata = await asyncio.shield(poll)
+    if rdata["result"].lower() != "ok":
+        return dex_error_messages([manga_id], {manga_id: services}, rdata)
+    if releases is not None:
+        releases[manga_id] = [chapter_date(chapter) for chapter in rdata["data"]]
+
+    unseen = collect_unseen(manga_id, services, rdata["data"], batch, (mangas or {}).get(manga_id))
+    advance_dormant(manga_id, services, unseen, polled_at, batch)
+    return {chat_id: [msg] for chat_id, msg in unseen.items()}
+
+
+async def get_mangadex_batch(manga_ids: list[str], groups: dict[str, list[TService]], poll: asyncio.Task,
+                             batch: dbf.ServiceBatch, mangas: dict[str, TManga] = None,
+                             releases: dict[str, list[datetime]] = None) -> dict[str, list[str]]:
+    """
+    Hands each manga its own chapters from the result of the poll_chapters query of several mangas.
+    :param releases: collects the publish times of the chapters seen, per manga, only when the poll succeeded
+    :return: messages per chat id
+    """
+    _, rdata = await asyncio.shield(poll)
+    if rdata["result"].lower() != "ok":
+        return dex_error_messages(manga_ids, groups, rdata)
+
+    by_manga: dict[str, list[dict]] = {}
+    for chapter in rdata["data"]:
+        by_manga.setdefault(chapter_manga_id(chapter), []).append(chapter)
+    if releases is not None:
+        releases.update((manga_id, [chapter_date(chapter) for chapter in by_manga.get(manga_id, [])])
+                        for manga_id in manga_ids)
+
+    messages: dict[str, list[str]] = {}
+    for manga_id in manga_ids:
+        chapters = by_manga.get(manga_id)
+        if not chapters:
+            continue
+        unseen = collect_unseen(manga_id, groups[manga_id], chapters, batch, (mangas or {}).get(manga_id))
+        for chat_id, msg in unseen.items():
+            messages.setdefault(chat_id, []).append(msg)
+    return messages
+
+
+async def get_shared_mangadex(manga_id: str, services: list[TService], poll: asyncio.Task,
+                              batch: dbf.ServiceBatch, mangas: dict[str, TManga] = None) -> dict[str, list[str]]:
+    """
+    Hands the services of a manga its chapters from a poll made moments ago for another timezone.
+    The publish times were recorded by that poll, they are not recorded again.
+    :return: messages per chat id
+    """
+    polled_at, rdata = await asyncio.shield(poll)
+    if rdata["result"].lower() != "ok":
+        return dex_error_messages([manga_id], {manga_id: services}, rdata)
+    chapters = [chapter for chapter in rdata["data"] if chapter_manga_id(chapter) == manga_id]
+    unseen = collect_unseen(manga_id, services, chapters, batch, (mangas or {}).get(manga_id))
+    advance_dormant(manga_id, services, unseen, polled_at, batch)
+    return {chat_id: [msg] for chat_id, msg in unseen.items()}
+
+
+async def poll_mangadex(services: list[TService], failed: list[TService] = None,
+                        schedule: bool = False) -> dict[str, list[str]]:
+    """
+    Polls MangaDex once per distinct manga, no matter how many chats follow it, packing up to
+    DEX_IDS_PER_REQUEST mangas in each chapter query.
+    Mangas with a watermark older than DEX_BATCH_MAX_AGE_DAYS (new subscriptions start in 2000) are queried
+    alone, otherwise their whole history would be paged through for the latest few chapters. Their first
+    successful poll moves the watermark forward, so they are packed from then on.
+    Mangas polled in the last SLOT_SHARE_TTL seconds from a watermark no newer than theirs reuse that poll.
+    :param services: active DEX services, from one chat or from all of them
+    :param failed: collects the services of the mangas that could not be polled
+    :param schedule: record the releases seen and when each manga is due again, only for polls made for every
+        chat following the mangas, otherwise the chats left out would wait for the next poll with old watermarks
+    :return: list of messages per chat id
+    """
+    groups: dict[str, list[TService]] = {}
+    for service in services:
+        groups.setdefault(service.optional_url, []).append(service)
+
+    # Titles for the messages, missing or expired ones cost one request per DEX_PAGE_SIZE mangas
+    mangas = await manga_metadata(groups)
+
+    # Polls are looked up and started without an await in between, so concurrent slots never repeat one
+    cutoff = batch_cutoff()
+    watermarks = {manga_id: min(s.last_updated for s in group) for manga_id, group in groups.items()}
+    expire_polls()
+    shared: dict[str, asyncio.Task] = {}
+    for manga_id, since in watermarks.items():
+        poll = recent_poll(('dex', manga_id), since)
+        if poll is not None:
+            shared[manga_id] = poll
+    watermarks = {manga_id: since for manga_id, since in watermarks.items() if manga_id not in shared}
+    solo = [manga_id for manga_id, since in watermarks.items() if since < cutoff]
+    # Sorted by watermark, so each packed query starts from a date close to all of its mangas
+    packed = sorted((manga_id for manga_id, since in watermarks.items() if since >= cutoff), key=watermarks.get)
+    chunks = [packed[i:i + DEX_IDS_PER_REQUEST] for i in range(0, len(packed), DEX_IDS_PER_REQUEST)]
+
+    # Pacing is left to dex_limiter, so requests go out as fast as MangaDex allows
+    batch = dbf.ServiceBatch(db_file)
+    releases: dict[str, list[datetime]] | None = {} if schedule else None
+    tasks = [get_shared_mangadex(manga_id, groups[manga_id], poll, batch, mangas) for manga_id, poll in shared.items()]
+    for manga_id in solo:
+        poll = asyncio.create_task(poll_manga_feed(manga_id, watermarks[manga_id]))
+        share_poll([('dex', manga_id)], watermarks[manga_id], poll)
+        tasks.append(get_mangadex(manga_id, groups[manga_id], poll, batch, mangas, releases))
+    for chunk in chunks:
+        # packed is sorted, the first manga of a chunk has its oldest watermark
+        since = watermarks[chunk[0]]
+        poll = asyncio.create_task(poll_chapters(chunk, since))
+        share_poll([('dex', manga_id) for manga_id in chunk], since, poll)
+        tasks.append(get_mangadex_batch(chunk, groups, poll, batch, mangas, releases))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await dbf.offload(batch.flush)
+    # Mangas that failed are left due, the next look for due mangas picks them up again
+    if schedule:
+        await schedule_polls(releases)
+    return merge_manga_polls([[manga_id] for manga_id in (*shared, *solo)] + chunks, results, groups, failed)
+
+
+def merge_manga_polls(polled: list[list[str]], results: list, groups: dict[str, list[TService]],
+                      failed: list[TService] = None) -> dict[str, list[str]]:
+    """
+    Messages per chat of the polls that succeeded. A poll that failed is logged and skipped, the mangas of the
+    others are still notified and their watermarks saved.
+    :param polled: manga ids of each poll, in the order of the results
+    :param results: messages per chat id or the exception of each poll
+    :param failed: collects the services of the mangas whose poll failed
+    """
+    messages: dict[str, list[str]] = {}
+    for manga_ids, result in zip(polled, results):
+        if isinstance(result, Exception):
+            logger.error(f'Failed to poll mangas {", ".join(manga_ids)}', exc_info=failure_info(result))
+            if failed is not None:
+                failed.extend(service for manga_id in manga_ids for service in groups[manga_id])
+            continue
+        for chat_id, msgs in result.items():
+            messages.setdefault(chat_id, []).extend(msgs)
+    return messages
+
+
+async def schedule_polls(releases: dict[str, list[datetime]]) -> None:
+    """Records the publish times seen by a poll and when each polled manga is due again"""
+    if not releases:
+        return
+    # Chapter publish times are UTC
+    now = datetime.utcnow()
+    history = await dbf.offload(dbf.record_manga_releases, db_file, releases, cadence.HISTORY)
+    rows = []
+    for manga_id in releases:
+        next_poll_at, interval = cadence.next_poll(history.get(manga_id, []), now)
+        rows.append((manga_id, now, next_poll_at, interval.total_seconds() if interval else None))
+    await dbf.offload(dbf.set_manga_polls, db_file, rows)
+
+
+def within_budget(manga_ids: list[str], services: list[TService], max_requests: int) -> list[str]:
+    """The first mangas of the list poll_mangadex can poll in max_requests chapter queries"""
+    cutoff = batch_cutoff()
+    watermarks: dict[str, datetime] = {}
+    for service in services:
+        current = watermarks.get(service.optional_url)
+        watermarks[service.optional_url] = service.last_updated if current is None else min(current,
+                                                                                             service.last_updated)
+    solo = packed = 0
+    selected = []
+    for manga_id in manga_ids:
+        if manga_id not in watermarks:
+            continue
+        if watermarks[manga_id] < cutoff:
+            solo += 1
+        else:
+            packed += 1
+        if solo + math.ceil(packed / DEX_IDS_PER_REQUEST) > max_requests:
+            break
+        selected.append(manga_id)
+    return selected
 
 
 async def check_manga_exists(manga_id: str):
-    base_url = "https://api.mangadex.org"
-    r = httpx.get(f"{base_url}/manga/{manga_id}")
-    rdata = r.json()
+    """Mangas in the metadata cache exist, the others are looked up and cached"""
+    cached = await dbf.offload(dbf.get_manga_metadata, db_file, [manga_id])
+    if cached:
+        return True, f"Manga {TManga(cached[0]).title} found!"
+
+    try:
+        r = await http_client.get(f"{DEX_BASE_URL}/manga/{manga_id}", limiter=dex_limiter,
+                                  call='check_manga_exists', upstream=mangadex)
+        rdata = r.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning(f'Failed to look up manga {manga_id}: {e!r}')
+        return False, "MangaDex can't be reached right now, please try again later"
     if 'result' not in rdata:
         return False, "Unexpected response from server"
 
     if rdata["result"].lower() != "ok":
         return False, get_dex_error_msg(rdata)
 
-    title = list(rdata["data"]["attributes"]["title"].values())[0]
-    return True, f"Manga {title} found!"
+    row = parse_manga(rdata["data"])
+    await dbf.offload(dbf.save_manga_metadata, db_file, [row], DEX_METADATA_CACHE_SIZE)
+    return True, f"Manga {row[1]} found!"
 
 
 def get_dex_error_msg(rdata: dict):
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger()
+
+
+class TokenBucket:
+    """
+    Process-wide token bucket, every coroutine that calls acquire() shares the same budget.
+    The bucket can also be paused when the upstream tells us to slow down.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float = 1):
+        self.name = name
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        """Waits until a token is available and takes it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> float:
+        """Takes a token without waiting and returns 0, or returns the seconds until one is available"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller for the given seconds and drop the accumulated burst"""
+        if seconds <= 0:
+            return
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.updated_at = now
+        logger.warning(f'{self.name} rate limit hit, pausing requests for {seconds:.1f}s')
+
+    def update_from_headers(self, headers) -> None:
+        """Honors Retry-After and X-RateLimit-* response headers"""
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if retry_after is None and headers.get('X-RateLimit-Remaining') == '0':
+            # MangaDex sends the epoch second at which the window resets
+            reset_at = headers.get('X-RateLimit-Retry-After') or headers.get('X-RateLimit-Reset')
+            if reset_at and reset_at.isdigit():
+                retry_after = int(reset_at) - time.time()
+        if retry_after:
+            self.pause(retry_after)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
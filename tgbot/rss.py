@@ -0,0 +1,158 @@
+"""
+Incremental RSS/Atom parsing: entries are read as the bytes arrive and reading stops at the
+first entry that is not newer than the watermark, so the rest of a large feed is never parsed.
+"""
+from datetime import datetime
+from email.utils import parsedate_tz
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+import feedparser
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+ITEM_TAGS = {'item', 'entry'}
+DATE_TAGS = ('pubDate', 'published', 'updated', 'date')
+
+
+class MalformedFeed(Exception):
+    pass
+
+
+def parse_rfc822(date_str: str) -> datetime:
+    """
+    'Wed, 03 Jan 2024 10:00:00 +0000' to the wall time of the feed, the offset is dropped as entryd_to_date does.
+    The common fixed-width layout is sliced directly, anything else goes through email.utils.
+    """
+    s = date_str.strip()
+    if len(s) >= 25 and s[3] == ',' and s[7] == ' ' and s[11] == ' ' and s[16] == ' ' and s[19] == ':':
+        month = MONTHS.get(s[8:11])
+        if month:
+            return datetime(int(s[12:16]), month, int(s[5:7]), int(s[17:19]), int(s[20:22]), int(s[23:25]))
+    parsed = parsedate_tz(s)
+    if parsed is None:
+        raise ValueError(f'Unknown date format: {date_str}')
+    return datetime(*parsed[:6])
+
+
+def entryd_to_date(date_str: str) -> datetime:
+    # Works only with the format of this feed
+    # Clean date string
+    date_str = date_str[5:-6]
+    # Convert to datetime obj
+    return datetime.strptime(date_str, '%d %b %Y %H:%M:%S')
+
+
+def entry_date(entry) -> datetime:
+    try:
+        return entryd_to_date(entry['published'])
+    except (KeyError, ValueError):
+        # Other feeds, fall back to the date feedparser already parsed
+        parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        if not parsed:
+            raise ValueError(f"Entry {entry.get('title')} has no date")
+        return datetime(*parsed[:6])
+
+
+def parse_date(date_str: str) -> datetime:
+    """RSS uses RFC-822 dates, Atom uses ISO 8601"""
+    date_str = date_str.strip()
+    if date_str[:4].isdigit():
+        return datetime.fromisoformat(date_str.replace('Z', '+00:00')).replace(tzinfo=None)
+    return parse_rfc822(date_str)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+class FeedStream:
+    """
+    Feed it the body of a feed chunk by chunk, `done` turns true once the watermark or the limit is reached.
+    """
+
+    def __init__(self, since: datetime, limit: int = 10):
+        self.since = since
+        self.limit = limit
+        self.entries: list[tuple[datetime, str]] = []
+        self.done = False
+        # Whether every entry up to the limit was read, rather than stopping at the watermark
+        self.complete = False
+        self.raw = bytearray()
+        self._parser = XMLPullParser(events=('end',))
+
+    def feed(self, chunk: bytes) -> None:
+        if self.done:
+            return
+        self.raw += chunk
+        try:
+            self._parser.feed(chunk)
+            self._read_events()
+        except (ParseError, ValueError) as e:
+            raise MalformedFeed(str(e)) from e
+
+    def close(self) -> list[tuple[datetime, str]]:
+        """Returns the entries newer than the watermark, newest first"""
+        if not self.done:
+            try:
+                self._parser.close()
+                self._read_events()
+            except (ParseError, ValueError) as e:
+                raise MalformedFeed(str(e)) from e
+            if not self.entries and b'<item' not in self.raw and b'<entry' not in self.raw:
+                raise MalformedFeed('No entries found')
+            self.complete = True
+        self.raw = bytearray()
+        return self.entries
+
+    def _read_events(self) -> None:
+        for _, element in self._parser.read_events():
+            if _local_name(element.tag) not in ITEM_TAGS:
+                continue
+            title = ''
+            date_str = None
+            for child in element:
+                name = _local_name(child.tag)
+                if name == 'title':
+                    title = (child.text or '').strip()
+                elif name in DATE_TAGS and date_str is None:
+                    date_str = child.text
+            element.clear()
+            if not date_str:
+                raise ValueError(f'Entry {title} has no date')
+            entry_dt = parse_date(date_str)
+            if entry_dt <= self.since:
+                self._stop(complete=False)
+                return
+            self.entries.append((entry_dt, title))
+            if len(self.entries) >= self.limit:
+                self._stop(complete=True)
+                return
+
+    def _stop(self, complete: bool) -> None:
+        self.done = True
+        self.complete = complete
+
+
+def parse_with_feedparser(content: bytes, since: datetime, limit: int = 10) -> list[tuple[datetime, str]]:
+    """Slow path for feeds the streaming parser cannot read, same result shape"""
+    news_feed = feedparser.parse(content)
+    entries = []
+    for e in news_feed.entries[:limit]:
+        entry_dt = entry_date(e)
+        if entry_dt > since:
+            entries.append((entry_dt, e['title']))
+    return entries
+
+
+def parse_feed(content: bytes, since: datetime, limit: int = 10, chunk_size: int = 64 * 1024) -> list:
+    """Parses a whole document, streaming first and falling back to feedparser"""
+    stream = FeedStream(since, limit)
+    try:
+        for i in range(0, len(content), chunk_size):
+            stream.feed(content[i:i + chunk_size])
+            if stream.done:
+                break
+        return stream.close()
+    except MalformedFeed:
+        return parse_with_feedparser(content, since, limit)
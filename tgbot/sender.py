@@ -0,0 +1,211 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+
+from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
+
+from settings.config import TG_GLOBAL_RATE, TG_CHAT_RATE, TG_SEND_WORKERS, TG_SEND_RETRIES
+from monitoring import metrics, profiling
+from tgbot.ratelimit import TokenBucket
+
+logger = logging.getLogger()
+
+
+class ProfiledRequest(HTTPXRequest):
+    """Bot API requests, timed as the send phase of the profiled run they belong to"""
+
+    async def do_request(self, *args, **kwargs):
+        with profiling.phase('send'):
+            return await super().do_request(*args, **kwargs)
+
+
+# Idle per-chat buckets are dropped once there are more than this many
+MAX_CHAT_BUCKETS = 10_000
+
+
+class SendQueue:
+    """
+    Central outbound queue for scheduled notifications.
+    Messages are delivered as fast as Telegram allows: a global bucket (~30 msg/s) and one bucket per chat,
+    RetryAfter pauses everything for the time Telegram asks, and network errors are retried with backoff.
+    Each chat has its own queue and workers only pick up a chat whose bucket has a token, so a chat with many
+    messages never holds a worker while it waits. A chat has one message in flight at a time, retries go back to
+    the front of its queue, so its messages arrive in order.
+    """
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 workers: int = TG_SEND_WORKERS, max_retries: int = TG_SEND_RETRIES):
+        self.bot: Bot | None = None
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket('Telegram', global_rate, global_rate)
+        self.chat_buckets: dict[str, TokenBucket] = {}
+        # Messages of each chat as (text, kwargs, attempt), a chat is listed while it has messages queued or in flight
+        self._chats: dict[str, deque[tuple[str, dict, int]]] = {}
+        # (monotonic time the chat can be sent to, sequence, chat id) of the chats waiting for a worker
+        self._ready: list[tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        # Created by start() in the loop of the workers, messages queued before that wait for it
+        self._wakeup: asyncio.Event | None = None
+        self._drained: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        # Stats of the current fan-out, from the first message queued until the queue is empty again
+        self.busy_since: float | None = None
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        """Messages queued or being delivered"""
+        return self.pending
+
+    def drain_estimate(self) -> float:
+        """Seconds needed to deliver what is queued at the global rate"""
+        return self.depth / self.global_bucket.rate
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        if self.pending == 0:
+            self._drained.set()
+        self._tasks = [asyncio.create_task(self._worker(), name=f'send-worker-{i}') for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Delivers what is still queued and stops the workers"""
+        if not self._tasks:
+            return
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = self._drained = None
+
+    def send(self, chat_id: str, text: str, **kwargs) -> None:
+        """Queue a message, it is never dropped unless Telegram refuses it for good"""
+        if self.busy_since is None:
+            self.busy_since = time.monotonic()
+            self.sent = self.failed = 0
+        self.pending += 1
+        if self._drained:
+            self._drained.clear()
+        chat_id = str(chat_id)
+        messages = self._chats.get(chat_id)
+        if messages is None:
+            messages = self._chats[chat_id] = deque()
+            self._schedule(chat_id, 0.0)
+        messages.append((text, kwargs, 0))
+
+    async def join(self) -> None:
+        """Waits until every queued message has been delivered or given up"""
+        if self.pending == 0:
+            return
+        if self._drained is None:
+            raise RuntimeError('SendQueue.start() has to be called before waiting for the messages')
+        await self._drained.wait()
+
+    def _schedule(self, chat_id: str, at: float) -> None:
+        heapq.heappush(self._ready, (at, next(self._sequence), chat_id))
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _next_chat(self) -> str:
+        """Waits for a chat that can be sent to and takes it out of the ready heap"""
+        while True:
+            timeout = None
+            if self._ready:
+                timeout = self._ready[0][0] - time.monotonic()
+                if timeout <= 0:
+                    return heapq.heappop(self._ready)[2]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                self._prune_buckets()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(f'Telegram chat {chat_id}', self.chat_rate)
+        return bucket
+
+    def _prune_buckets(self) -> None:
+        idle_since = time.monotonic() - 60
+        for chat_id in [c for c, b in self.chat_buckets.items() if b.updated_at < idle_since and c not in self._chats]:
+            del self.chat_buckets[chat_id]
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._next_chat()
+            wait = self._chat_bucket(chat_id).try_acquire()
+            if wait > 0:
+                self._schedule(chat_id, time.monotonic() + wait)
+                continue
+            messages = self._chats[chat_id]
+            text, kwargs, attempt = messages.popleft()
+            retry_in = None
+            try:
+                retry_in = await self._deliver(chat_id, text, kwargs, attempt)
+            except Exception:
+                self.failed += 1
+                logger.error(f'Failed to send message to chat {chat_id}', exc_info=True)
+            if retry_in is None:
+                self._done()
+            else:
+                # Ahead of the chat's later messages, so they keep their order
+                messages.appendleft((text, kwargs, attempt + 1))
+            if messages:
+                self._schedule(chat_id, time.monotonic() + (retry_in or 0.0))
+            else:
+                del self._chats[chat_id]
+
+    def _done(self) -> None:
+        self.pending -= 1
+        if self.pending == 0:
+            self._drained.set()
+            if self.busy_since is not None:
+                self._report()
+
+    async def _deliver(self, chat_id: str, text: str, kwargs: dict, attempt: int) -> float | None:
+        """Sends one message, returns the seconds to wait before retrying it or None when it is done with"""
+        await self.global_bucket.acquire()
+        try:
+            await self.bot.send_message(chat_id, text=text, **kwargs)
+            self.sent += 1
+        except RetryAfter as e:
+            # Flood control applies to the whole bot, hold every worker
+            self.global_bucket.pause(float(e.retry_after))
+            if attempt >= self.max_retries:
+                raise
+            return 0.0
+        except (Forbidden, BadRequest) as e:
+            # Blocked by the user or a bad message, retrying will not help
+            self.failed += 1
+            logger.warning(f'Telegram refused message to chat {chat_id}: {e}')
+        except NetworkError as e:
+            if attempt >= self.max_retries:
+                raise
+            delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+            logger.warning(f'Sending to chat {chat_id} failed ({e}), retrying in {delay:.1f}s')
+            return delay
+        return None
+
+    def _report(self) -> None:
+        drain_time = time.monotonic() - self.busy_since
+        self.busy_since = None
+        logger.info(f'Send queue drained: {self.sent} sent, {self.failed} failed in {drain_time:.1f}s')
+
+
+send_queue = SendQueue()
+metrics.send_queue_depth.set_function(lambda: send_queue.depth)
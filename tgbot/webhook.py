@@ -0,0 +1,209 @@
+"""
+Webhook ingestion, the alternative to long polling selected with BOT_MODE=webhook.
+
+Telegram (or the load balancer in front of the bot) POSTs each update to WEBHOOK_PATH. Requests without the
+WEBHOOK_SECRET in X-Telegram-Bot-Api-Secret-Token are refused. When the bot registers WEBHOOK_URL itself and no
+secret is set a random one is generated for the run, without either the bot refuses to start. Accepted updates go
+through a bounded queue and are processed up to WEBHOOK_CONCURRENCY at a time. On SIGINT/SIGTERM the server stops
+accepting updates and the ones already queued are processed before the bot exits. GET /healthz answers 200 for
+health checks.
+
+Recorded updates can be replayed against a running bot:
+
+    python -m tgbot.webhook update.json [more.json ...] --url http://127.0.0.1:8443/telegram
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+import signal
+
+import httpx
+from telegram import Update
+from telegram.ext import Application
+
+from settings.config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, \
+    WEBHOOK_MAX_BODY, WEBHOOK_CONCURRENCY, WEBHOOK_READ_TIMEOUT
+
+logger = logging.getLogger()
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookServer:
+    """Minimal keep-alive HTTP/1.1 server that feeds the application's update queue"""
+
+    def __init__(self, application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.accepting = False
+        self._server: asyncio.AbstractServer | None = None
+        self._connections: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self.accepting = True
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logger.info(f'Webhook listening on {self.listen}:{self.port}{self.path}')
+
+    async def stop(self) -> None:
+        """Stops accepting updates and waits for the requests being read, what is queued is left to the application"""
+        self.accepting = False
+        if self._server is None:
+            return
+        self._server.close()
+        # Idle keep-alive connections would hold wait_closed() forever
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    def _authorized(self, headers: dict) -> bool:
+        if not self.secret:
+            return False
+        return hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self.secret.encode())
+
+    def _enqueue(self, body: bytes) -> int:
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400
+        if update is None:
+            return 400
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram delivers it again later, the queue has drained a bit by then
+            logger.warning('Webhook update queue full, asking Telegram to retry')
+            return 503
+        return 200
+
+    def _respond(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        path = target.split('?', 1)[0]
+        if path == '/healthz':
+            return 200 if self.accepting else 503
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not self._authorized(headers):
+            return 403
+        if not self.accepting:
+            return 503
+        return self._enqueue(body)
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes | None] | None:
+        """Method, target, headers and body of the next request, no body when it is too large, None at EOF"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        body = await reader.readexactly(length) if length <= WEBHOOK_MAX_BODY else None
+        return method, target, headers, body
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                # A client that stops sending, or a connection left idle, does not hold its slot forever
+                request = await asyncio.wait_for(self._read_request(reader), WEBHOOK_READ_TIMEOUT)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                if body is None:
+                    status = 413
+                    keep_alive = False
+                else:
+                    status = self._respond(method, target, headers, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close' and self.accepting
+                writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(task)
+
+
+async def run_webhook(application: Application) -> None:
+    """Runs the application fed by the webhook until SIGINT or SIGTERM, then drains it"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise SystemExit('BOT_MODE=webhook needs WEBHOOK_SECRET when the webhook is registered elsewhere')
+        # Only Telegram learns it, through set_webhook below
+        secret = secrets.token_urlsafe(32)
+        logger.info('No WEBHOOK_SECRET set, using a random one for this run')
+
+    server = WebhookServer(application, secret=secret)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        # Without a public url the webhook is registered elsewhere, e.g. by whoever runs the load balancer
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES,
+                                              max_connections=WEBHOOK_CONCURRENCY)
+            logger.info(f'Webhook registered at {WEBHOOK_URL}')
+
+        await stop.wait()
+        logger.info('Stopping, processing the updates already received')
+    finally:
+        await server.stop()
+        # Processes what is still in the update queue before returning
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        # Same order as Application.run_polling, post_shutdown sees the application already shut down
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='json files holding an update or a list of updates')
+    parser.add_argument('--url', default=f'http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+    parser.add_argument('--secret', default=WEBHOOK_SECRET)
+    args = parser.parse_args()
+
+    headers = {'Content-Type': 'application/json'}
+    if args.secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = args.secret
+    with httpx.Client(headers=headers) as client:
+        for filename in args.files:
+            with open(filename) as f:
+                updates = json.load(f)
+            for update in updates if isinstance(updates, list) else [updates]:
+                response = client.post(args.url, json=update)
+                print(f"{filename} update {update.get('update_id')}: {response.status_code}")
+
+
+if __name__ == '__main__':
+    main()
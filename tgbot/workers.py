@@ -0,0 +1,115 @@
+"""
+Optional multi-process mode, enabled with WORKER_PROCESSES > 0.
+
+The bot process keeps answering commands while each worker process owns the chats whose shard_of(chat.id) is its
+index, and runs the weather, blog and dex slots for them with its own event loop, HTTP pool and send queue.
+Workers claim every (slot, timezone, day, shard) in the slot_claim table before running it, so a shard is never
+processed twice, even by a worker started twice by mistake. A claim is marked done once the slot's digests are in
+the outbox, one left unfinished for SLOT_CLAIM_TIMEOUT seconds is taken over by the next worker of the shard.
+
+The upstream budgets (Telegram, MangaDex, OWM) are per bot, they are split evenly between the processes.
+Each worker serves its own metrics on METRICS_PORT + 1 + its shard index and arms the PROFILE_TARGETS itself,
+/profile only reaches the bot process.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from telegram.ext import Application, CallbackContext, ContextTypes
+from telegram.request import HTTPXRequest
+
+import db.db_funcs as dbf
+from settings.config import WORKER_PROCESSES, WORKER_REFRESH_INTERVAL, TG_GLOBAL_RATE, DEX_RATE_LIMIT, \
+    DEX_RATE_BURST, WEATHER_MAX_CALLS_PER_SLOT, TELEGRAM_TOKEN, TELEGRAM_BASE_URL, METRICS_PORT, PROFILING, \
+    TG_POOL_SIZE
+from monitoring import metrics, profiling
+from tgbot import http_client, my_apis
+from tgbot.bot import load_saved_jobs
+from tgbot.sender import send_queue, ProfiledRequest
+
+logger = logging.getLogger()
+
+_processes: list[multiprocessing.Process] = []
+
+
+def metrics_port(shard: int) -> int:
+    """Port of a worker's metrics endpoint, next to the bot's, 0 while the endpoint is disabled"""
+    return METRICS_PORT + 1 + shard if METRICS_PORT else 0
+
+
+def split_limits(processes: int) -> None:
+    """Gives this process its share of the budgets every process of the bot draws from"""
+    send_queue.global_bucket.rate = TG_GLOBAL_RATE / processes
+    send_queue.global_bucket.capacity = max(1.0, TG_GLOBAL_RATE / processes)
+    my_apis.dex_limiter.rate = DEX_RATE_LIMIT / processes
+    my_apis.dex_limiter.capacity = max(1.0, DEX_RATE_BURST / processes)
+    my_apis.WEATHER_MAX_CALLS_PER_SLOT = max(1, WEATHER_MAX_CALLS_PER_SLOT // processes)
+
+
+async def refresh_slot_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Picks up the timezones chats moved to since the worker started"""
+    load_saved_jobs(context)
+
+
+async def _run(shard: int, shards: int) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # The bot process answers commands too, it keeps a share of the budgets
+    split_limits(shards + 1)
+    request_class = ProfiledRequest if PROFILING else HTTPXRequest
+    application = (Application.builder().token(TELEGRAM_TOKEN).base_url(TELEGRAM_BASE_URL)
+                   .request(request_class(connection_pool_size=TG_POOL_SIZE)).build())
+    application.bot_data['shard'] = (shard, shards)
+    async with application:
+        await http_client.start_client()
+        send_queue.start(application.bot)
+        await metrics.start_server(port=metrics_port(shard))
+        if PROFILING:
+            profiling.arm_from_config()
+        await application.start()
+        load_saved_jobs(CallbackContext(application))
+        application.job_queue.run_repeating(refresh_slot_jobs, interval=WORKER_REFRESH_INTERVAL,
+                                            first=WORKER_REFRESH_INTERVAL, name='refresh_slot_jobs')
+        logger.info(f'Worker {shard}/{shards} started')
+
+        await stop.wait()
+        # Lets a running slot finish and its messages go out
+        await application.stop()
+        await send_queue.stop()
+        await http_client.close_client()
+        await metrics.stop_server()
+        dbf.close_connections()
+    logger.info(f'Worker {shard}/{shards} stopped')
+
+
+def run_worker(shard: int, shards: int) -> None:
+    """Entry point of a worker process"""
+    asyncio.run(_run(shard, shards))
+
+
+def start_workers(processes: int = WORKER_PROCESSES) -> None:
+    """Spawns the workers, the calling process keeps its share of the budgets for the commands"""
+    split_limits(processes + 1)
+    context = multiprocessing.get_context('spawn')
+    for shard in range(processes):
+        process = context.Process(target=run_worker, args=(shard, processes), name=f'worker-{shard}')
+        process.start()
+        _processes.append(process)
+    logger.info(f'Started {processes} worker processes')
+
+
+def stop_workers(timeout: float = 60) -> None:
+    """Asks every worker to finish its current slot and waits for them"""
+    for process in _processes:
+        if process.is_alive():
+            process.terminate()
+    for process in _processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning(f'{process.name} did not stop in {timeout:.0f}s, killing it')
+            process.kill()
+    _processes.clear()